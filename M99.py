@@ -4,54 +4,899 @@
 """
 M99 Machine
 """
+import os
 import re
 import sys
+import time
+import struct
+import mmap
+import hashlib
 import argparse
-
-# Token format: (regex, (opcode, arg1, arg2, ...))
-# if argument is negative, it refer to a regex group
-# else it is a constant
-REGISTER_TOKENS = "(A|B|R|PC|SB|RA)"
-# None means ignore
-# -n means use the n-th regex group
-# n means use the constant n
-TOKENS = [
-    (r"^\s*STR ([0-9]{1,2})\s*$", (0, 0, -1)),
-    (r"^\s*LDA ([0-9]{1,2})\s*$", (1, 0, -1)),
-    (r"^\s*LDB ([0-9]{1,2})\s*$", (2, 0, -1)),
-    (r"^\s*MOV " + REGISTER_TOKENS + " " + REGISTER_TOKENS + "\s*$", (3, -1, -2)),
-    (r"^\s*ADD\s*$", (4, 0, 0)),
-    (r"^\s*SUB\s*$", (4, 0, 1)),
-    (r"^\s*MUL\s*$", (4, 0, 2)),
-    (r"^\s*JMP ([0-9]{1,2})\s*$", (5, 0, -1)),
-    (r"^\s*JPP ([0-9]{1,2})\s*$", (6, 0, -1)),
-    (r"^\s*JEQ ([0-9]{1,2})\s*$", (7, 0, -1)),
-    (r"^\s*JNE ([0-9]{1,2})\s*$", (8, 0, -1)),
-    (r"^\s*CAL ([0-9]{1,2})\s*$", (9, 0, -1)),
-    (r"^\s*RET\s*$", (4, 0, 9)),
-    (r"^\s*PSH " + REGISTER_TOKENS + "\s*$", (4, 8, -1)),
-    (r"^\s*POP " + REGISTER_TOKENS + "\s*$", (4, 9, -1)),
-    (r"^\s*DAT ([0-9]{1,3})\s*$", (0, 0, -1)),
+import tempfile
+from array import array
+from collections import deque
+from typing import NamedTuple
+
+# Instruction format: mnemonic -> (base opcode, operand)
+# None means no operand
+# address means a 1 or 2 digit number or a label, added to the opcode
+# value means a 1 to 3 digit number or a label, added to the opcode
+# register means a register, its id is added to the opcode
+# registers means two registers, id1 * 10 + id2 is added to the opcode
+INSTRUCTIONS = {
+    "STR": (0, "address"),
+    "LDA": (100, "address"),
+    "LDB": (200, "address"),
+    "MOV": (300, "registers"),
+    "ADD": (400, None),
+    "SUB": (401, None),
+    "MUL": (402, None),
+    "JMP": (500, "address"),
+    "JPP": (600, "address"),
+    "JEQ": (700, "address"),
+    "JNE": (800, "address"),
+    "CAL": (900, "address"),
+    "RET": (409, None),
+    "PSH": (480, "register"),
+    "POP": (490, "register"),
+    "DAT": (0, "value"),
+}
+
+OPERAND_PATTERNS = {
+    "address": re.compile(r"[0-9]{1,2}"),
+    "value": re.compile(r"[0-9]{1,3}"),
+    "register": re.compile(r"A|B|R|PC|SB|RA"),
+}
+
+# A line is either empty, a comment, a label definition or an instruction
+# followed by an optional comment
+LINE_PATTERN = re.compile(
+    r"^\s*(?:"
+    r"(?:#.*)?"
+    r"|:(?P<label>[A-Za-z][a-zA-Z09_\-]+)"
+    r"|(?P<mnemonic>[A-Z]{3})(?: (?P<arg1>[^\s#]+))?(?: (?P<arg2>[^\s#]+))?\s*(?:#.*)?"
+    r")$"
+)
+# Must be changed whenever the assembler output changes, it is part of the
+# key of the assembly cache
+ASSEMBLER_VERSION = 2
+
+LABEL_PATTERN = re.compile(r"@([a-zA-Z][a-zA-Z0-9_\-]+)")
+COMMENT_PATTERN = re.compile(r"\s*#.*")
+
+# Execution engines accepted by M99.run
+# step: the reference interpreter, one call to step per instruction
+# decoded: memory is decoded once into a table of handlers
+# compiled: basic blocks are compiled into Python functions
+# fused: decoded, with common sequences of instructions fused into one handler
+ENGINES = ("step", "decoded", "compiled", "fused")
+
+# Name of the local variables holding the registers in compiled blocks,
+# the PC is never stored in a local variable
+BLOCK_REGISTERS = ("R", "A", "B", None, "SB", "RA")
+
+# Number of instructions executed by the decoded engine between two checks of
+# the step limit
+DECODED_CHUNK = 1 << 16
+
+# Registers that can be watched, the PC changes at every instruction and is
+# watched with breakpoints instead
+WATCH_REGISTERS = ("R", "A", "B", "SB", "RA")
+
+# Time between two checks of the timeout of a run, in seconds. The number of
+# instructions executed between two checks grows until a check takes that long
+TIMEOUT_SLICE = 0.01
+TIMEOUT_FIRST_CHUNK = 1 << 10
+
+# Snapshot format: shutdown flag, size of the memory and of the registers
+SNAPSHOT_HEADER = struct.Struct("<?HH")
+
+# Random 64 bits key of each memory cell, the hash of the memory being the sum
+# of the cells multiplied by their key so that a write updates it in O(1)
+LOOP_HASH_KEYS = [
+    int.from_bytes(hashlib.blake2b(bytes([cell]), digest_size=8).digest(), "little")
+    for cell in range(99)
 ]
+LOOP_HASH_MASK = (1 << 64) - 1
+
+# Values of the memory and the registers of a cleared or restarted machine,
+# copied into the existing ones
+EMPTY_MEMORY = array("h", bytes(2 * 99))
+INITIAL_REGISTERS = (
+    0,  # R
+    0,  # A
+    0,  # B
+    0,  # PC
+    98,  # SB
+    0,  # RA
+)
+
+
+def prompt_input() -> int:
+    """
+    Read a value from the standard input, the default input channel.
+
+    Returns:
+        int: value read from the standard input, None at the end of the input.
+    """
+    print("Enter a value: ", end="")
+    valid = False
+    while not valid:
+        try:
+            value = input()
+        except EOFError:
+            return None
+        if value.isnumeric():
+            valid = True
+        else:
+            print("Invalid input. Enter a value: ", end="")
+    return int(value)
+
+
+def print_output(value: int) -> None:
+    """
+    Write a value to the standard output, the default output channel.
+
+    Args:
+        value (int): value to be written to the standard output.
+    """
+    print(value)
+
+
+class IterableInput:
+    """
+    Input channel returning the values of an iterable one after the other.
+    Once the values are exhausted it returns None, which makes the machine
+    shut down like an invalid input does.
+    """
+
+    def __init__(self, values) -> None:
+        self._values = iter(values)
+        self.exhausted = False
+
+    def __call__(self) -> int:
+        value = next(self._values, None)
+        if value is None:
+            self.exhausted = True
+        return value
+
+
+class StreamInput(IterableInput):
+    """
+    Input channel reading all the values of a stream at once.
+    The whole stream is read and split on whitespaces the first time a value is
+    requested, instead of prompting for each value.
+    """
+
+    def __init__(self, stream=sys.stdin) -> None:
+        super().__init__(())
+        self._stream = stream
+        self._loaded = False
+
+    def __call__(self) -> int:
+        if not self._loaded:
+            self._loaded = True
+            tokens = self._stream.read().split()
+            for token in tokens:
+                if not re.match(r"^-?[0-9]+$", token):
+                    raise ValueError(f"Invalid input value {token}")
+            self._values = map(int, tokens)
+        return super().__call__()
+
+
+class ListOutput:
+    """
+    Output channel collecting the values in a list.
+    """
+
+    def __init__(self) -> None:
+        self.values = []
+
+    def __call__(self, value: int) -> None:
+        self.values.append(value)
+
+
+class StreamOutput:
+    """
+    Output channel writing the values to a stream, one per line, by batches.
+    flush must be called once the machine stopped to write the last values.
+    """
+
+    def __init__(self, stream=sys.stdout, size: int = 4096) -> None:
+        self._stream = stream
+        self._size = size
+        self._buffer = []
+
+    def __call__(self, value: int) -> None:
+        self._buffer.append(str(value))
+        if len(self._buffer) >= self._size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered values to the stream.
+        """
+        if self._buffer:
+            self._stream.write("\n".join(self._buffer) + "\n")
+            self._buffer.clear()
+        self._stream.flush()
+
+
+class RunStats(NamedTuple):
+    """
+    Resources used by a run of a machine.
+    """
+
+    # Number of executed instructions
+    steps: int
+    # Maximum number of values on the stack
+    max_depth: int
+    # Number of values read and written
+    inputs: int
+    outputs: int
+    # Duration of the run in seconds
+    elapsed: float
+
+
+class Snapshot(NamedTuple):
+    """
+    Immutable copy of the state of a machine.
+    The memory and the registers are packed as int16 arrays, or int64 arrays
+    when a value does not fit, which makes a snapshot about 220 bytes.
+    """
+
+    memory: bytes
+    registers: bytes
+    shutdown: bool
+
+    @staticmethod
+    def pack_values(values: list[int]) -> bytes:
+        try:
+            return array("h", values).tobytes()
+        except OverflowError:
+            return array("q", values).tobytes()
+
+    @staticmethod
+    def unpack_values(data: bytes, count: int) -> list[int]:
+        return array("h" if len(data) == 2 * count else "q", data).tolist()
+
+    def pack(self) -> bytes:
+        """
+        Serialize the snapshot, in the byte order of the host.
+
+        Returns:
+            bytes: the serialized snapshot.
+        """
+        header = SNAPSHOT_HEADER.pack(self.shutdown, len(self.memory), len(self.registers))
+        return header + self.memory + self.registers
+
+    @classmethod
+    def unpack(cls, data: bytes) -> "Snapshot":
+        """
+        Deserialize a snapshot serialized with pack.
+
+        Args:
+            data (bytes): the serialized snapshot.
+
+        Returns:
+            Snapshot: the snapshot.
+        """
+        try:
+            (shutdown, memory_size, registers_size) = SNAPSHOT_HEADER.unpack_from(data)
+        except struct.error:
+            raise ValueError("Invalid snapshot.")
+        offset = SNAPSHOT_HEADER.size
+        if len(data) != offset + memory_size + registers_size:
+            raise ValueError("Invalid snapshot.")
+        memory = data[offset : offset + memory_size]
+        return cls(memory, data[offset + memory_size :], shutdown)
+
+
+class Checkpoints:
+    """
+    Ring buffer of the last snapshots of a machine, taken every interval
+    instructions when it is given to M99.run.
+    The input and output channels are not part of the snapshots, a run
+    resumed from a checkpoint must be given the values that were not read yet.
+    """
+
+    def __init__(self, interval: int = 10000, size: int = 16, path: str = None) -> None:
+        """
+        Args:
+            interval (int): number of instructions between two checkpoints.
+            size (int): number of checkpoints kept.
+            path (str): file rewritten with the latest checkpoint, so that the
+                run can be resumed after a crash with load.
+        """
+        self.interval = interval
+        self.path = path
+        self.ring = deque(maxlen=size)
+        self.steps = 0
+
+    def take(self, machine: "M99") -> None:
+        """
+        Add a snapshot of the machine to the ring.
+        """
+        snapshot = machine.snapshot()
+        self.ring.append((self.steps, snapshot))
+        if self.path is None:
+            return
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        (fd, temporary) = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(struct.pack("<Q", self.steps) + snapshot.pack())
+            os.replace(temporary, self.path)
+        except OSError:
+            os.remove(temporary)
+            raise
+
+    @staticmethod
+    def load(path: str) -> tuple[int, Snapshot]:
+        """
+        Read the checkpoint written by a previous run.
+
+        Args:
+            path (str): file given as path to the previous run.
+
+        Returns:
+            tuple[int, Snapshot]: number of instructions executed before the
+                checkpoint and the snapshot.
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) < 8:
+            raise ValueError("Invalid snapshot.")
+        return (struct.unpack_from("<Q", data)[0], Snapshot.unpack(data[8:]))
+
+    def latest(self) -> tuple[int, Snapshot]:
+        """
+        Give the latest checkpoint.
+
+        Returns:
+            tuple[int, Snapshot]: number of instructions executed before the
+                checkpoint and the snapshot, None if there is none.
+        """
+        return self.ring[-1] if self.ring else None
+
+    def run(
+        self,
+        machine: "M99",
+        engine: str,
+        profiler=None,
+        max_steps: int = None,
+        tracer=None,
+        loop_detector: "LoopDetector" = None,
+        memoizer=None,
+    ) -> int:
+        """
+        Run the machine, taking a checkpoint before every interval instructions.
+
+        Returns:
+            int: number of executed instructions.
+        """
+        executed = 0
+        while not machine._shutdown and machine.stopped is None and (max_steps is None or executed < max_steps):
+            # Runs may be resumed in chunks shorter than the interval
+            if not self.ring or self.steps - self.ring[-1][0] >= self.interval:
+                self.take(machine)
+            limit = self.interval - (self.steps - self.ring[-1][0])
+            if max_steps is not None:
+                limit = min(limit, max_steps - executed)
+            steps = machine.run(
+                engine=engine,
+                profiler=profiler,
+                max_steps=limit,
+                tracer=tracer,
+                loop_detector=loop_detector,
+                memoizer=memoizer,
+            )
+            executed += steps
+            self.steps += steps
+        return executed
+
+
+class History:
+    """
+    Record the execution of a machine so that it can be stepped backward.
+    Instructions executed with step are recorded in a bounded undo log holding
+    the registers, the memory cell the instruction may write and its old
+    value, so stepping back over them restores them directly. Runs take
+    checkpoints instead: stepping back into a run restores the closest
+    checkpoint and executes the instructions again up to the wanted one.
+    The values read by the machine are recorded so that they are read again
+    instead of being asked when instructions are executed again.
+    """
+
+    def __init__(self, machine: "M99", size: int = 100000, interval: int = 10000, checkpoints: int = 16) -> None:
+        """
+        Args:
+            machine (M99): machine to be recorded, its read_value must not be
+                replaced afterwards.
+            size (int): maximum number of entries of the undo log.
+            interval (int): number of instructions between two checkpoints.
+            checkpoints (int): number of checkpoints kept.
+        """
+        self.machine = machine
+        self.size = size
+        self.checkpoints = Checkpoints(interval, checkpoints)
+        self._read_value = machine.read_value
+        machine.read_value = self.read_value
+        self.clear()
+
+    def clear(self) -> None:
+        """
+        Forget the recorded execution, the current state becoming the oldest
+        one that can be reached.
+        """
+        self.steps = 0
+        self.undo = deque(maxlen=self.size)
+        self.inputs = deque()
+        self.replay = []
+        self._running = False
+        self.checkpoints.ring.clear()
+        self.checkpoints.steps = 0
+
+    def read_value(self) -> int:
+        if self.replay:
+            value = self.replay.pop()
+        else:
+            value = self._read_value()
+        # Forget the values read before the oldest state that can be restored
+        oldest = [entries[0][0] for entries in (self.undo, self.checkpoints.ring) if entries]
+        while self.inputs and self.inputs[0][0] < min(oldest, default=self.steps):
+            self.inputs.popleft()
+        # During a run only the start of the current chunk is known, which is
+        # enough since checkpoints are taken at the start of chunks
+        self.inputs.append((self.checkpoints.steps if self._running else self.steps, value))
+        return value
+
+    def step(self) -> None:
+        """
+        Execute the next instruction of the machine, recording how to undo it.
+        """
+        machine = self.machine
+        if machine._shutdown:
+            return
+
+        reg = machine.reg
+        # machine.step fails itself when the PC is out of the memory
+        opcode = machine.mem[reg[3]] if -99 <= reg[3] < 99 else -1
+        # STR and PSH are the only instructions writing in the memory
+        address = None
+        if 0 <= opcode <= 98:
+            address = opcode
+        elif 480 <= opcode <= 485 and 0 <= reg[4] <= 98:
+            address = reg[4]
+
+        entry = (self.steps, tuple(reg), address, None if address is None else machine.mem[address])
+        try:
+            machine.step()
+        finally:
+            self.undo.append(entry)
+            self.steps += 1
+
+    def run(self, engine: str = "decoded", max_steps: int = None) -> int:
+        """
+        Run the machine, taking checkpoints instead of recording each
+        instruction.
+
+        Returns:
+            int: number of executed instructions.
+        """
+        self.checkpoints.steps = self.steps
+        self._running = True
+        try:
+            executed = self.machine.run(engine=engine, max_steps=max_steps, checkpoints=self.checkpoints)
+        except (ValueError, IndexError):
+            self._running = False
+            # Execute the instructions run before the error again from the last
+            # checkpoint to record them, the stats counting them exactly
+            try:
+                self.replay_to(self.steps + self.machine.stats.steps)
+            except (ValueError, IndexError):
+                pass
+            raise
+        finally:
+            self._running = False
+        self.steps = self.checkpoints.steps
+        return executed
+
+    def step_back(self) -> bool:
+        """
+        Go back to the state before the last executed instruction.
+
+        Returns:
+            bool: False if the history does not go back that far.
+        """
+        if not self.steps:
+            return False
+
+        machine = self.machine
+        target = self.steps - 1
+        if self.undo and self.undo[-1][0] == target:
+            (_, reg, address, value) = self.undo.pop()
+            ring = self.checkpoints.ring
+            while ring and ring[-1][0] > target:
+                ring.pop()
+            machine.reg = list(reg)
+            machine._shutdown = False
+            if address is not None and machine.mem[address] != value:
+                machine.mem[address] = value
+                machine._code = None
+                machine._blocks = None
+            self.unread(target)
+            self.steps = target
+            machine.emit_update_event()
+            return True
+
+        return self.replay_to(target)
+
+    def unread(self, step: int) -> None:
+        """
+        Give back the values read since the given instruction, so that they are
+        read again.
+        """
+        while self.inputs and self.inputs[-1][0] >= step:
+            self.replay.append(self.inputs.pop()[1])
+
+    def replay_to(self, target: int) -> bool:
+        """
+        Restore the last checkpoint taken before the target instruction and
+        execute the instructions up to it again, without emitting the values
+        written by the machine. The errors raised by the instructions are
+        propagated.
+
+        Returns:
+            bool: False if there is no such checkpoint.
+        """
+        ring = self.checkpoints.ring
+        while ring and ring[-1][0] > target:
+            ring.pop()
+        if not ring:
+            return False
+
+        (steps, snapshot) = ring[-1]
+        self.unread(steps)
+        # The undo entries after the checkpoint are recorded again
+        while self.undo and self.undo[-1][0] >= steps:
+            self.undo.pop()
+        self.machine.restore(snapshot)
+        self.steps = steps
+        self.forward(target)
+        return True
+
+    def forward(self, target: int, errors: bool = True) -> None:
+        """
+        Execute the instructions up to the target one again, without emitting
+        the values written by the machine.
+
+        Args:
+            target (int): number of the instruction to stop at.
+            errors (bool): propagate the errors raised by the instructions,
+                otherwise they are ignored.
+        """
+        machine = self.machine
+        write_value = machine.write_value
+        update_event = machine.update_event
+        machine.write_value = lambda _: None
+        machine.update_event = None
+        try:
+            # step does nothing once the machine is shut down
+            while self.steps < target and not machine._shutdown:
+                try:
+                    self.step()
+                except (ValueError, IndexError):
+                    if errors:
+                        raise
+        finally:
+            machine.write_value = write_value
+            machine.update_event = update_event
+        machine.emit_update_event()
+
+    def back_to(self, address: int, limit: int = None) -> bool:
+        """
+        Step back until the PC reaches the given address. If it is not
+        reached, the machine is left in its current state.
+
+        Args:
+            address (int): address of the instruction to go back to.
+            limit (int): maximum number of instructions to go back.
+
+        Returns:
+            bool: False if the address was not reached.
+        """
+        update_event = self.machine.update_event
+        self.machine.update_event = None
+        steps = self.steps
+        try:
+            while limit is None or steps - self.steps < limit:
+                if not self.step_back():
+                    break
+                if self.machine.reg[3] == address:
+                    return True
+        finally:
+            self.machine.update_event = update_event
+        # The undo log and the values read allow to go forward again
+        self.forward(steps, errors=False)
+        return False
+
+
+class InfiniteLoop(ValueError):
+    """
+    Raised by LoopDetector when the state of the machine repeats, the program
+    never shutting down.
+    """
+
+    def __init__(self, start: int, end: int, length: int) -> None:
+        """
+        Args:
+            start (int): lowest address executed by the cycle.
+            end (int): highest address executed by the cycle.
+            length (int): number of instructions of the cycle.
+        """
+        super().__init__(f"Infinite loop between {start} and {end}.")
+        self.start = start
+        self.end = end
+        self.length = length
+
+
+class LoopDetector:
+    """
+    Detect the programs that never shut down, by finding a state of the
+    machine (registers and memory) repeated without reading a value in
+    between. The state is compared at the loop-back edges only, the
+    instructions going to an address lower or equal to their own, with
+    Brent's cycle detection: a single state is kept and replaced after a
+    doubling number of edges, so the cycle is found within about twice the
+    number of instructions executed before its end.
+    The memory is compared through a hash updated by each write, the full
+    state only being compared when the hashes match. Like M99_profile.Profiler,
+    the detector is given to M99.run which delegates the whole run to it.
+    """
+
+    def __init__(self) -> None:
+        self.machine = None
+        self.steps = 0
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forget the kept state, after a value was read or the machine changed.
+        """
+        self._saved = None
+        self._power = 1
+        self._edges = 0
+        self._end = None
+
+    def run(self, machine: "M99", max_steps: int = None) -> int:
+        """
+        Run the program loaded into the machine, raising InfiniteLoop if it
+        goes through a state seen before. The detection goes on over the runs
+        resumed from the state where the previous one stopped.
+
+        Args:
+            machine (M99): machine to be run.
+            max_steps (int): maximum number of instructions to execute.
+
+        Returns:
+            int: number of executed instructions.
+        """
+        if machine is not self.machine or self._end != (machine.mem, machine.reg):
+            self.machine = machine
+            self.reset()
+        machine._code = None
+        steps = 0
+        if machine._shutdown or steps == max_steps:
+            return steps
+
+        mem = machine.mem
+        memory_hash = sum(key * value for key, value in zip(LOOP_HASH_KEYS, mem)) & LOOP_HASH_MASK
+        # Reading a value makes the next states depend on the input
+        read = [False]
+        read_value = machine.read_value
+
+        def watched_read() -> int:
+            read[0] = True
+            return read_value()
+
+        machine.read_value = watched_read
+        try:
+            while True:
+                code = machine._code
+                if code is None:
+                    code = machine._code = [M99.decode(opcode) for opcode in mem]
+
+                reg = machine.reg
+                pc = reg[3]
+                handler, data = code[pc]
+                # STR and PSH are the only instructions writing in the memory
+                cell = None
+                if handler is M99._op_str:
+                    cell = data
+                elif handler is M99._op_psh and 0 < reg[4] < 99:
+                    cell = reg[4]
+                if cell is not None:
+                    old = mem[cell]
+                handler(machine, data)
+                if cell is not None and mem[cell] != old:
+                    memory_hash = (memory_hash + LOOP_HASH_KEYS[cell] * (mem[cell] - old)) & LOOP_HASH_MASK
+
+                reg = machine.reg
+                reg[3] += 1
+                if reg[3] >= 99:
+                    machine._shutdown = True
+
+                if machine.update_event:
+                    machine.update_event()
+
+                steps += 1
+                self.steps += 1
+                if machine._shutdown or steps == max_steps:
+                    if read[0]:
+                        # The resumed run must not match the states before the read
+                        self.reset()
+                    return steps
+
+                if read[0]:
+                    read[0] = False
+                    self.reset()
+                elif reg[3] <= pc:
+                    self._edge(machine, memory_hash)
+        finally:
+            machine.read_value = read_value
+            self._end = (machine.mem[:], list(machine.reg))
+            machine._steps += steps
+
+    def _edge(self, machine: "M99", memory_hash: int) -> None:
+        """
+        Compare the state at a loop-back edge with the kept one.
+        """
+        saved = self._saved
+        if saved is not None:
+            self._edges += 1
+            if memory_hash == saved[0] and machine.reg == saved[1] and machine.mem == saved[2]:
+                length = self.steps - saved[3]
+                (start, end) = LoopDetector.cycle_range(machine, length)
+                raise InfiniteLoop(start, end, length)
+            if self._edges != self._power:
+                return
+            self._power *= 2
+            self._edges = 0
+        self._saved = (memory_hash, list(machine.reg), machine.mem[:], self.steps)
+
+    @staticmethod
+    def cycle_range(machine: "M99", length: int) -> tuple[int, int]:
+        """
+        Execute a cycle of the machine on a copy of it to find the addresses
+        it goes through.
+
+        Returns:
+            tuple[int, int]: lowest and highest addresses executed.
+        """
+        copy = M99()
+        copy.mem = machine.mem[:]
+        copy.reg = list(machine.reg)
+        copy.write_value = lambda _: None
+        addresses = set()
+        for _ in range(length):
+            addresses.add(copy.reg[3] % 99)
+            copy.step()
+        return (min(addresses), max(addresses))
+
+
+class _Stop(Exception):
+    """
+    Raised by the instrumented handlers to stop the decoded engine.
+    """
+
+
+# Names a condition of a breakpoint or a watchpoint can use, the registers in
+# the order of their ids then the memory
+CONDITION_NAMES = ("R", "A", "B", "PC", "SB", "RA", "mem")
+
+
+def parse_condition(expression: str) -> callable:
+    """
+    Compile the condition of a breakpoint or a watchpoint, a Python expression
+    using the registers R, A, B, PC, SB, RA and the memory mem.
+
+    Args:
+        expression (str): condition, for example "A > 10 and mem[40] == 0".
+
+    Raises:
+        ValueError: the condition is not valid Python or uses other names,
+            the returned function raising it too when the evaluation fails.
+
+    Returns:
+        callable: function of the machine evaluating the condition.
+    """
+    try:
+        code = compile(expression, "<condition>", "eval")
+    except SyntaxError:
+        raise ValueError(f"Invalid condition {expression}.")
+    unknown = set(code.co_names) - set(CONDITION_NAMES)
+    if unknown:
+        raise ValueError(f"Invalid condition {expression}: unknown name {', '.join(sorted(unknown))}.")
+
+    def condition(machine: "M99") -> bool:
+        names = dict(zip(CONDITION_NAMES, machine.reg))
+        names["mem"] = machine.mem
+        try:
+            return bool(eval(code, {"__builtins__": {}}, names))
+        except Exception as e:
+            # The handlers evaluating it only let the errors of the machine out
+            raise ValueError(f"Invalid condition: {e}")
+
+    return condition
+
 
 class M99:
+    # Many paused machines can be kept in a process, so the instances have no
+    # __dict__ and the memory is an array of int16, which takes a third of the
+    # room of a list and is indexed about as fast by the engines since they
+    # mostly go through the decoded table and the registers. The registers stay
+    # a list, R holding the results of MUL before their overflow is handled.
+    __slots__ = (
+        "update_event",
+        "mem",
+        "reg",
+        "read_value",
+        "write_value",
+        "_shutdown",
+        "_code",
+        "_fused_extra",
+        "_blocks",
+        "_block_ends",
+        "_cover",
+        "_blocks_mem",
+        "_seen_mem",
+        "_seen_reg",
+        "breakpoints",
+        "watchpoints",
+        "stopped",
+        "_resume",
+        "stats",
+        "_steps",
+        "_inputs",
+        "_outputs",
+        "_lowest_sb",
+        "_static",
+    )
+
     def __init__(self) -> None:
         self.update_event = None
-        self.mem = [0] * 99
-        self.read_value = M99.read_value
-        self.write_value = M99.write_value
+        self.mem = array("h", EMPTY_MEMORY)
+        self.reg = list(INITIAL_REGISTERS)
+        self.read_value = prompt_input
+        self.write_value = print_output
+        self._code = None
+        self._fused_extra = 0
+        self._blocks = None
+        self._seen_mem = None
+        self._seen_reg = None
+        self.breakpoints = {}
+        self.watchpoints = {}
+        self.stopped = None
+        self._resume = None
+        self.stats = None
+        # Instructions executed by the engines, read by run for the stats
+        self._steps = 0
+        self._inputs = 0
+        self._outputs = 0
+        self._lowest_sb = 98
+        self._static = False
         self.restart()
 
     def restart(self) -> None:
-        self.reg = [
-            0,  # R
-            0,  # A
-            0,  # B
-            0,  # PC
-            98,  # SB
-            0,  # RA
-        ]
+        self.reg[:] = INITIAL_REGISTERS
         self._shutdown = False
+        if self._static:
+            # The memory may have been modified by the previous run, and the
+            # blocks compiled for the program do not check their stores
+            self._static = False
+            self._blocks = None
         self.emit_update_event()
 
     def shutdown(self) -> None:
@@ -67,34 +912,6 @@ class M99:
         """
         self.update_event = callback
 
-    @staticmethod
-    def read_value() -> int:
-        """
-        Read a value from the standard input.
-
-        Returns:
-            int: value read from the standard input.
-        """
-        print("Enter a value: ", end="")
-        valid = False
-        while not valid:
-            value = input()
-            if value.isnumeric():
-                valid = True
-            else:
-                print("Invalid input. Enter a value: ", end="")
-        return int(value)
-
-    @staticmethod
-    def write_value(value: int) -> None:
-        """
-        Write a value to the standard output.
-
-        Args:
-            value (int): value to be written to the standard output.
-        """
-        print(value)
-
     @staticmethod
     def reg_to_id(reg: str) -> int:
         """
@@ -153,7 +970,8 @@ class M99:
     def manage_overflow(value: int) -> int:
         """
         Make sure the given value is not greater than 999 and not less than -999
-        by cycling it.
+        by cycling it. Cycling by 1999 gives the only value of the range
+        congruent to it modulo 1999, computed in constant time.
 
         Args:
             value (int): value to be managed.
@@ -161,13 +979,9 @@ class M99:
         Returns:
             int: managed value.
         """
-        while value > 999:
-            value -= 1999
-
-        while value < -999:
-            value += 1999
-
-        return value
+        if -999 <= value <= 999:
+            return value
+        return (value + 999) % 1999 - 999
 
     def exec_reg_op(self, opcode: int) -> None:
         match opcode:
@@ -201,6 +1015,8 @@ class M99:
                 raise ValueError("Stack overflow")
             self[self.reg[4]] = self.reg[reg]
             self.reg[4] -= 1
+            if self.reg[4] < self._lowest_sb:
+                self._lowest_sb = self.reg[4]
         elif stack_op == 9:
             if self.reg[4] >= 98:
                 raise ValueError("Stack is empty.")
@@ -251,25 +1067,231 @@ class M99:
             case _:  # Not a valid identifier
                 raise ValueError("Invalid identifier.")
 
-    def load(self, program: list[int], offset: int = 0) -> None:
+    @staticmethod
+    def decode(opcode: int) -> tuple[callable, object]:
+        """
+        Decode the given opcode into a handler of the decoded engine and its operand.
+        Opcodes without a dedicated handler (invalid identifiers, register ids
+        greater than 5...) are decoded to the reference interpreter so that they
+        fail exactly like they do with step.
+
+        Args:
+            opcode (int): opcode to be decoded.
+
+        Returns:
+            tuple[callable, object]: handler and the operand it must be called with.
+        """
+        if opcode > 999 or opcode < 0:
+            return (M99._op_exec, opcode)
+
+        data = opcode % 100
+        match opcode // 100:
+            case 0:  # STR
+                if data == 99:
+                    return (M99._op_out, None)
+                return (M99._op_str, data)
+            case 1:  # LDA
+                if data == 99:
+                    return (M99._op_in_a, None)
+                return (M99._op_lda, data)
+            case 2:  # LDB
+                if data == 99:
+                    return (M99._op_in_b, None)
+                return (M99._op_ldb, data)
+            case 3:  # MOV
+                if data // 10 > 5 or data % 10 > 5:
+                    return (M99._op_exec, opcode)
+                return (M99._op_mov, (data // 10, data % 10))
+            case 4:  # ADD, SUB, MUL, PSH, POP, RET...
+                if data == 0:
+                    return (M99._op_add, None)
+                if data == 1:
+                    return (M99._op_sub, None)
+                if data == 2:
+                    return (M99._op_mul, None)
+                if data == 9:
+                    return (M99._op_ret, None)
+                if 80 <= data <= 85:
+                    return (M99._op_psh, data % 10)
+                if 90 <= data <= 95:
+                    return (M99._op_pop, data % 10)
+                return (M99._op_exec, opcode)
+            case 5:  # JMP
+                return (M99._op_jmp, data - 1)
+            case 6:  # JPP
+                return (M99._op_jpp, data - 1)
+            case 7:  # JEQ
+                return (M99._op_jeq, data)
+            case 8:  # JNE
+                return (M99._op_jne, data)
+            case 9:  # CAL
+                return (M99._op_cal, data - 1)
+
+    def _op_exec(self, opcode: int) -> None:
+        self.__exec(opcode)
+
+    def _op_str(self, address: int) -> None:
+        value = self.reg[0]
+        if value > 999 or value < -999:
+            value = M99.manage_overflow(value)
+        self.mem[address] = value
+        self._code[address] = M99.decode(value)
+
+    def _op_out(self, _) -> None:
+        self[99] = self.reg[0]
+
+    def _op_lda(self, address: int) -> None:
+        self.reg[1] = self.mem[address]
+
+    def _op_ldb(self, address: int) -> None:
+        self.reg[2] = self.mem[address]
+
+    def _op_in_a(self, _) -> None:
+        self.reg[1] = self[99]
+
+    def _op_in_b(self, _) -> None:
+        self.reg[2] = self[99]
+
+    def _op_mov(self, regs: tuple[int, int]) -> None:
+        reg = self.reg
+        reg[regs[1]] = reg[regs[0]]
+
+    def _op_add(self, _) -> None:
+        reg = self.reg
+        value = reg[1] + reg[2]
+        if value > 999 or value < -999:
+            value = M99.manage_overflow(value)
+        reg[0] = value
+
+    def _op_sub(self, _) -> None:
+        reg = self.reg
+        value = reg[1] - reg[2]
+        if value > 999 or value < -999:
+            value = M99.manage_overflow(value)
+        reg[0] = value
+
+    def _op_mul(self, _) -> None:
+        reg = self.reg
+        value = reg[1] * reg[2]
+        if value > 999 or value < -999:
+            value = M99.manage_overflow(value)
+        reg[0] = value
+
+    def _op_ret(self, _) -> None:
+        reg = self.reg
+        reg[3] = reg[5] - 1
+        if reg[0] > 999 or reg[0] < -999:
+            reg[0] = M99.manage_overflow(reg[0])
+
+    def _op_psh(self, source: int) -> None:
+        reg = self.reg
+        address = reg[4]
+        if address <= 0:
+            raise ValueError("Stack overflow")
+        if address < 99:
+            value = reg[source]
+            if value > 999 or value < -999:
+                value = M99.manage_overflow(value)
+            self.mem[address] = value
+            self._code[address] = M99.decode(value)
+        else:
+            self[address] = reg[source]
+        reg = self.reg
+        reg[4] -= 1
+        if reg[4] < self._lowest_sb:
+            self._lowest_sb = reg[4]
+        if reg[0] > 999 or reg[0] < -999:
+            reg[0] = M99.manage_overflow(reg[0])
+
+    def _op_pop(self, target: int) -> None:
+        reg = self.reg
+        address = reg[4]
+        if address >= 98:
+            raise ValueError("Stack is empty.")
+        address += 1
+        reg[4] = address
+        reg[target] = self.mem[address] if address >= 0 else self[address]
+        if reg[0] > 999 or reg[0] < -999:
+            reg[0] = M99.manage_overflow(reg[0])
+
+    def _op_jmp(self, target: int) -> None:
+        self.reg[3] = target
+
+    def _op_jpp(self, target: int) -> None:
+        if self.reg[0] > 0:
+            self.reg[3] = target
+
+    def _op_jeq(self, value: int) -> None:
+        if self.reg[0] == value:
+            self.reg[3] += 1
+
+    def _op_jne(self, value: int) -> None:
+        if self.reg[0] != value:
+            self.reg[3] += 1
+
+    def _op_cal(self, target: int) -> None:
+        reg = self.reg
+        reg[5] = reg[3] + 1
+        reg[3] = target
+
+    def _op_break(self, entry: tuple) -> None:
+        ((handler, data), address, condition) = entry
+        if self._resume == address:
+            self._resume = None
+        elif condition is None or condition(self):
+            self.stopped = ("breakpoint", address)
+            raise _Stop()
+        handler(self, data)
+
+    def _op_watch(self, entry: tuple) -> None:
+        ((handler, data), targets) = entry
+        values = [self._watched(target) for target in targets]
+        handler(self, data)
+        for target, old in zip(targets, values):
+            new = self._watched(target)
+            condition = self.watchpoints[target]
+            if new != old and (condition is None or condition(self)):
+                self.stopped = ("watchpoint", target, old, new)
+                raise _Stop()
+
+    def _op_store(self, entry: tuple) -> None:
+        # The store decodes the written cell again, instrument it again
+        (handler, data) = entry
+        address = data if handler is M99._op_str else self.reg[4]
+        handler(self, data)
+        if 0 <= address < 99:
+            self._code[address] = self._instrument(address, self._code[address])
+
+    def load(self, program: list[int], offset: int = 0, static: bool = False) -> None:
         """
         Load a program into the M99 machine.
 
         Args:
             program (list[int]): program to be loaded into the M99 machine.
             offset (int): base memory address to load the program into.
+            static (bool): the program is known never to execute a cell it
+                writes when run from this state, see M99_analysis. The engines
+                then skip decoding again or invalidating the cells written,
+                until the machine is restarted or its memory replaced.
         """
 
         if len(program) + offset > 98:
             raise ValueError("Program too long.")
 
-        self.mem[offset : len(program) + offset] = program
+        # The values are stored like the ones written by the program
+        self.mem[offset : len(program) + offset] = array("h", [M99.manage_overflow(value) for value in program])
+        self._code = None
+        self._blocks = None
+        self._static = static
 
     def clear(self) -> None:
         """
         Clear the memory of the M99 machine.
         """
-        self.mem = [0] * 99
+        self.mem[:] = EMPTY_MEMORY
+        self._code = None
+        self._blocks = None
+        self._static = False
         self.emit_update_event()
 
     def __getitem__(self, key: int) -> int:
@@ -291,6 +1313,7 @@ class M99:
             if value is None:
                 self.shutdown()
                 raise ValueError("Invalid input.")
+            self._inputs += 1
             return M99.manage_overflow(value)
 
         return self.mem[key]
@@ -311,6 +1334,7 @@ class M99:
 
         if key == 99:
             self.write_value(value)
+            self._outputs += 1
             return
 
         self.mem[key] = value
@@ -322,7 +1346,11 @@ class M99:
         if self._shutdown:
             return
 
-        self.__exec(self.mem[self.reg[3]])
+        pc = self.reg[3]
+        if pc >= 99 or pc < -99:
+            # Fail like the engines fetching from their decoded table, a list
+            raise IndexError("list index out of range")
+        self.__exec(self.mem[pc])
 
         self.reg[3] += 1
         if self.reg[3] >= 99:
@@ -330,73 +1358,1040 @@ class M99:
 
         self.emit_update_event()
 
+    def changes(self) -> tuple[list[int], list[int]]:
+        """
+        Give the memory cells and the registers whose value changed since the
+        last call. The first call reports every cell and register.
+        The machine is compared to a copy taken at the previous call, so
+        nothing is recorded while it runs and every engine is supported.
+
+        Returns:
+            tuple[list[int], list[int]]: addresses of the changed cells and ids
+                of the changed registers.
+        """
+        mem = self.mem
+        reg = self.reg
+        seen_mem = self._seen_mem
+        seen_reg = self._seen_reg
+        if seen_mem is None:
+            cells = list(range(99))
+            registers = list(range(6))
+        else:
+            cells = [] if mem == seen_mem else [i for i in range(99) if mem[i] != seen_mem[i]]
+            registers = [] if reg == seen_reg else [i for i in range(6) if reg[i] != seen_reg[i]]
+
+        self._seen_mem = mem[:]
+        self._seen_reg = reg.copy()
+        return (cells, registers)
+
     def emit_update_event(self) -> None:
         if self.update_event:
             self.update_event()
 
-    def run(self, offset: int = 0) -> None:
+    def snapshot(self) -> Snapshot:
+        """
+        Take a snapshot of the memory, the registers and the shutdown state.
+
+        Returns:
+            Snapshot: the snapshot.
+        """
+        return Snapshot(Snapshot.pack_values(self.mem), Snapshot.pack_values(self.reg), self._shutdown)
+
+    def restore(self, snapshot: Snapshot) -> None:
+        """
+        Restore the state of the machine from a snapshot.
+
+        Args:
+            snapshot (Snapshot): snapshot taken with snapshot.
+        """
+        self.mem[:] = array("h", Snapshot.unpack_values(snapshot.memory, 99))
+        self.reg[:] = Snapshot.unpack_values(snapshot.registers, 6)
+        self._shutdown = snapshot.shutdown
+        self._code = None
+        self._blocks = None
+        self._static = False
+        self.emit_update_event()
+
+    def add_breakpoint(self, address: int, condition: callable = None) -> None:
+        """
+        Stop the runs before executing the instruction at the given address.
+        Breakpoints are implemented by instrumenting the handler of the address
+        in the decoded engine, so the other instructions run at full speed.
+
+        Args:
+            address (int): address of the instruction.
+            condition (callable): only stop if condition(machine) is true.
+        """
+        if not 0 <= address <= 98:
+            raise ValueError("Invalid address.")
+        self.breakpoints[address] = condition
+        self._code = None
+
+    def remove_breakpoint(self, address: int) -> None:
+        self.breakpoints.pop(address, None)
+        self._code = None
+
+    def add_watchpoint(self, target, condition: callable = None) -> None:
+        """
+        Stop the runs after an instruction changing a memory cell or a
+        register. Only the handlers of the instructions that can write it are
+        instrumented.
+
+        Args:
+            target (int | str): address of the memory cell or name of the
+                register, one of WATCH_REGISTERS.
+            condition (callable): only stop if condition(machine) is true, it
+                is called with the PC still on the instruction.
+        """
+        if target == "PC":
+            raise ValueError("The PC can not be watched, use a breakpoint.")
+        if target not in WATCH_REGISTERS and not (isinstance(target, int) and 0 <= target <= 98):
+            raise ValueError("Invalid watchpoint.")
+        self.watchpoints[target] = condition
+        self._code = None
+
+    def remove_watchpoint(self, target) -> None:
+        self.watchpoints.pop(target, None)
+        self._code = None
+
+    def _watched(self, target) -> int:
+        if isinstance(target, str):
+            return self.reg[M99.reg_to_id(target)]
+        return self.mem[target]
+
+    @staticmethod
+    def _may_write(handler: callable, data: object, target) -> bool:
+        """
+        Tell whether a decoded instruction can change a watched memory cell or
+        register.
+        """
+        if handler is M99._op_exec:
+            return True
+        if isinstance(target, int):
+            return (handler is M99._op_str and data == target) or handler is M99._op_psh
+
+        register = M99.reg_to_id(target)
+        if handler is M99._op_mov:
+            return data[1] == register
+        if handler is M99._op_pop:
+            return register in (0, 4, data)
+        writes = {
+            M99._op_lda: (1,),
+            M99._op_in_a: (1,),
+            M99._op_ldb: (2,),
+            M99._op_in_b: (2,),
+            M99._op_add: (0,),
+            M99._op_sub: (0,),
+            M99._op_mul: (0,),
+            M99._op_ret: (0,),
+            M99._op_psh: (0, 4),
+            M99._op_cal: (5,),
+        }
+        return register in writes.get(handler, ())
+
+    def _instrument(self, address: int, entry: tuple) -> tuple:
+        """
+        Wrap the decoded instruction at an address into the handlers checking
+        the breakpoints and watchpoints it is concerned by.
+        """
+        (handler, data) = entry
+        if handler is M99._op_str or handler is M99._op_psh:
+            entry = (M99._op_store, entry)
+        targets = [target for target in self.watchpoints if M99._may_write(handler, data, target)]
+        if targets:
+            entry = (M99._op_watch, (entry, targets))
+        if address in self.breakpoints:
+            entry = (M99._op_break, (entry, address, self.breakpoints[address]))
+        return entry
+
+    def run(
+        self,
+        offset: int = 0,
+        engine: str = "step",
+        profiler=None,
+        max_steps: int = None,
+        checkpoints: Checkpoints = None,
+        tracer=None,
+        loop_detector: LoopDetector = None,
+        timeout: float = None,
+        memoizer=None,
+    ) -> int:
         """
         Run the program loaded into the M99 machine.
 
         Args:
             offset (int): base memory address to start the program from.
+            engine (str): execution engine to use, one of ENGINES.
+            profiler (M99_profile.Profiler): profiler recording the run, the
+                engine is then ignored and the whole run is delegated to it.
+            max_steps (int): stop after this number of instructions even if the
+                machine is not shut down, the run can then be resumed by
+                calling run again. The compiled engine only stops at the end of
+                a block and can execute a few more instructions.
+            checkpoints (Checkpoints): ring receiving a snapshot of the
+                machine every checkpoints.interval instructions.
+            tracer (M99_trace.Tracer): tracer writing a record for each
+                executed instruction, the run is then delegated to it like to
+                a profiler.
+            loop_detector (LoopDetector): detector raising InfiniteLoop when
+                the program goes through a state seen before, the run is then
+                delegated to it like to a profiler.
+            timeout (float): stop after this number of seconds even if the
+                machine is not shut down, like max_steps. The time is checked
+                between slices of instructions lasting about TIMEOUT_SLICE
+                seconds, so the run can last a bit longer.
+            memoizer (M99_memo.Memoizer): memoizer replaying the calls of
+                subroutines made again with the same inputs, the run is then
+                delegated to it like to a profiler.
+
+        While breakpoints or watchpoints are set, the decoded engine is used
+        whatever the given engine and the run stops when one of them triggers,
+        stopped then telling why. Profiled, traced, loop detecting and
+        memoized runs ignore them.
+
+        The resources used by the run are then given by stats.
+
+        Returns:
+            int: number of executed instructions.
         """
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine}.")
+
         if offset > 0:
             self.reg[3] = offset
 
-        while not self._shutdown:
-            self.step()
+        # Resuming a run stopped by a breakpoint executes its instruction
+        if self.stopped is not None and self.stopped[0] == "breakpoint" and self.stopped[1] == self.reg[3]:
+            self._resume = self.reg[3]
+        self.stopped = None
+        if self.breakpoints or self.watchpoints:
+            engine = "decoded"
+
+        # Runs can be nested by the checkpoints, the counters are only read
+        # and the lowest SB is kept for the outer run
+        start = time.perf_counter()
+        (executed, inputs, outputs, lowest_sb) = (self._steps, self._inputs, self._outputs, self._lowest_sb)
+        self._lowest_sb = self.reg[4]
+        try:
+            if timeout is None:
+                steps = self._run(engine, profiler, max_steps, checkpoints, tracer, loop_detector, memoizer)
+            else:
+                steps = self._run_timed(
+                    engine, profiler, max_steps, checkpoints, tracer, loop_detector, memoizer, start + timeout
+                )
+        finally:
+            depth = 98 - self._lowest_sb
+            self._lowest_sb = min(self._lowest_sb, lowest_sb)
+            # Every run decodes the memory again, the table of the decoded
+            # engines would only take room in the paused machine
+            self._code = None
+            # The engines count the instructions executed before an error too
+            self.stats = RunStats(
+                self._steps - executed,
+                max(depth, 0),
+                self._inputs - inputs,
+                self._outputs - outputs,
+                time.perf_counter() - start,
+            )
+        return steps
+
+    def _run_timed(
+        self,
+        engine: str,
+        profiler,
+        max_steps: int,
+        checkpoints: Checkpoints,
+        tracer,
+        loop_detector: LoopDetector,
+        memoizer,
+        deadline: float,
+    ) -> int:
+        """
+        Run the program in slices of instructions until the deadline, as
+        given by time.perf_counter, is passed. The slices start small and
+        double until one lasts TIMEOUT_SLICE seconds, so that the time is
+        checked often with slow engines without slowing the fast ones down.
+        """
+        steps = 0
+        chunk = TIMEOUT_FIRST_CHUNK
+        while not self._shutdown and self.stopped is None and (max_steps is None or steps < max_steps):
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            limit = chunk if max_steps is None else min(chunk, max_steps - steps)
+            steps += self._run(engine, profiler, limit, checkpoints, tracer, loop_detector, memoizer)
+            if chunk < DECODED_CHUNK and time.perf_counter() - now < TIMEOUT_SLICE:
+                chunk *= 2
+        return steps
+
+    def _run(
+        self,
+        engine: str,
+        profiler,
+        max_steps: int,
+        checkpoints: Checkpoints,
+        tracer,
+        loop_detector: LoopDetector,
+        memoizer,
+    ) -> int:
+        """
+        Run the program with the given engine, or delegate the run.
+        """
+        if checkpoints is not None:
+            return checkpoints.run(self, engine, profiler, max_steps, tracer, loop_detector, memoizer)
+
+        if profiler is not None:
+            return profiler.run(self, max_steps)
+
+        if tracer is not None:
+            return tracer.run(self, max_steps)
+
+        if loop_detector is not None:
+            return loop_detector.run(self, max_steps)
+
+        if memoizer is not None:
+            return memoizer.run(self, max_steps)
+
+        if engine == "decoded":
+            return self._run_decoded(max_steps)
+
+        if engine == "compiled":
+            return self._run_compiled(max_steps)
+
+        if engine == "fused":
+            return self._run_fused(max_steps)
+
+        steps = 0
+        try:
+            while not self._shutdown and steps != max_steps:
+                self.step()
+                steps += 1
+        finally:
+            self._steps += steps
+        return steps
+
+    def _run_decoded(self, max_steps: int = None) -> int:
+        """
+        Run the program with the decoded engine.
+        The memory is decoded once into a table of (handler, operand) pairs and
+        only the cells overwritten by STR or PSH are decoded again. The table is
+        rebuilt when the memory is replaced by load or clear.
+        """
+        self._code = None
+        total = 0
+        while not self._shutdown and self.stopped is None and total != max_steps:
+            chunk = DECODED_CHUNK if max_steps is None else min(DECODED_CHUNK, max_steps - total)
+            total += self._run_decoded_chunk(chunk)
+        return total
+
+    def _run_decoded_chunk(self, limit: int) -> int:
+        """
+        Execute at most limit instructions with the decoded engine.
+        Iterating over a small range counts the instructions for free, and the
+        shutdown flag is tested at the end of the body rather than in the loop
+        condition, which is noticeably faster on CPython.
+
+        Returns:
+            int: number of executed instructions.
+        """
+        try:
+            for steps in range(1, limit + 1):
+                code = self._code
+                if code is None:
+                    code = self._code = self._decode_memory()
+
+                handler, data = code[self.reg[3]]
+                handler(self, data)
+
+                reg = self.reg
+                reg[3] += 1
+                if reg[3] >= 99:
+                    self._shutdown = True
+
+                if self.update_event:
+                    self.update_event()
+
+                if self._shutdown:
+                    break
+        except _Stop:
+            # Breakpoints stop before their instruction, watchpoints after it
+            if self.stopped[0] == "breakpoint":
+                steps -= 1
+            else:
+                reg = self.reg
+                reg[3] += 1
+                if reg[3] >= 99:
+                    self._shutdown = True
+                self.emit_update_event()
+        except BaseException:
+            # The instruction raising is not counted
+            self._steps += steps - 1
+            raise
+        self._steps += steps
+        return steps
+
+    def _decode_memory(self) -> list[tuple[callable, object]]:
+        """
+        Decode the memory for the decoded engine, the cells affected by the
+        breakpoints and watchpoints being decoded to instrumented handlers.
+        """
+        code = [M99.decode(opcode) for opcode in self.mem]
+        if self.breakpoints or self.watchpoints:
+            for address in range(99):
+                code[address] = self._instrument(address, code[address])
+        elif self._static:
+            for address, (handler, data) in enumerate(code):
+                if handler is M99._op_str:
+                    code[address] = (M99._static_str, data)
+                elif handler is M99._op_psh:
+                    code[address] = (M99._static_psh, data)
+        return code
+
+    def _run_fused(self, max_steps: int = None) -> int:
+        """
+        Run the program with the fused engine.
+        The decoded table goes through a peephole pass replacing the common
+        sequences of instructions by a single handler executing all of them,
+        see _fuse, and is then run by the loop of the decoded engine. The
+        sequences are fused at their first address only, so a jump into the
+        middle of one executes the following instructions one by one, and the
+        stores mark the sequences covering the cell they write to be fused
+        again. The update event is emitted once per fused sequence.
+        """
+        self._code = None
+        self._code = self._fuse_memory()
+        total = 0
+        while not self._shutdown and total != max_steps:
+            limit = DECODED_CHUNK if max_steps is None else min(DECODED_CHUNK, max_steps - total)
+            # A handler executes at most FUSION_LENGTH instructions, the last
+            # few ones are executed with step to stop exactly at max_steps
+            if limit < FUSION_LENGTH:
+                while not self._shutdown and total != max_steps:
+                    self.step()
+                    total += 1
+                    self._steps += 1
+                # step does not maintain the table
+                self._code = None
+                break
+            # The fused handlers count the instructions they execute besides
+            # the first one in _fused_extra
+            self._fused_extra = 0
+            try:
+                total += self._run_decoded_chunk(limit // FUSION_LENGTH)
+            finally:
+                total += self._fused_extra
+                self._steps += self._fused_extra
+        return total
+
+    def _fuse_memory(self) -> list[tuple[callable, object]]:
+        """
+        Decode the memory and fuse its sequences of instructions.
+        """
+        return [self._fuse(address) for address in range(99)]
+
+    def _fuse(self, address: int) -> tuple[callable, object]:
+        """
+        Give the entry of the fused table for an address.
+        Only the last instruction of a sequence can write the memory, so the
+        instructions of a sequence can not be modified while it runs.
+
+        Fused sequences:
+            - LDA x; LDB y; ADD, SUB or MUL; JPP z
+            - ADD, SUB or MUL; JPP z
+            - MOV r1 r2; JMP z, r2 not being PC
+            - POP r1; POP r2, r1 not being PC
+            - JEQ n or JNE n; JMP z
+            - LDA 99 or LDB 99; PSH r
+        """
+        code = [M99.decode(opcode) for opcode in self.mem[address : address + FUSION_LENGTH]]
+        (handler, data) = code[0]
+        following = [entry[0] for entry in code[1:]]
+        arithmetic = (M99._op_add, M99._op_sub, M99._op_mul)
+
+        if handler is M99._op_lda and following[:1] == [M99._op_ldb] and following[1:2] and following[1] in arithmetic and following[2:] == [M99._op_jpp]:
+            return (M99._fused_load_jpp, (data, code[1][1], arithmetic.index(following[1]), code[3][1]))
+        if handler in arithmetic and following[:1] == [M99._op_jpp]:
+            return (M99._fused_arithmetic_jpp, (arithmetic.index(handler), code[1][1]))
+        if handler is M99._op_mov and data[1] != 3 and following[:1] == [M99._op_jmp]:
+            return (M99._fused_mov_jmp, (data[0], data[1], code[1][1]))
+        if handler is M99._op_pop and data != 3 and following[:1] == [M99._op_pop]:
+            return (M99._fused_pop_pop, (data, code[1][1]))
+        if (handler is M99._op_jeq or handler is M99._op_jne) and following[:1] == [M99._op_jmp]:
+            return (M99._fused_skip_jmp, (handler is M99._op_jeq, data, code[1][1]))
+        if (handler is M99._op_in_a or handler is M99._op_in_b) and following[:1] == [M99._op_psh]:
+            return (M99._fused_in_psh, (handler, code[1][1]))
+
+        if handler is M99._op_str:
+            return (M99._static_str if self._static else M99._fused_str, data)
+        if handler is M99._op_psh:
+            return (M99._static_psh if self._static else M99._fused_psh, data)
+        return (handler, data)
+
+    def _refuse(self, address: int) -> None:
+        """
+        Mark the sequences which can contain a memory cell as stale after it
+        was written, they are fused again when they are reached. Only the cell
+        itself and the fused sequences starting in the cells before it can
+        change.
+        """
+        code = self._code
+        code[address] = FUSED_STALE
+        for start in FUSION_STARTS[address]:
+            if code[start][0] in FUSION_HANDLERS:
+                code[start] = FUSED_STALE
+
+    def _fused_stale(self, _) -> None:
+        # A negative PC indexes the memory from its end, like in the other engines
+        address = self.reg[3] % 99
+        entry = self._code[address] = self._fuse(address)
+        if entry[0] in FUSION_HANDLERS:
+            # The limit of the chunk was only checked for a single instruction
+            (handler, data) = M99.decode(self.mem[address])
+            handler(self, data)
+        else:
+            entry[0](self, entry[1])
+
+    def _fused_str(self, address: int) -> None:
+        value = self.reg[0]
+        if value > 999 or value < -999:
+            value = M99.manage_overflow(value)
+        # Writing the value a cell already holds does not change the program
+        if self.mem[address] != value:
+            self.mem[address] = value
+            self._refuse(address)
+
+    def _fused_psh(self, source: int) -> None:
+        reg = self.reg
+        address = reg[4]
+        if address <= 0 or address >= 99:
+            # Stack overflow or output
+            M99._op_psh(self, source)
+            return
+        value = reg[source]
+        if value > 999 or value < -999:
+            value = M99.manage_overflow(value)
+        if self.mem[address] != value:
+            self.mem[address] = value
+            self._refuse(address)
+        reg[4] = address - 1
+        if address <= self._lowest_sb:
+            self._lowest_sb = address - 1
+        if reg[0] > 999 or reg[0] < -999:
+            reg[0] = M99.manage_overflow(reg[0])
+
+    # The stores of the static programs never write a cell that is executed,
+    # the decoded and fused tables are left as they are
+
+    def _static_str(self, address: int) -> None:
+        value = self.reg[0]
+        if value > 999 or value < -999:
+            value = M99.manage_overflow(value)
+        self.mem[address] = value
+
+    def _static_psh(self, source: int) -> None:
+        reg = self.reg
+        address = reg[4]
+        if address <= 0 or address >= 99:
+            # Stack overflow or output
+            M99._op_psh(self, source)
+            return
+        value = reg[source]
+        if value > 999 or value < -999:
+            value = M99.manage_overflow(value)
+        self.mem[address] = value
+        reg[4] = address - 1
+        if address <= self._lowest_sb:
+            self._lowest_sb = address - 1
+        if reg[0] > 999 or reg[0] < -999:
+            reg[0] = M99.manage_overflow(reg[0])
+
+    def _fused_load_jpp(self, data: tuple) -> None:
+        (x, y, operation, target) = data
+        reg = self.reg
+        a = reg[1] = self.mem[x]
+        b = reg[2] = self.mem[y]
+        if operation == 1:
+            value = a - b
+        elif operation == 0:
+            value = a + b
+        else:
+            value = a * b
+        if value > 999 or value < -999:
+            value = M99.manage_overflow(value)
+        reg[0] = value
+        if value > 0:
+            reg[3] = target
+        else:
+            reg[3] += 3
+        self._fused_extra += 3
+
+    def _fused_arithmetic_jpp(self, data: tuple) -> None:
+        (operation, target) = data
+        reg = self.reg
+        if operation == 1:
+            value = reg[1] - reg[2]
+        elif operation == 0:
+            value = reg[1] + reg[2]
+        else:
+            value = reg[1] * reg[2]
+        if value > 999 or value < -999:
+            value = M99.manage_overflow(value)
+        reg[0] = value
+        if value > 0:
+            reg[3] = target
+        else:
+            reg[3] += 1
+        self._fused_extra += 1
+
+    def _fused_mov_jmp(self, data: tuple) -> None:
+        (source, destination, target) = data
+        reg = self.reg
+        reg[destination] = reg[source]
+        reg[3] = target
+        self._fused_extra += 1
+
+    def _fused_pop_pop(self, data: tuple) -> None:
+        # The second POP is executed with its own PC in case the first raises
+        M99._op_pop(self, data[0])
+        self.reg[3] += 1
+        self._fused_extra += 1
+        M99._op_pop(self, data[1])
+
+    def _fused_skip_jmp(self, data: tuple) -> None:
+        (equal, value, target) = data
+        reg = self.reg
+        if (reg[0] == value) == equal:
+            # The JMP is skipped
+            reg[3] += 1
+        else:
+            reg[3] = target
+            self._fused_extra += 1
+
+    def _fused_in_psh(self, data: tuple) -> None:
+        (handler, source) = data
+        handler(self, None)
+        self.reg[3] += 1
+        self._fused_extra += 1
+        M99._fused_psh(self, source)
+
+    def _run_compiled(self, max_steps: int = None) -> int:
+        """
+        Run the program with the compiled engine.
+        Each basic block is compiled into a Python function the first time it
+        is reached. Registers are kept in local variables and only written back
+        to self.reg when the block exits, so the update event is emitted once
+        per block instead of once per instruction. Instructions that can not be
+        compiled (I/O, invalid opcodes...) are executed with step.
+        """
+        # The blocks compiled by the previous run are kept if the memory was not
+        # modified since, which makes resuming a run stopped by max_steps cheap
+        if self._blocks is not None and self.mem != self._blocks_mem:
+            self._blocks = None
+        if self._shutdown:
+            return 0
+
+        limit = sys.maxsize if max_steps is None else max_steps
+        steps = 0
+        try:
+            while True:
+                blocks = self._blocks
+                if blocks is None:
+                    blocks = self._blocks = [None] * 99
+                    self._block_ends = {}
+                    self._cover = [0] * 99
+
+                pc = self.reg[3]
+                if 0 <= pc < 99:
+                    block = blocks[pc]
+                    if block is None:
+                        block = blocks[pc] = self._compile_block(pc)
+                else:
+                    # The PC went negative (RET or MOV into the PC), let the
+                    # reference interpreter fetch the cell and forget the blocks
+                    # since the instruction may write anywhere.
+                    block = False
+                    self._blocks = None
+
+                executed = block and block(self, self.reg, self.mem, self._cover)
+                if executed:
+                    steps += executed
+                    if self.reg[3] >= 99:
+                        self._shutdown = True
+                    if self.update_event:
+                        self.update_event()
+                else:
+                    self.step()
+                    steps += 1
+
+                if self._shutdown or steps >= limit:
+                    return steps
+        finally:
+            self._steps += steps
+            self._blocks_mem = self.mem[:]
+
+    def _compile_block(self, start: int) -> callable:
+        """
+        Compile the basic block starting at the given address.
+
+        The block ends after the first instruction transferring control (JMP,
+        JPP, JEQ, JNE, CAL, RET, MOV or POP into PC) or before the first
+        instruction that can not be compiled. The generated function returns
+        the number of instructions executed; it bails out before a stack
+        operation that would fail and exits right after a store landing in a
+        compiled block, which is then invalidated, unless the program is static.
+
+        Args:
+            start (int): address of the first instruction of the block.
+
+        Returns:
+            callable: compiled block, or False if the first instruction can not be compiled.
+        """
+        body = []
+        used = set()
+        written = set()
+        # True while R is known to be in [-999, 999]
+        r_safe = False
+        # SB relative to its value at the start of the block, or since the
+        # last MOV into SB, and its lowest value after a PSH. The lowest SB of
+        # the machine is only updated when the block exits
+        sb_offset = 0
+        sb_lowest = None
+
+        def checked(name: str) -> str:
+            return f"({name} if -999 <= {name} <= 999 else mo({name}))"
+
+        def lowest_sb(indent: str) -> None:
+            if sb_lowest is not None:
+                lowest = f"SB - {sb_offset - sb_lowest}" if sb_offset != sb_lowest else "SB"
+                body.append(f"{indent}if {lowest} < m._lowest_sb:")
+                body.append(f"{indent}    m._lowest_sb = {lowest}")
+
+        def leave(indent: str, pc: str, count: int, invalidate: str = None) -> None:
+            lowest_sb(indent)
+            body.append(f"{indent}@writeback")
+            body.append(f"{indent}reg[3] = {pc}")
+            if invalidate is not None:
+                body.append(f"{indent}m._invalidate_blocks({invalidate})")
+            body.append(f"{indent}return {count}")
+
+        address = start
+        count = 0
+        terminated = False
+        while address < 99 and not terminated:
+            opcode = self.mem[address]
+            handler, data = M99.decode(opcode)
+            if handler in (M99._op_exec, M99._op_out, M99._op_in_a, M99._op_in_b):
+                break
+
+            count += 1
+            if handler is M99._op_str:
+                value = "R" if r_safe else checked("R")
+                used.add("R")
+                body.append(f"    mem[{data}] = {value}")
+                if not self._static:
+                    body.append(f"    if cover[{data}]:")
+                    leave("        ", str(address + 1), count, str(data))
+            elif handler in (M99._op_lda, M99._op_ldb):
+                target = "A" if handler is M99._op_lda else "B"
+                written.add(target)
+                body.append(f"    {target} = mem[{data}]")
+            elif handler is M99._op_mov:
+                source = str(address) if data[0] == 3 else BLOCK_REGISTERS[data[0]]
+                if data[0] != 3:
+                    used.add(source)
+                if data[1] == 3:
+                    leave("    ", f"{source} + 1", count)
+                    terminated = True
+                else:
+                    if data[1] == 4:
+                        lowest_sb("    ")
+                        (sb_offset, sb_lowest) = (0, None)
+                    target = BLOCK_REGISTERS[data[1]]
+                    written.add(target)
+                    body.append(f"    {target} = {source}")
+                    if data[1] == 0:
+                        r_safe = data[0] == 3 or (data[0] == 0 and r_safe)
+            elif handler in (M99._op_add, M99._op_sub, M99._op_mul):
+                operator = {M99._op_add: "+", M99._op_sub: "-", M99._op_mul: "*"}[handler]
+                used.update(("A", "B"))
+                written.add("R")
+                body.append(f"    R = A {operator} B")
+                body.append(f"    if R > 999 or R < -999:")
+                body.append(f"        R = mo(R)")
+                r_safe = True
+            elif handler is M99._op_ret:
+                used.add("RA")
+                if not r_safe:
+                    written.add("R")
+                    body.append(f"    if R > 999 or R < -999:")
+                    body.append(f"        R = mo(R)")
+                leave("    ", "RA", count)
+                terminated = True
+            elif handler is M99._op_psh:
+                used.add("SB")
+                written.add("SB")
+                body.append(f"    if SB <= 0 or SB >= 99:")
+                leave("        ", str(address), count - 1)
+                if data == 3:
+                    value = str(address)
+                else:
+                    used.add(BLOCK_REGISTERS[data])
+                    value = BLOCK_REGISTERS[data]
+                    if data != 4 and not (data == 0 and r_safe):
+                        value = checked(value)
+                body.append(f"    mem[SB] = {value}")
+                body.append(f"    SB -= 1")
+                sb_offset -= 1
+                if sb_lowest is None or sb_offset < sb_lowest:
+                    sb_lowest = sb_offset
+                if not r_safe:
+                    written.add("R")
+                    body.append(f"    if R > 999 or R < -999:")
+                    body.append(f"        R = mo(R)")
+                    r_safe = True
+                if not self._static:
+                    body.append(f"    if cover[SB + 1]:")
+                    leave("        ", str(address + 1), count, "SB + 1")
+            elif handler is M99._op_pop:
+                used.add("SB")
+                written.add("SB")
+                body.append(f"    if SB >= 98 or SB < -1:")
+                leave("        ", str(address), count - 1)
+                body.append(f"    SB += 1")
+                sb_offset += 1
+                if data == 3:
+                    target = "pc"
+                else:
+                    target = BLOCK_REGISTERS[data]
+                    written.add(target)
+                body.append(f"    {target} = mem[SB]")
+                if data == 0 or not r_safe:
+                    written.add("R")
+                    body.append(f"    if R > 999 or R < -999:")
+                    body.append(f"        R = mo(R)")
+                    r_safe = True
+                if data == 3:
+                    leave("    ", "pc + 1", count)
+                    terminated = True
+            elif handler is M99._op_jmp:
+                leave("    ", str(data + 1), count)
+                terminated = True
+            elif handler is M99._op_jpp:
+                used.add("R")
+                body.append(f"    if R > 0:")
+                leave("        ", str(data + 1), count)
+                leave("    ", str(address + 1), count)
+                terminated = True
+            elif handler in (M99._op_jeq, M99._op_jne):
+                used.add("R")
+                operator = "==" if handler is M99._op_jeq else "!="
+                body.append(f"    if R {operator} {data}:")
+                leave("        ", str(address + 2), count)
+                leave("    ", str(address + 1), count)
+                terminated = True
+            elif handler is M99._op_cal:
+                written.add("RA")
+                body.append(f"    RA = {address + 1}")
+                leave("    ", str(data + 1), count)
+                terminated = True
+
+            address += 1
+
+        if count == 0:
+            # The cell is still covered, a store changing its instruction
+            # forgets that it can not be compiled
+            self._block_ends[start] = start + 1
+            self._cover[start] += 1
+            return False
+
+        if not terminated:
+            leave("    ", str(address), count)
+
+        registers = [name for name in BLOCK_REGISTERS if name in used | written]
+        source = ["def block(m, reg, mem, cover):"]
+        for name in registers:
+            source.append(f"    {name} = reg[{BLOCK_REGISTERS.index(name)}]")
+        for line in body:
+            if line.strip() == "@writeback":
+                indent = line[: line.index("@")]
+                if not written:
+                    continue
+                for name in BLOCK_REGISTERS:
+                    if name in written:
+                        source.append(f"{indent}reg[{BLOCK_REGISTERS.index(name)}] = {name}")
+            else:
+                source.append(line)
+
+        namespace = {"mo": M99.manage_overflow}
+        exec("\n".join(source), namespace)
+
+        self._block_ends[start] = address
+        for cell in range(start, address):
+            self._cover[cell] += 1
+        return namespace["block"]
+
+    def _invalidate_blocks(self, address: int) -> None:
+        """
+        Forget every compiled block containing the given address.
+
+        Args:
+            address (int): address of the modified memory cell.
+        """
+        for start, end in list(self._block_ends.items()):
+            if start <= address < end:
+                self._blocks[start] = None
+                del self._block_ends[start]
+                for cell in range(start, end):
+                    self._cover[cell] -= 1
+
+
+# Entry of the fused table of the cells whose sequence must be fused again
+FUSED_STALE = (M99._fused_stale, None)
+# Maximum number of instructions of a fused sequence
+FUSION_LENGTH = 4
+# Cells where a fused sequence containing each cell can start, besides itself
+FUSION_STARTS = [tuple(range(max(address - FUSION_LENGTH + 1, 0), address)) for address in range(99)]
+# Handlers executing fused sequences
+FUSION_HANDLERS = frozenset(
+    (
+        M99._fused_load_jpp,
+        M99._fused_arithmetic_jpp,
+        M99._fused_mov_jmp,
+        M99._fused_pop_pop,
+        M99._fused_skip_jmp,
+        M99._fused_in_psh,
+    )
+)
 
 
-def search_match(line: str, line_nb: int) -> tuple[re.Match, tuple[int, int, int]]:
+def encode(mnemonic: str, arg1: str, arg2: str) -> tuple[int, str]:
     """
-    Search for a match in the given line.
+    Encode an instruction.
 
     Args:
-        line (str): line to be searched.
-        line_nb (int): line number.
+        mnemonic (str): mnemonic of the instruction.
+        arg1 (str): first operand, None if there is none.
+        arg2 (str): second operand, None if there is none.
 
     Returns:
-        tuple[re.Pattern, tuple[int, int, int]]: match object and opcode.
+        tuple[int, str]: the opcode and the label that must be added to it,
+            or None if the instruction is invalid.
     """
-    for token in TOKENS:
-        match = re.match(token[0], line)
-        if match:
-            return (match, token[1])
-
-    raise ValueError(f"Invalid instruction at line {line_nb} : {line}")
+    if mnemonic not in INSTRUCTIONS:
+        return None
+
+    (opcode, operand) = INSTRUCTIONS[mnemonic]
+    match operand:
+        case None:
+            if arg1 is None:
+                return (opcode, None)
+        case "address" | "value":
+            if arg1 is None or arg2 is not None:
+                return None
+            if OPERAND_PATTERNS[operand].fullmatch(arg1):
+                return (opcode + int(arg1), None)
+            if label := LABEL_PATTERN.fullmatch(arg1):
+                return (opcode, label.group(1))
+        case "register":
+            if arg2 is None and OPERAND_PATTERNS["register"].fullmatch(arg1 or ""):
+                return (opcode + M99.reg_to_id(arg1), None)
+        case "registers":
+            if arg2 is not None and OPERAND_PATTERNS["register"].fullmatch(arg1):
+                if OPERAND_PATTERNS["register"].fullmatch(arg2):
+                    return (opcode + M99.reg_to_id(arg1) * 10 + M99.reg_to_id(arg2), None)
+    return None
+
+
+def disassemble(opcode: int) -> str:
+    """
+    Give the instruction corresponding to an opcode.
+    Values that are not valid instructions are given as DAT.
 
+    Args:
+        opcode (int): opcode to be disassembled.
 
-def preprocess(labels: dict[str, int], lines: list[str]) -> list[(int, str)]:
+    Returns:
+        str: the instruction.
+    """
+    if opcode > 999 or opcode < 0:
+        return f"DAT {opcode}"
+
+    data = opcode % 100
+    match opcode // 100:
+        case 0:
+            return f"STR {data}"
+        case 1:
+            return f"LDA {data}"
+        case 2:
+            return f"LDB {data}"
+        case 3:
+            if data // 10 <= 5 and data % 10 <= 5:
+                return f"MOV {M99.id_to_reg(data // 10)} {M99.id_to_reg(data % 10)}"
+        case 4:
+            operations = {0: "ADD", 1: "SUB", 2: "MUL", 9: "RET"}
+            if data in operations:
+                return operations[data]
+            if data // 10 in (8, 9) and data % 10 <= 5:
+                return f"{'PSH' if data // 10 == 8 else 'POP'} {M99.id_to_reg(data % 10)}"
+        case 5:
+            return f"JMP {data}"
+        case 6:
+            return f"JPP {data}"
+        case 7:
+            return f"JEQ {data}"
+        case 8:
+            return f"JNE {data}"
+        case 9:
+            return f"CAL {data}"
+    return f"DAT {opcode}"
+
+
+def assemble_program(code: str) -> tuple[list[int], dict[str, int], list[int]]:
     """
-    Scan the code to find labels and return the code without labels
-    This function also remove empty lines and comments
+    Assemble the given code in a single pass.
+    Label references are recorded in a fixup list and resolved once every label
+    is known. All the errors are reported at once.
 
     Args:
-        labels (dict[str, int]): The labels dict
-        lines (list[str]): list of lines representing the assembly code
+        code (str): code to be assembled.
 
     Returns:
-        str: the code without labels
-    """
-    code = []
-    line_nb = 0
-    address = 0
-    for l in lines:
-        line_nb += 1
-        if re.match(r"^\s*$", l):
+        tuple[list[int], dict[str, int], list[int]]: assembled program, labels and
+            source line number of each instruction.
+    """
+    program = []
+    labels = {}
+    lines = []
+    fixups = []
+    errors = []
+    for line_nb, line in enumerate(code.split("\n"), 1):
+        match = LINE_PATTERN.match(line)
+        if match and match["mnemonic"] is None:
+            if match["label"] is not None:
+                labels[match["label"]] = len(program)
             continue
-        
-        if re.match(r"^\s*#", l):
+
+        instruction = match and encode(match["mnemonic"], match["arg1"], match["arg2"])
+        if instruction is None:
+            errors.append(f"Invalid instruction at line {line_nb} : {COMMENT_PATTERN.sub('', line)}")
+            instruction = (0, None)
+
+        (opcode, label) = instruction
+        if label is not None:
+            fixups.append((len(program), label, line_nb))
+        program.append(opcode)
+        lines.append(line_nb)
+
+    for address, label, line_nb in fixups:
+        if label not in labels:
+            errors.append(f"Undefined label {label} at line {line_nb}")
             continue
+        program[address] += labels[label]
 
-        if m := re.match(r"^\s*:([A-Za-z][a-zA-Z09_\-]+)$", l):
-            labels[m.group(1)] = address
-        else:
-            l = re.sub(r"\s*#.*", "", l)
-            code.append((line_nb, l))
-            address += 1
-    return code
+    if errors:
+        raise ValueError("\n".join(errors))
+
+    return (program, labels, lines)
 
 
 def assemble(code: str) -> list[int]:
@@ -409,75 +2404,492 @@ def assemble(code: str) -> list[int]:
     Returns:
         list[int]: assembled program.
     """
+    return assemble_program(code)[0]
 
-    program = []
-    labels = {}
-    lines = code.split("\n")
-    lines = preprocess(labels, lines)
 
-    for line in lines:
-        # skip empty lines
-        (line_nb, line) = line
-        line = replace_labels(labels, line)
+# Version of the binary image format written by pack_image
+IMAGE_VERSION = 1
+# magic, version, flags, program length, padding to 16 bytes
+IMAGE_HEADER = struct.Struct("<4sHHH6x")
+IMAGE_MAGIC = b"M99I"
+IMAGE_LINES = 1
+IMAGE_LABELS = 2
 
-        (instruction_match, token) = search_match(line, line_nb)
-        if token is None:
-            continue
-        opcode = token[0]
-        for i in range(1, len(token)):
-            opcode *= 10
-            if token[i] < 0:
-                data = instruction_match.group(-token[i])
-                if data.isnumeric():
-                    opcode += int(data)
-                else:
-                    opcode += M99.reg_to_id(data)
-            else:
-                opcode += token[i]
 
-        program.append(opcode)
+def pack_image(program: list[int], labels: dict[str, int] = None, lines: list[int] = None) -> bytes:
+    """
+    Serialize a program into the binary image format.
+    The image is little-endian and starts with a 16 bytes header followed by
+    the 99 memory cells as int16. The optional line section holds the source line of
+    each cell as uint32 (0 when there is none), the optional label section
+    holds the number of labels as uint16 followed by, for each label, its
+    address and name length as uint16 and its UTF-8 name.
 
-    return program
+    Args:
+        program (list[int]): program to be serialized.
+        labels (dict[str, int]): labels of the program.
+        lines (list[int]): source line number of each instruction.
+
+    Returns:
+        bytes: the binary image.
+    """
+    if len(program) > 98:
+        raise ValueError("Program too long.")
+
+    flags = (IMAGE_LINES if lines is not None else 0) | (IMAGE_LABELS if labels is not None else 0)
+    cells = array("h", program)
+    cells.extend([0] * (99 - len(program)))
+    sections = [cells]
+    if lines is not None:
+        sections.append(array("I", lines))
+        sections[-1].extend([0] * (99 - len(lines)))
+
+    data = [IMAGE_HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, flags, len(program))]
+    for section in sections:
+        if sys.byteorder == "big":
+            section.byteswap()
+        data.append(section.tobytes())
+    if labels is not None:
+        data.append(struct.pack("<H", len(labels)))
+        for name, address in labels.items():
+            name = name.encode()
+            data.append(struct.pack("<HH", address, len(name)) + name)
+    return b"".join(data)
+
+
+def write_image(path: str, program: list[int], labels: dict[str, int] = None, lines: list[int] = None) -> None:
+    """
+    Write a program to a binary image file, see pack_image.
+    """
+    with open(path, "wb") as f:
+        f.write(pack_image(program, labels, lines))
 
 
-def replace_labels(labels: dict[str, int], line: str) -> str:
+class Image:
+    """
+    Binary image of a program, read with pack_image's format.
+    The cells and lines are memoryviews on the underlying buffer, no copy is
+    made. When built from a path the file is memory-mapped and close must be
+    called (or the image used as a context manager) before it is released.
     """
-    Replace labels in the given line.
 
-    Args:
-        labels (dict[str, int]): labels dict.
-        line (str): line to be processed.
+    def __init__(self, source) -> None:
+        """
+        Args:
+            source (str | bytes): path of the image file or its content.
+        """
+        self._mmap = None
+        self.cells = self.program = self.lines = self.labels = None
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            source = self._mmap
+        self._buffer = memoryview(source)
+        try:
+            self._parse()
+        except ValueError:
+            self.close()
+            raise
+
+    def _parse(self) -> None:
+        """
+        Read the header and the sections of the image.
+        """
+        try:
+            (magic, version, flags, length) = IMAGE_HEADER.unpack_from(self._buffer)
+        except struct.error:
+            raise ValueError("Invalid image.")
+        if magic != IMAGE_MAGIC or version != IMAGE_VERSION or length > 98:
+            raise ValueError("Invalid image.")
+
+        offset = IMAGE_HEADER.size
+        self.cells = self._section(offset, "h")
+        self.program = self.cells[:length]
+        offset += 2 * 99
+
+        if flags & IMAGE_LINES:
+            self.lines = self._section(offset, "I")
+            offset += 4 * 99
+
+        if flags & IMAGE_LABELS:
+            self.labels = {}
+            try:
+                (count,) = struct.unpack_from("<H", self._buffer, offset)
+                offset += 2
+                for _ in range(count):
+                    (address, size) = struct.unpack_from("<HH", self._buffer, offset)
+                    offset += 4
+                    if len(self._buffer) < offset + size:
+                        raise ValueError("Invalid image.")
+                    self.labels[bytes(self._buffer[offset : offset + size]).decode()] = address
+                    offset += size
+            except (struct.error, UnicodeDecodeError):
+                raise ValueError("Invalid image.")
+
+    def _section(self, offset: int, typecode: str) -> memoryview:
+        """
+        View of a section of 99 values of the given type.
+        On big-endian hosts the values are copied and swapped since the image
+        is little-endian.
+        """
+        size = array(typecode).itemsize * 99
+        if len(self._buffer) < offset + size:
+            raise ValueError("Invalid image.")
+        view = self._buffer[offset : offset + size]
+        if sys.byteorder == "big":
+            values = array(typecode, view)
+            values.byteswap()
+            view.release()
+            return memoryview(values)
+        return view.cast(typecode)
+
+    def close(self) -> None:
+        """
+        Release the buffer of the image.
+        """
+        for view in (self.program, self.cells, self.lines, self._buffer):
+            if view is not None:
+                view.release()
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def __enter__(self) -> "Image":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+class AssemblyCache:
+    """
+    Content-addressed on-disk cache of assembled programs.
+    Entries are keyed on the hash of the source and of ASSEMBLER_VERSION and
+    are binary images holding the program, the labels and the source line of
+    each instruction. When the cache grows beyond max_size bytes, the least
+    recently used entries are removed. Any error while using the cache
+    directory only makes the cache miss.
     """
 
-    for m in re.finditer(r"@([a-zA-Z][a-zA-Z0-9_\-]+)", line):
-        if m.group(1) not in labels:
-            raise ValueError(f"Undefined label {m.group(1)}")
-        line = line.replace(m.group(0), str(labels[m.group(1)]))
+    def __init__(self, directory: str = None, max_size: int = 16 * 1024 * 1024) -> None:
+        if directory is None:
+            directory = os.environ.get("M99_CACHE_DIR") or os.path.join(
+                os.path.expanduser("~"), ".cache", "m99"
+            )
+        self.directory = directory
+        self.max_size = max_size
 
-    return line
+    def path(self, code: str) -> str:
+        """
+        Path of the cache entry of the given source.
+
+        Args:
+            code (str): source of the program.
+
+        Returns:
+            str: path of the cache entry.
+        """
+        key = hashlib.sha256(f"{ASSEMBLER_VERSION}\0{code}".encode()).hexdigest()
+        return os.path.join(self.directory, key + ".m99i")
+
+    def assemble(self, code: str) -> tuple[list[int], dict[str, int], list[int]]:
+        """
+        Assemble the given code, reusing the cached result if there is one.
+
+        Args:
+            code (str): code to be assembled.
+
+        Returns:
+            tuple[list[int], dict[str, int], list[int]]: same as assemble_program.
+        """
+        path = self.path(code)
+        try:
+            with open(path, "rb") as f:
+                image = Image(f.read())
+            result = (image.program.tolist(), image.labels, image.lines[: len(image.program)].tolist())
+            image.close()
+            os.utime(path)
+            return result
+        except (OSError, ValueError, TypeError, struct.error):
+            pass
+
+        result = assemble_program(code)
+        try:
+            self.store(path, pack_image(*result))
+        except (OSError, ValueError):
+            pass
+        return result
+
+    def store(self, path: str, data: bytes) -> None:
+        """
+        Atomically write a cache entry then evict the least recently used
+        entries until the cache fits in max_size.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        (fd, temporary) = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".m99i"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, entry_path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            size -= entry_size
+
+    def clear(self) -> None:
+        """
+        Remove every entry of the cache.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".m99i"):
+                os.remove(entry.path)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="M99 Machine Emulator",
-        epilog = "Error codes: 1: Assembler error 2: Runtime error"
+        epilog = "Error codes: 1: Assembler error 2: Runtime error 3: Instruction budget or time limit exhausted"
+    )
+    parser.add_argument("file", type=argparse.FileType("r"), nargs="?", help="file to assemble and run")
+    parser.add_argument("--image", help="binary image to run instead of a source file")
+    parser.add_argument(
+        "-o", "--output", help="write the assembled program to a binary image instead of running it"
+    )
+    parser.add_argument(
+        "--engine", choices=ENGINES, default="decoded", help="execution engine (default: decoded)"
+    )
+    inputs = parser.add_mutually_exclusive_group()
+    inputs.add_argument(
+        "-i",
+        "--inputs",
+        type=int,
+        action="append",
+        metavar="VALUE",
+        help="value read by the program, repeated once per value",
+    )
+    inputs.add_argument(
+        "--input-file", type=argparse.FileType("r"), help="read the values from a file instead of prompting"
+    )
+    inputs.add_argument(
+        "--stdin", action="store_true", help="read all the values from the standard input instead of prompting"
+    )
+    parser.add_argument(
+        "--buffered", action="store_true", help="buffer the values written by the program"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="always assemble the program instead of using the assembly cache"
+    )
+    parser.add_argument(
+        "--profile", action="store_true", help="print the execution profile of the program on the standard error"
     )
-    parser.add_argument("file", type=argparse.FileType("r"), help="file to assemble and run")
-    
+    parser.add_argument(
+        "--profile-json", metavar="FILE", help="write the execution profile of the program to a JSON file"
+    )
+    parser.add_argument(
+        "--trace", metavar="FILE", help="write a binary trace of the executed instructions, read by M99_trace.py"
+    )
+    parser.add_argument(
+        "--break",
+        dest="breakpoints",
+        action="append",
+        default=[],
+        metavar="LOCATION",
+        help="report the state before executing the instruction at an address or a label, "
+        "optionally followed by 'if CONDITION'",
+    )
+    parser.add_argument(
+        "--watch",
+        dest="watchpoints",
+        action="append",
+        default=[],
+        metavar="TARGET",
+        help="report the state after an instruction changing a memory cell or a register, "
+        "optionally followed by 'if CONDITION'",
+    )
+    parser.add_argument(
+        "--max-steps", type=int, metavar="N", help="stop the program after N instructions"
+    )
+    parser.add_argument(
+        "--timeout", type=float, metavar="SECONDS", help="stop the program after SECONDS seconds"
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print the resources used by the run on the standard error: instructions, stack depth, I/O and time",
+    )
+    parser.add_argument(
+        "--detect-loops",
+        action="store_true",
+        help="fail as soon as the program goes through the same state twice without reading a value",
+    )
+
     args = parser.parse_args()
-    with open(args.file.name, "r") as f:
-        code = f.read()
-    
+    if (args.file is None) == (args.image is None):
+        parser.error("either a file or an image is required")
+    if args.trace and (args.profile or args.profile_json):
+        parser.error("--trace can not be used with --profile")
+    if args.detect_loops and (args.trace or args.profile or args.profile_json):
+        parser.error("--detect-loops can not be used with --profile or --trace")
+
+    if args.image:
+        try:
+            with Image(args.image) as image:
+                result = (image.program.tolist(), image.labels, image.lines and image.lines.tolist())
+        except (OSError, ValueError) as e:
+            print(e)
+            sys.exit(1)
+        program = result[0]
+    else:
+        with open(args.file.name, "r") as f:
+            code = f.read()
+
+        try:
+            if args.no_cache:
+                result = assemble_program(code)
+            else:
+                result = AssemblyCache().assemble(code)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+
+        if args.output:
+            try:
+                write_image(args.output, *result)
+            except ValueError as e:
+                print(e)
+                sys.exit(1)
+            sys.exit(0)
+        program = result[0]
+
+    m99 = M99()
+    if args.inputs is not None:
+        m99.read_value = IterableInput(args.inputs)
+    elif args.input_file:
+        m99.read_value = StreamInput(args.input_file)
+    elif args.stdin:
+        m99.read_value = StreamInput(sys.stdin)
+    if args.buffered:
+        m99.write_value = StreamOutput(sys.stdout)
+
+    def split_condition(text: str) -> tuple[str, callable]:
+        (target, _, expression) = text.partition(" if ")
+        return (target.strip(), parse_condition(expression) if expression else None)
+
+    labels = result[1] or {}
     try:
-        program = assemble(code)
+        for text in args.breakpoints:
+            (location, condition) = split_condition(text)
+            if location.isdigit():
+                m99.add_breakpoint(int(location), condition)
+            elif location in labels:
+                m99.add_breakpoint(labels[location], condition)
+            else:
+                raise ValueError(f"Unknown label {location}.")
+        for text in args.watchpoints:
+            (target, condition) = split_condition(text)
+            m99.add_watchpoint(int(target) if target.isdigit() else target, condition)
     except ValueError as e:
         print(e)
         sys.exit(1)
-    
-    m99 = M99()
+
+    def report_stop() -> None:
+        registers = " ".join(f"{M99.id_to_reg(i)}={value}" for i, value in enumerate(m99.reg))
+        if m99.stopped[0] == "breakpoint":
+            print(f"Breakpoint at {m99.stopped[1]}: {registers}", file=sys.stderr)
+        else:
+            (_, target, old, new) = m99.stopped
+            print(f"Watchpoint {target}: {old} -> {new}: {registers}", file=sys.stderr)
+
+    profiler = None
+    if args.profile or args.profile_json:
+        import M99_profile
+
+        profiler = M99_profile.Profiler()
+
+    tracer = None
+    if args.trace:
+        import M99_trace
+
+        tracer = M99_trace.Tracer(args.trace)
+
+    def write_reports() -> None:
+        if tracer is not None:
+            tracer.close()
+        if profiler is None:
+            return
+        if args.profile:
+            print(M99_profile.format_report(profiler.report(*result)), file=sys.stderr)
+        if args.profile_json:
+            profiler.dump(args.profile_json, *result)
+
+    # Runs resumed after a breakpoint share the budget of the first one
+    stats = []
+
+    def run_budgeted(**kwargs) -> None:
+        steps = sum(run_stats.steps for run_stats in stats)
+        elapsed = sum(run_stats.elapsed for run_stats in stats)
+        try:
+            m99.run(
+                engine=args.engine,
+                max_steps=None if args.max_steps is None else max(args.max_steps - steps, 0),
+                timeout=None if args.timeout is None else args.timeout - elapsed,
+                **kwargs,
+            )
+        finally:
+            # The stats of a run stopped by an error are reported too
+            stats.append(m99.stats)
+
+    def report_stats() -> None:
+        if not args.stats or not stats:
+            return
+        print(
+            f"Steps: {sum(run_stats.steps for run_stats in stats)}, "
+            f"stack depth: {max(run_stats.max_depth for run_stats in stats)}, "
+            f"inputs: {sum(run_stats.inputs for run_stats in stats)}, "
+            f"outputs: {sum(run_stats.outputs for run_stats in stats)}, "
+            f"time: {sum(run_stats.elapsed for run_stats in stats):.3f} s",
+            file=sys.stderr,
+        )
+
     try:
         m99.load(program)
-        m99.run()
-    except ValueError as e:
+        loop_detector = LoopDetector() if args.detect_loops else None
+        run_budgeted(profiler=profiler, tracer=tracer, loop_detector=loop_detector)
+        while m99.stopped is not None:
+            report_stop()
+            run_budgeted()
+    except (ValueError, IndexError) as e:
+        if args.buffered:
+            m99.write_value.flush()
+        write_reports()
+        report_stats()
+        if getattr(m99.read_value, "exhausted", False):
+            e = "End of input."
         print(e)
         sys.exit(2)
+
+    if args.buffered:
+        m99.write_value.flush()
+    write_reports()
+    report_stats()
+    if not m99._shutdown:
+        if args.max_steps is not None and sum(run_stats.steps for run_stats in stats) >= args.max_steps:
+            print("Instruction budget exhausted.")
+        else:
+            print("Time limit exhausted.")
+        sys.exit(3)
@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Static analysis of assembled M99 programs
+"""
+import sys
+import argparse
+from typing import NamedTuple
+import M99
+
+# Maximum number of values tracked for a register or a memory cell, beyond
+# which its value is unknown. SB is not limited, PSH and POP keep it in the
+# memory range
+LIMIT = 16
+# Number of return addresses of the pending calls distinguishing the states of
+# a subroutine, so that it only returns to the caller it was called from
+CONTEXT_DEPTH = 4
+# Number of states beyond which the states of the subroutines are merged for
+# all their callers, some programs jumping around too much
+MAX_STATES = 1024
+# Successor of the instructions shutting the machine down
+HALT = 99
+
+ERROR = "error"
+WARNING = "warning"
+
+ARITHMETIC = {
+    M99.M99._op_add: lambda a, b: a + b,
+    M99.M99._op_sub: lambda a, b: a - b,
+    M99.M99._op_mul: lambda a, b: a * b,
+}
+
+
+class Finding(NamedTuple):
+    """
+    Problem found in a program.
+    """
+
+    # Memory cell of the instruction, or first cell of the range, concerned
+    address: int
+    # ERROR when the execution fails or goes wrong whenever it reaches the
+    # instruction, WARNING when it may
+    severity: str
+    kind: str
+    message: str
+
+
+def join(a: frozenset, b: frozenset, limit: int = LIMIT) -> frozenset:
+    """
+    Give the values a location can hold after two paths meet.
+
+    Args:
+        a (frozenset): values of the location on the first path, None if unknown.
+        b (frozenset): values of the location on the second path.
+        limit (int): maximum number of values, None for no limit.
+
+    Returns:
+        frozenset: the values of both paths, None if they are unknown.
+    """
+    if a is None or b is None:
+        return None
+    if a == b:
+        return a
+    values = a | b
+    return values if limit is None or len(values) <= limit else None
+
+
+def data_cells(code: str, lines: list[int]) -> set[int]:
+    """
+    Find the cells of an assembled program declared with DAT.
+
+    Args:
+        code (str): source of the program.
+        lines (list[int]): source line number of each instruction, as given
+            by M99.assemble_program.
+
+    Returns:
+        set[int]: addresses of the DAT cells.
+    """
+    source = code.split("\n")
+    data = set()
+    for address, line_nb in enumerate(lines):
+        match = M99.LINE_PATTERN.match(source[line_nb - 1])
+        if match and match["mnemonic"] == "DAT":
+            data.add(address)
+    return data
+
+
+class Analysis:
+    """
+    Control-flow graph and problems of a program, found without running it.
+    The program is executed abstractly from the state of a machine it was just
+    loaded into: each register and memory cell holds a set of possible values,
+    or is unknown, and the paths are followed until the state at each address
+    stops growing. The successors of an instruction are thus given by the
+    values it can actually see: the skip of JEQ and JNE, the return addresses
+    held in RA (saved on the stack or not) and the instructions written by
+    STR or PSH are taken into account. The states of a subroutine are kept
+    apart for each of its callers, up to CONTEXT_DEPTH nested calls, unless
+    there are more than MAX_STATES of them.
+    The analysis is sound: every path the program can take is in the graph,
+    unless complete is False because it jumps to or executes an unknown value.
+    """
+
+    def __init__(self, program: list[int], data: set[int] = None) -> None:
+        """
+        Args:
+            program (list[int]): assembled program, loaded at address 0.
+            data (set[int]): addresses of the cells holding data, see
+                data_cells. Without them, the cells of the program that do not
+                disassemble to an instruction are taken as data.
+        """
+        self.program = list(program)
+        if data is None:
+            data = {address for address, opcode in enumerate(self.program) if M99.disassemble(opcode).startswith("DAT")}
+        self.data = data
+        # address -> addresses the execution can go to after its instruction, HALT included
+        self.successors = {}
+        # address of a CAL -> addresses of the subroutines it calls
+        self.calls = {}
+        # address -> opcodes it is executed with, none if they are unknown
+        self.executed = {}
+        # address -> addresses of the instructions that can write it
+        self.writes = {}
+        # addresses of the instructions writing unknown cells
+        self.unknown_writes = set()
+        self.complete = True
+        self._found = {}
+
+        states = self._explore(CONTEXT_DEPTH)
+        if states is None:
+            states = self._explore(0)
+        for node, state in states.items():
+            self._transfer(node, state, True)
+        self._report()
+
+    @property
+    def errors(self) -> list[Finding]:
+        return [finding for finding in self.findings if finding.severity == ERROR]
+
+    @property
+    def self_modifying(self) -> bool:
+        """
+        False when the program provably never executes a cell it writes, the
+        engines can then skip decoding the cells it writes again, see M99.load.
+        """
+        return not self.complete or bool(self.unknown_writes) or any(address in self.writes for address in self.executed)
+
+    def _explore(self, depth: int) -> dict:
+        """
+        Compute the state at each (PC, pending calls) until none changes.
+
+        Args:
+            depth (int): number of pending calls distinguishing the states.
+
+        Returns:
+            dict: the state at each (PC, pending calls), None if there are
+                more than MAX_STATES of them.
+        """
+        self._depth = depth
+        known = lambda value: frozenset((value,))
+        registers = (known(0), known(0), known(0), None, known(98), known(0))
+        memory = tuple(known(opcode) for opcode in self.program + [0] * (99 - len(self.program)))
+        states = {(0, ()): (registers, memory)}
+        pending = [(0, ())]
+        queued = set(pending)
+        while pending:
+            node = pending.pop()
+            queued.discard(node)
+            for target, state in self._transfer(node, states[node], False):
+                old = states.get(target)
+                new = state if old is None else Analysis._join_states(old, state)
+                if new is not old:
+                    if old is None and len(states) == MAX_STATES:
+                        return None
+                    states[target] = new
+                    if target not in queued:
+                        queued.add(target)
+                        pending.append(target)
+        return states
+
+    @staticmethod
+    def _join_states(old: tuple, new: tuple) -> tuple:
+        """
+        Join two states, giving the old one back if it already holds the new one.
+        """
+        (registers, memory) = old
+        (new_registers, new_memory) = new
+        joined = tuple(
+            join(a, b, None if index == 4 else LIMIT) for index, (a, b) in enumerate(zip(registers, new_registers))
+        )
+        if memory != new_memory:
+            new_memory = tuple(join(a, b) for a, b in zip(memory, new_memory))
+        if joined == registers and new_memory == memory:
+            return old
+        return (joined, new_memory)
+
+    def _find(self, address: int, severity: str, kind: str, message: str) -> None:
+        """
+        Record a problem, keeping the error when an instruction has both.
+        """
+        key = (address, kind)
+        if key not in self._found or severity == ERROR:
+            self._found[key] = Finding(address, severity, kind, message)
+
+    def _transfer(self, node: tuple, state: tuple, report: bool) -> list:
+        """
+        Execute the instruction of a node abstractly.
+
+        Args:
+            node (tuple): PC and return addresses of the pending calls.
+            state (tuple): registers and memory before the instruction.
+            report (bool): record the graph and the problems.
+
+        Returns:
+            list: (node, state) pairs of the successors.
+        """
+        (pc, context) = node
+        (registers, memory) = state
+        address = pc % 99
+        successors = []
+
+        def go(
+            target: int, registers: tuple = registers, memory: tuple = memory, indirect: bool = False, calls: tuple = context
+        ) -> None:
+            if target < -99:
+                if report:
+                    self._find(address, ERROR, "memory", f"Jump out of the memory at {address}")
+                return
+            if report:
+                self.successors.setdefault(address, set()).add(HALT if target >= 99 else target % 99)
+            if target >= 99:
+                return
+            # A return to the caller of the innermost pending call ends it
+            if indirect and calls and calls[-1] == target:
+                calls = calls[:-1]
+            successors.append(((target, calls), (registers, memory)))
+
+        def set_register(index: int, values: frozenset) -> tuple:
+            return registers[:index] + (values,) + registers[index + 1 :]
+
+        def jump_to(values: frozenset, offset: int, registers: tuple = registers, memory: tuple = memory) -> None:
+            if values is None:
+                if report:
+                    self.complete = False
+                    self._find(address, WARNING, "indirect", f"Jump to an unknown address at {address}")
+                return
+            for value in values:
+                go(value + offset, registers, memory, True)
+
+        opcodes = memory[address]
+        if opcodes is None:
+            if report:
+                self.executed.setdefault(address, set())
+                self.complete = False
+                self._find(address, WARNING, "unknown", f"Unknown instruction executed at {address}")
+            return successors
+
+        if report:
+            self.executed.setdefault(address, set()).update(opcodes)
+        for opcode in opcodes:
+            (handler, data) = M99.M99.decode(opcode)
+            if handler is M99.M99._op_exec:
+                if report:
+                    self._find(address, ERROR, "invalid", f"Invalid instruction {opcode} at {address}")
+            elif handler is M99.M99._op_str:
+                if report:
+                    self.writes.setdefault(data, set()).add(address)
+                go(pc + 1, registers, memory[:data] + (registers[0],) + memory[data + 1 :])
+            elif handler is M99.M99._op_out:
+                go(pc + 1)
+            elif handler in (M99.M99._op_lda, M99.M99._op_ldb):
+                go(pc + 1, set_register(1 if handler is M99.M99._op_lda else 2, memory[data]))
+            elif handler in (M99.M99._op_in_a, M99.M99._op_in_b):
+                go(pc + 1, set_register(1 if handler is M99.M99._op_in_a else 2, None))
+            elif handler is M99.M99._op_mov:
+                values = frozenset((pc,)) if data[0] == 3 else registers[data[0]]
+                if data[1] == 3:
+                    jump_to(values, 1)
+                else:
+                    go(pc + 1, set_register(data[1], values))
+            elif handler in ARITHMETIC:
+                (a, b) = (registers[1], registers[2])
+                values = None
+                if a is not None and b is not None and len(a) * len(b) <= LIMIT * LIMIT:
+                    operation = ARITHMETIC[handler]
+                    values = frozenset(M99.M99.manage_overflow(operation(x, y)) for x in a for y in b)
+                    if len(values) > LIMIT:
+                        values = None
+                go(pc + 1, set_register(0, values))
+            elif handler is M99.M99._op_ret:
+                jump_to(registers[5], 0)
+            elif handler is M99.M99._op_psh:
+                self._push(address, pc, data, registers, memory, report, go)
+            elif handler is M99.M99._op_pop:
+                self._pop(address, pc, data, registers, memory, report, go, jump_to)
+            elif handler is M99.M99._op_jmp:
+                go(data + 1)
+            elif handler is M99.M99._op_jpp:
+                values = registers[0]
+                if values is None or any(value > 0 for value in values):
+                    go(data + 1)
+                if values is None or any(value <= 0 for value in values):
+                    go(pc + 1)
+            elif handler in (M99.M99._op_jeq, M99.M99._op_jne):
+                values = registers[0]
+                equal = values is None or data in values
+                different = values is None or any(value != data for value in values)
+                if handler is M99.M99._op_jne:
+                    (equal, different) = (different, equal)
+                if equal:
+                    go(pc + 2)
+                if different:
+                    go(pc + 1)
+            elif handler is M99.M99._op_cal:
+                if report:
+                    self.calls.setdefault(address, set()).add((data + 1) % 99)
+                calls = (context + (pc + 1,))[-self._depth :] if self._depth else ()
+                go(data + 1, set_register(5, frozenset((pc + 1,))), calls=calls)
+        return successors
+
+    def _push(self, address: int, pc: int, source: int, registers: tuple, memory: tuple, report: bool, go) -> None:
+        """
+        Execute a PSH abstractly, see _transfer.
+        """
+        value = frozenset((pc,)) if source == 3 else registers[source]
+        stack = registers[4]
+        if stack is None:
+            # The value can land in any cell
+            if report:
+                self.unknown_writes.add(address)
+                self._find(address, WARNING, "write", f"Push to an unknown address at {address}")
+            go(pc + 1, registers, tuple(join(cell, value) for cell in memory))
+            return
+
+        valid = [cell for cell in stack if cell > 0]
+        if report and len(valid) < len(stack):
+            if valid:
+                self._find(address, WARNING, "overflow", f"Possible stack overflow at {address}")
+            else:
+                self._find(address, ERROR, "overflow", f"Stack overflow at {address}")
+        if not valid:
+            return
+
+        # Pushing on cell 99 and above writes the value out
+        cells = [cell for cell in valid if cell < 99]
+        if report:
+            for cell in cells:
+                self.writes.setdefault(cell, set()).add(address)
+        memory = list(memory)
+        for cell in cells:
+            memory[cell] = value if len(valid) == 1 else join(memory[cell], value)
+        registers = registers[:4] + (frozenset(cell - 1 for cell in valid),) + registers[5:]
+        go(pc + 1, registers, tuple(memory))
+
+    def _pop(self, address: int, pc: int, target: int, registers: tuple, memory: tuple, report: bool, go, jump_to) -> None:
+        """
+        Execute a POP abstractly, see _transfer.
+        """
+        stack = registers[4]
+        if stack is None:
+            (value, stack) = (None, None)
+        else:
+            valid = [cell for cell in stack if -1 <= cell < 98]
+            if report and len(valid) < len(stack):
+                if any(cell < -1 for cell in stack):
+                    self._find(address, ERROR if not valid else WARNING, "memory", f"Pop out of the memory at {address}")
+                if any(cell >= 98 for cell in stack):
+                    if valid:
+                        self._find(address, WARNING, "underflow", f"Possible stack underflow at {address}")
+                    else:
+                        self._find(address, ERROR, "underflow", f"Stack underflow at {address}")
+            if not valid:
+                return
+            value = frozenset()
+            for cell in valid:
+                value = join(value, memory[cell + 1])
+            stack = frozenset(cell + 1 for cell in valid)
+
+        registers = registers[:4] + (stack,) + registers[5:]
+        if target == 3:
+            jump_to(value, 1, registers, memory)
+        else:
+            go(pc + 1, registers[:target] + (value,) + registers[target + 1 :], memory)
+
+    def _report(self) -> None:
+        """
+        Find the problems depending on the whole graph: cells holding data or
+        written by the program being executed and unreachable code.
+        """
+        end = len(self.program)
+        # The cells written by instructions of the program are code
+        region = {address for address in self.executed if address in self.data or address >= end}
+        data = {address for address in region if self.writes.get(address, set()) <= region}
+        entries = {0} | {
+            successor
+            for address, successors in self.successors.items()
+            if address not in data
+            for successor in successors
+        }
+        for address in sorted(self.executed):
+            if address in data:
+                # Only the first cell of data executed is reported, the
+                # execution going on through the next ones
+                self._found.pop((address, "invalid"), None)
+                if address not in entries:
+                    continue
+                if address < end:
+                    self._find(address, ERROR, "data", f"Execution reaches the data at {address}")
+                else:
+                    self._find(address, ERROR, "data", f"Execution runs past the end of the program at {address}")
+            elif address in self.writes:
+                writers = sorted(writer for writer in self.writes[address] if writer not in data)
+                if not writers:
+                    continue
+                written = ", ".join(str(writer) for writer in writers[:4])
+                if len(writers) > 4:
+                    written += f" and {len(writers) - 4} other instructions"
+                self._find(address, WARNING, "self-modifying", f"Cell {address} is written by {written} and executed")
+
+        # Without the whole graph, the cells not reached may be reached
+        if self.complete:
+            start = None
+            for address in range(end + 1):
+                unreachable = address < end and address not in self.data and address not in self.executed
+                if unreachable and start is None:
+                    start = address
+                elif not unreachable and start is not None:
+                    cells = f"Cell {start} is" if address - 1 == start else f"Cells {start} to {address - 1} are"
+                    self._find(start, WARNING, "unreachable", f"{cells} unreachable")
+                    start = None
+
+        self.findings = sorted(self._found.values())
+
+    def format_graph(self) -> str:
+        """
+        Format the control-flow graph, one executed instruction per line
+        followed by its successors.
+
+        Returns:
+            str: the formatted graph.
+        """
+        lines = []
+        for address in sorted(self.executed):
+            instructions = " | ".join(M99.disassemble(opcode) for opcode in sorted(self.executed[address])) or "?"
+            successors = ", ".join(
+                "halt" if successor == HALT else str(successor) for successor in sorted(self.successors.get(address, ()))
+            )
+            lines.append(f"{address:>2} {instructions:<12} -> {successors}")
+        return "\n".join(lines)
+
+
+def analyze_source(code: str) -> Analysis:
+    """
+    Assemble and analyze a program, its DAT cells being known.
+
+    Args:
+        code (str): code to be analyzed.
+
+    Returns:
+        Analysis: the analysis of the assembled program.
+    """
+    (program, _, lines) = M99.assemble_program(code)
+    return Analysis(program, data_cells(code, lines))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find the problems of M99 programs without running them",
+        epilog="Exit status: 0 when no program has errors, 1 otherwise",
+    )
+    parser.add_argument("programs", nargs="+", help=".m99 or .m99i files to analyze")
+    parser.add_argument("--graph", action="store_true", help="print the control-flow graph of each program")
+    parser.add_argument("--strict", action="store_true", help="fail on warnings too")
+
+    args = parser.parse_args()
+    failed = False
+    for path in args.programs:
+        try:
+            if path.endswith(".m99i"):
+                with M99.Image(path) as image:
+                    program = image.program.tolist()
+                    lines = image.lines.tolist() if image.lines is not None else None
+                analysis = Analysis(program)
+            else:
+                with open(path, "r") as f:
+                    code = f.read()
+                (program, _, lines) = M99.assemble_program(code)
+                analysis = Analysis(program, data_cells(code, lines))
+        except (OSError, ValueError) as e:
+            print(f"{path}: {e}", file=sys.stderr)
+            failed = True
+            continue
+
+        if args.graph:
+            print(f"{path}:")
+            print(analysis.format_graph())
+        for finding in analysis.findings:
+            line = lines[finding.address] if lines is not None and finding.address < len(program) else 0
+            location = f"{path}:{line}" if line else path
+            print(f"{location}: {finding.severity}: {finding.message}")
+        if analysis.errors or (args.strict and analysis.findings):
+            failed = True
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Host M99 machines in an asyncio event loop, their I/O going through queues
+"""
+import sys
+import asyncio
+import argparse
+from collections import deque
+import M99
+
+# Number of instructions executed between two yields to the event loop
+SLICE = 1000
+# Maximum number of values waiting in the queues of a session
+QUEUE_SIZE = 1024
+# Engines stopping exactly after max_steps instructions, so that the slices
+# add up to the budget of the run
+ASYNC_ENGINES = ("step", "decoded", "fused")
+
+
+class _Starved(Exception):
+    """
+    Raised by the read function of a hosted machine when no value was received.
+    """
+
+
+class AsyncM99:
+    """
+    Host of a M99 machine in an asyncio event loop. The values read from the
+    cell 99 are taken from the inputs queue, None ending the input like an
+    invalid value, and the values written to it are put in the outputs queue.
+    The machine is run by slices of instructions, yielding to the event loop
+    between them and while it waits for a value, so that one process can host
+    thousands of machines without a thread per machine.
+
+    The instructions reading a value do not change the machine before the
+    read function is called, so when no value was received it raises and the
+    run is resumed at the same instruction once a value comes.
+    """
+
+    def __init__(
+        self,
+        machine: M99.M99 = None,
+        engine: str = "decoded",
+        slice_size: int = SLICE,
+        inputs: asyncio.Queue = None,
+        outputs: asyncio.Queue = None,
+    ) -> None:
+        """
+        Args:
+            machine (M99.M99): hosted machine, a new one by default.
+            engine (str): execution engine, one of ASYNC_ENGINES.
+            slice_size (int): number of instructions executed between two
+                yields to the event loop.
+            inputs (asyncio.Queue): queue of the values read by the program.
+            outputs (asyncio.Queue): queue receiving the values written by the
+                program, after each slice and before waiting for a value.
+        """
+        if engine not in ASYNC_ENGINES:
+            raise ValueError(f"Unknown engine {engine}.")
+        if slice_size < 1:
+            raise ValueError("Invalid slice size.")
+        self.machine = machine if machine is not None else M99.M99()
+        self.engine = engine
+        self.slice_size = slice_size
+        self.inputs = inputs if inputs is not None else asyncio.Queue()
+        self.outputs = outputs if outputs is not None else asyncio.Queue()
+        self.steps = 0
+        self.exhausted = False
+        self._received = deque()
+        self._written = []
+        self.machine.read_value = self._read
+        self.machine.write_value = self._written.append
+
+    def _read(self) -> int:
+        if self._received:
+            value = self._received.popleft()
+        else:
+            try:
+                value = self.inputs.get_nowait()
+            except asyncio.QueueEmpty:
+                raise _Starved()
+        if value is None:
+            self.exhausted = True
+        return value
+
+    async def _flush(self) -> None:
+        """
+        Put the values written during the slice in the outputs queue.
+        """
+        written = self._written
+        for value in written:
+            await self.outputs.put(value)
+        written.clear()
+
+    async def run(self, max_steps: int = None) -> int:
+        """
+        Run the program loaded into the machine until it shuts down, a
+        breakpoint or a watchpoint stops it, or max_steps instructions were
+        executed.
+
+        Args:
+            max_steps (int): maximum number of instructions to execute.
+
+        Raises:
+            ValueError: the errors raised by the instructions, like M99.run.
+
+        Returns:
+            int: number of executed instructions.
+        """
+        machine = self.machine
+        steps = 0
+        try:
+            # M99.run resumes the runs stopped by a breakpoint
+            while not machine._shutdown and steps != max_steps:
+                limit = self.slice_size if max_steps is None else min(self.slice_size, max_steps - steps)
+                try:
+                    machine.run(engine=self.engine, max_steps=limit)
+                except _Starved:
+                    # The stats count the instructions executed before the read
+                    steps += machine.stats.steps
+                    pc = machine.reg[3]
+                    await self._flush()
+                    self._received.append(await self.inputs.get())
+                    # A breakpoint of the reading instruction was already passed
+                    if pc in machine.breakpoints:
+                        machine._resume = pc
+                    continue
+                except (ValueError, IndexError):
+                    steps += machine.stats.steps
+                    await self._flush()
+                    raise
+                steps += machine.stats.steps
+                await self._flush()
+                if machine.stopped is not None:
+                    break
+                await asyncio.sleep(0)
+        finally:
+            self.steps += steps
+        return steps
+
+
+async def run_session(
+    program: list[int],
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    engine: str = "decoded",
+    slice_size: int = SLICE,
+    max_steps: int = None,
+) -> int:
+    """
+    Run a program for a client connected to the server. The client sends the
+    values read by the program as integers separated by whitespaces, closing
+    its side of the connection ending the input, and receives the values
+    written by the program, one per line. Once the machine stops, a last line
+    "# exit STATUS [MESSAGE]" is sent, the status being the exit code of
+    M99.py, and the connection is closed. The lines starting with # are not
+    values.
+
+    Args:
+        program (list[int]): assembled program.
+        reader (asyncio.StreamReader): stream of the client.
+        writer (asyncio.StreamWriter): stream to the client.
+        engine (str): execution engine, one of ASYNC_ENGINES.
+        slice_size (int): number of instructions executed between two yields
+            to the event loop.
+        max_steps (int): number of instructions after which the run fails.
+
+    Returns:
+        int: exit status of the session, None if the client left before its end.
+    """
+    host = AsyncM99(
+        engine=engine,
+        slice_size=slice_size,
+        inputs=asyncio.Queue(QUEUE_SIZE),
+        outputs=asyncio.Queue(QUEUE_SIZE),
+    )
+
+    async def feed() -> None:
+        while line := await reader.readline():
+            for token in line.split():
+                try:
+                    value = int(token)
+                except ValueError:
+                    writer.write(f"# Invalid value {token.decode(errors='replace')}.\n".encode())
+                    continue
+                await host.inputs.put(value)
+        await host.inputs.put(None)
+
+    async def send() -> None:
+        while (value := await host.outputs.get()) is not None:
+            writer.write(f"{value}\n".encode())
+            await writer.drain()
+
+    host.machine.load(program)
+    feeder = asyncio.create_task(feed())
+    sender = asyncio.create_task(send())
+    runner = asyncio.create_task(host.run(max_steps))
+    try:
+        # The sender only stops before the end of the run if the client left
+        await asyncio.wait((runner, sender), return_when=asyncio.FIRST_COMPLETED)
+        if not runner.done():
+            return None
+        try:
+            runner.result()
+            if host.machine._shutdown:
+                (status, message) = (0, None)
+            else:
+                (status, message) = (3, "Instruction budget exhausted.")
+        except (ValueError, IndexError) as e:
+            (status, message) = (2, "End of input." if host.exhausted else str(e))
+
+        await host.outputs.put(None)
+        await sender
+        writer.write(f"# exit {status}{'' if message is None else ' ' + message}\n".encode())
+        await writer.drain()
+        return status
+    except ConnectionError:
+        return None
+    finally:
+        for task in (feeder, sender, runner):
+            task.cancel()
+        writer.close()
+
+
+async def serve(
+    program: list[int],
+    host: str = "127.0.0.1",
+    port: int = 0,
+    path: str = None,
+    engine: str = "decoded",
+    slice_size: int = SLICE,
+    max_steps: int = None,
+) -> asyncio.AbstractServer:
+    """
+    Start a server running a new machine loaded with the program for each
+    connection, as described by run_session.
+
+    Args:
+        program (list[int]): assembled program.
+        host (str): address of the TCP server.
+        port (int): port of the TCP server, 0 for any free port.
+        path (str): path of a Unix socket to listen on instead of TCP.
+        engine (str): execution engine, one of ASYNC_ENGINES.
+        slice_size (int): number of instructions executed between two yields
+            to the event loop.
+        max_steps (int): number of instructions after which a session fails.
+
+    Returns:
+        asyncio.AbstractServer: the started server.
+    """
+    if engine not in ASYNC_ENGINES:
+        raise ValueError(f"Unknown engine {engine}.")
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await run_session(program, reader, writer, engine, slice_size, max_steps)
+
+    if path is not None:
+        return await asyncio.start_unix_server(handle, path)
+    return await asyncio.start_server(handle, host, port)
+
+
+def load_program(path: str) -> list[int]:
+    """
+    Assemble a .m99 source, or read a .m99i image.
+    """
+    if path.endswith(".m99i"):
+        with M99.Image(path) as image:
+            return image.program.tolist()
+    with open(path, "r") as f:
+        return M99.AssemblyCache().assemble(f.read())[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve M99 machine sessions over TCP or a Unix socket",
+        epilog="Each connection runs the program on a new machine. The client sends the values read by the program "
+        "and receives the values written, one per line, then a last line '# exit STATUS [MESSAGE]'.",
+    )
+    parser.add_argument("program", help=".m99 or .m99i file run by the sessions")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=9999, help="port to listen on (default: 9999)")
+    parser.add_argument("--unix", metavar="PATH", help="listen on a Unix socket instead of TCP")
+    parser.add_argument(
+        "--engine", choices=ASYNC_ENGINES, default="decoded", help="execution engine (default: decoded)"
+    )
+    parser.add_argument(
+        "--slice",
+        type=int,
+        default=SLICE,
+        metavar="N",
+        help=f"instructions executed before yielding to the other sessions (default: {SLICE})",
+    )
+    parser.add_argument("--max-steps", type=int, metavar="N", help="fail a session after N instructions")
+
+    args = parser.parse_args()
+    try:
+        program = load_program(args.program)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    async def main() -> None:
+        server = await serve(program, args.host, args.port, args.unix, args.engine, args.slice, args.max_steps)
+        for socket in server.sockets:
+            print(f"Serving on {socket.getsockname()}", file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Run many M99 programs against many input vectors in a process pool
+"""
+import os
+import sys
+import json
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import M99
+import M99_memo
+import M99_analysis
+
+# Memoizer of the last program run by this process, the jobs of a program
+# being sent to the workers together
+memoizer = (None, None)
+
+
+def read_vectors(path: str) -> list[list[int]]:
+    """
+    Read input vectors from a file, one vector per line, values being
+    separated by whitespaces. Empty lines and lines starting with # are ignored.
+
+    Args:
+        path (str): path of the file.
+
+    Returns:
+        list[list[int]]: the input vectors.
+    """
+    vectors = []
+    with open(path, "r") as f:
+        for line_nb, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                vectors.append([int(value) for value in line.split()])
+            except ValueError:
+                raise ValueError(f"Invalid input vector at {path}:{line_nb}")
+    return vectors
+
+
+def collect_programs(paths: list[str], inputs: str = None) -> list[tuple[str, str]]:
+    """
+    List the programs to run and the input file to use with each of them.
+    A path can be a .m99 source or .m99i image, a directory containing such
+    files or a manifest
+    listing one program per line, optionally followed by its input file.
+    Without an explicit input file, the <program>.in file next to the program is
+    used if it exists, then the inputs argument.
+
+    Args:
+        paths (list[str]): files, directories and manifests.
+        inputs (str): default input file.
+
+    Returns:
+        list[tuple[str, str]]: (program path, input file or None) pairs.
+    """
+
+    def default_inputs(program: str) -> str:
+        candidate = os.path.splitext(program)[0] + ".in"
+        return candidate if os.path.isfile(candidate) else inputs
+
+    programs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith((".m99", ".m99i")):
+                    program = os.path.join(path, name)
+                    programs.append((program, default_inputs(program)))
+        elif path.endswith((".m99", ".m99i")):
+            programs.append((path, default_inputs(path)))
+        else:
+            base = os.path.dirname(path)
+            with open(path, "r") as f:
+                for line in f:
+                    fields = line.split("#", 1)[0].split()
+                    if not fields:
+                        continue
+                    program = os.path.join(base, fields[0])
+                    if len(fields) > 1:
+                        programs.append((program, os.path.join(base, fields[1])))
+                    else:
+                        programs.append((program, default_inputs(program)))
+    return programs
+
+
+def run_job(
+    job: tuple[str, int, list[int], list[int], bool],
+    engine: str = "decoded",
+    detect_loops: bool = False,
+    max_steps: int = None,
+    timeout: float = None,
+    memoize: bool = False,
+) -> dict:
+    """
+    Run a program against an input vector.
+
+    Args:
+        job (tuple[str, int, list[int], list[int], bool]): program name, index
+            of the input vector, assembled program, input vector and whether
+            the program is known not to modify its code.
+        engine (str): execution engine, one of M99.ENGINES.
+        detect_loops (bool): fail the run as soon as the program goes through
+            the same state twice without reading a value.
+        max_steps (int): number of instructions after which the run fails.
+        timeout (float): number of seconds after which the run fails.
+        memoize (bool): replay the calls of subroutines made with the same
+            inputs by the previous runs of the program in this process.
+
+    Returns:
+        dict: the result of the run.
+    """
+    global memoizer
+    (name, case, program, inputs, static) = job
+    if memoize and memoizer[0] != name:
+        memoizer = (name, M99_memo.Memoizer())
+    outputs = M99.ListOutput()
+    machine = M99.M99()
+    machine.read_value = M99.IterableInput(inputs)
+    machine.write_value = outputs
+    status = 0
+    error = None
+    try:
+        machine.load(program, static=static)
+        machine.run(
+            engine=engine,
+            loop_detector=M99.LoopDetector() if detect_loops else None,
+            max_steps=max_steps,
+            timeout=timeout,
+            memoizer=memoizer[1] if memoize else None,
+        )
+        steps = machine.stats.steps
+        if not machine._shutdown:
+            status = 3
+            # The compiled engine stops at the end of a block, past the budget
+            if max_steps is not None and steps >= max_steps:
+                error = "Instruction budget exhausted."
+            else:
+                error = "Time limit exhausted."
+    except (ValueError, IndexError) as e:
+        # Invalid register ids raise IndexError, like with M99.step
+        status = 2
+        error = str(e)
+        # The stats count the instructions executed before the error, the
+        # calls replayed by the memoizer included
+        steps = 0 if machine.stats is None else machine.stats.steps
+
+    return {
+        "program": name,
+        "case": case,
+        "inputs": inputs,
+        "outputs": outputs.values,
+        "steps": steps,
+        "status": status,
+        "error": error,
+    }
+
+
+def build_jobs(programs: list[tuple[str, str]], results: list[dict], analyze: bool = False) -> list:
+    """
+    Assemble each program once and build the (program, inputs) jobs.
+    Programs that fail to assemble produce a result with status 1 instead.
+
+    Args:
+        programs (list[tuple[str, str]]): (program path, input file) pairs.
+        results (list[dict]): list receiving the assembler errors.
+        analyze (bool): analyze each program with M99_analysis, the programs
+            with errors producing a result with status 4 instead, and the
+            ones never modifying their code being run with the fast path.
+
+    Returns:
+        list: jobs to be given to run_job.
+    """
+    jobs = []
+    cache = M99.AssemblyCache()
+    for path, inputs in programs:
+        try:
+            data = None
+            if path.endswith(".m99i"):
+                with M99.Image(path) as image:
+                    program = image.program.tolist()
+            else:
+                with open(path, "r") as f:
+                    code = f.read()
+                (program, _, lines) = cache.assemble(code)
+                data = M99_analysis.data_cells(code, lines)
+            vectors = read_vectors(inputs) if inputs else [[]]
+        except (OSError, ValueError) as e:
+            results.append(rejected(path, 1, str(e)))
+            continue
+
+        static = False
+        if analyze:
+            analysis = M99_analysis.Analysis(program, data)
+            if analysis.errors:
+                results.append(rejected(path, 4, "\n".join(error.message for error in analysis.errors)))
+                continue
+            static = not analysis.self_modifying
+        for case, vector in enumerate(vectors):
+            jobs.append((path, case, program, vector, static))
+    return jobs
+
+
+def rejected(path: str, status: int, error: str) -> dict:
+    """
+    Give the result of a program that is not run.
+    """
+    return {
+        "program": path,
+        "case": None,
+        "inputs": None,
+        "outputs": [],
+        "steps": 0,
+        "status": status,
+        "error": error,
+    }
+
+
+def run_batch(
+    jobs: list,
+    workers: int,
+    chunksize: int,
+    engine: str,
+    detect_loops: bool = False,
+    max_steps: int = None,
+    timeout: float = None,
+    memoize: bool = False,
+):
+    """
+    Run the jobs in a process pool, yielding the results in order.
+
+    Args:
+        jobs (list): jobs built by build_jobs.
+        workers (int): number of processes, 0 runs the jobs in this process.
+        chunksize (int): number of jobs sent to a worker at once.
+        engine (str): execution engine.
+        detect_loops (bool): fail the runs of the programs that never stop.
+        max_steps (int): number of instructions after which a run fails.
+        timeout (float): number of seconds after which a run fails.
+        memoize (bool): memoize the subroutines over the runs of a program.
+    """
+    runner = partial(
+        run_job, engine=engine, detect_loops=detect_loops, max_steps=max_steps, timeout=timeout, memoize=memoize
+    )
+    if workers == 0:
+        yield from map(runner, jobs)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(runner, jobs, chunksize=chunksize)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run M99 programs against input vectors in parallel",
+        epilog="Results are written as JSON Lines. Status: 0: success 1: Assembler error 2: Runtime error "
+        "3: Instruction budget or time limit exhausted 4: Static analysis error",
+    )
+    parser.add_argument(
+        "programs", nargs="+", help=".m99 or .m99i files, directories or manifests of programs to run"
+    )
+    parser.add_argument(
+        "-i", "--inputs", help="file of input vectors, one per line, used when a program has no .in file"
+    )
+    parser.add_argument(
+        "-o", "--output", type=argparse.FileType("w"), default=sys.stdout, help="file receiving the results"
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=os.cpu_count(), help="number of worker processes, 0 to run in process"
+    )
+    parser.add_argument(
+        "-c", "--chunksize", type=int, default=64, help="number of jobs sent to a worker at once"
+    )
+    parser.add_argument(
+        "--engine", choices=M99.ENGINES, default="decoded", help="execution engine (default: decoded)"
+    )
+    parser.add_argument(
+        "--max-steps", type=int, metavar="N", help="fail a run after N instructions"
+    )
+    parser.add_argument(
+        "--timeout", type=float, metavar="SECONDS", help="fail a run after SECONDS seconds"
+    )
+    parser.add_argument(
+        "--detect-loops",
+        action="store_true",
+        help="fail a run as soon as the program goes through the same state twice without reading a value",
+    )
+    parser.add_argument(
+        "--analyze",
+        action="store_true",
+        help="reject the programs with errors found by M99_analysis without running them, and run the ones "
+        "never modifying their code faster",
+    )
+    parser.add_argument(
+        "--memoize",
+        action="store_true",
+        help="replay the calls of subroutines made again with the same inputs instead of executing them",
+    )
+
+    args = parser.parse_args()
+    if args.detect_loops and args.memoize:
+        parser.error("--detect-loops can not be used with --memoize")
+    results = []
+    try:
+        jobs = build_jobs(collect_programs(args.programs, args.inputs), results, args.analyze)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    runs = run_batch(
+        jobs, args.workers, args.chunksize, args.engine, args.detect_loops, args.max_steps, args.timeout, args.memoize
+    )
+    for result in itertools.chain(results, runs):
+        args.output.write(json.dumps(result) + "\n")
+    args.output.flush()
@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Differential fuzzing of the M99 execution engines against the reference interpreter
+"""
+import os
+import sys
+import random
+import argparse
+from functools import partial
+from typing import NamedTuple
+import M99
+import M99_memo
+import M99_batch
+import M99_profile
+import M99_analysis
+
+# Ways of running a program compared to M99.step, see Runner
+# decoded, compiled, fused: the engines of M99.run
+# mixed: an engine drawn at random for each slice of instructions
+# static: the engines drawn at random on the programs proven static by M99_analysis
+# profile, memoize, loops, checkpoints: runs delegated to the profiler, the
+#   memoizer, the loop detector and a checkpoint ring
+# vector: M99_vector.BatchM99
+# batch: M99_batch.run_job, only compared once the run is over
+TARGETS = (
+    "decoded",
+    "compiled",
+    "fused",
+    "mixed",
+    "static",
+    "profile",
+    "memoize",
+    "loops",
+    "checkpoints",
+    "vector",
+    "batch",
+)
+# Number of instructions executed by the targets before their state is
+# compared, drawn for each slice
+SLICES = (1, 1, 2, 3, 5, 8, 13, 50, 200)
+# Maximum number of instructions executed by a case
+MAX_STEPS = 2000
+
+
+class Case(NamedTuple):
+    """
+    Program and input values run by the targets.
+    """
+
+    image: list[int]
+    inputs: list[int]
+
+
+class Mismatch(NamedTuple):
+    """
+    Case on which a target does not behave like the reference interpreter.
+    """
+
+    target: str
+    case: Case
+    # Description of the first difference
+    reason: str
+
+
+def random_image(rng: random.Random) -> list[int]:
+    """
+    Generate a random program of valid instructions, its jumps and memory
+    accesses mostly landing in the program.
+
+    Args:
+        rng (random.Random): random number generator.
+
+    Returns:
+        list[int]: the program.
+    """
+    length = rng.randrange(1, 99)
+
+    def address() -> int:
+        return 99 if rng.random() < 0.04 else rng.randrange(min(length + 8, 99))
+
+    def target() -> int:
+        return 99 if rng.random() < 0.02 else rng.randrange(length)
+
+    families = (
+        lambda: address(),  # STR
+        lambda: 100 + address(),  # LDA
+        lambda: 200 + address(),  # LDB
+        lambda: 300 + rng.randrange(6) * 10 + rng.randrange(6),  # MOV
+        lambda: rng.choice((400, 401, 402)),
+        lambda: 409,  # RET
+        lambda: 480 + rng.randrange(6),  # PSH
+        lambda: 490 + rng.randrange(6),  # POP
+        lambda: rng.choice((500, 600, 700, 800, 900)) + target(),
+        lambda: rng.randrange(1000),  # DAT
+    )
+    weights = (3, 4, 4, 2, 3, 1, 3, 1, 5, 1)
+    return [rng.choices(families, weights)[0]() for _ in range(length)]
+
+
+def random_inputs(rng: random.Random) -> list[int]:
+    """
+    Generate random input values, some of them out of the range of the cells.
+
+    Args:
+        rng (random.Random): random number generator.
+
+    Returns:
+        list[int]: the values.
+    """
+    return [rng.randrange(-1200, 1200) for _ in range(rng.randrange(16))]
+
+
+class Reference:
+    """
+    Machine running a case with M99.step, the instructions being executed on
+    demand.
+    """
+
+    def __init__(self, case: Case) -> None:
+        self.machine = machine_for(case)
+        self.steps = 0
+
+    def advance(self, count: int) -> Exception:
+        """
+        Execute instructions until count were executed, the machine shuts
+        down or an instruction raises.
+
+        Returns:
+            Exception: the exception raised, None if there was none.
+        """
+        machine = self.machine
+        for _ in range(count):
+            if machine._shutdown:
+                break
+            try:
+                machine.step()
+            except Exception as e:
+                return e
+            self.steps += 1
+        return None
+
+
+def machine_for(case: Case, static: bool = False) -> M99.M99:
+    """
+    Build a machine with the program and the input values of a case loaded.
+    """
+    machine = M99.M99()
+    machine.load(case.image, static=static)
+    machine.read_value = M99.IterableInput(case.inputs)
+    machine.write_value = M99.ListOutput()
+    return machine
+
+
+def state(machine: M99.M99) -> tuple:
+    return (list(machine.mem), list(machine.reg), machine._shutdown, list(machine.write_value.values))
+
+
+def difference(expected: tuple, got: tuple) -> str:
+    """
+    Describe the first difference between two states given by state.
+
+    Returns:
+        str: the description, None if the states are equal.
+    """
+    (memory, registers, shutdown, outputs) = expected
+    (got_memory, got_registers, got_shutdown, got_outputs) = got
+    for address in range(99):
+        if memory[address] != got_memory[address]:
+            return f"cell {address} is {got_memory[address]} instead of {memory[address]}"
+    for index in range(6):
+        if registers[index] != got_registers[index]:
+            name = M99.M99.id_to_reg(index)
+            return f"register {name} is {got_registers[index]} instead of {registers[index]}"
+    if shutdown != got_shutdown:
+        return "the machine is shut down" if got_shutdown else "the machine is not shut down"
+    if outputs != got_outputs:
+        return f"the outputs are {got_outputs} instead of {outputs}"
+    return None
+
+
+def describe(error: Exception) -> str:
+    return f"{type(error).__name__}: {error}"
+
+
+class Runner:
+    """
+    Run a case with a target, one slice of instructions at a time.
+    """
+
+    def __init__(self, case: Case, target: str, rng: random.Random) -> None:
+        """
+        Args:
+            case (Case): case to be run.
+            target (str): one of TARGETS but batch.
+            rng (random.Random): generator drawing the engines of the mixed
+                and static targets.
+        """
+        self.rng = rng
+        self.target = target
+        self.batch = None
+        if target == "vector":
+            import M99_vector
+
+            self.batch = M99_vector.BatchM99(1)
+            self.batch.load(case.image)
+            self.batch.set_inputs([case.inputs])
+            return
+
+        self.machine = machine_for(case, target == "static")
+        match target:
+            case "decoded" | "compiled" | "fused":
+                self._run = partial(self.machine.run, engine=target)
+            case "mixed" | "static":
+                self._run = lambda max_steps: self.machine.run(engine=rng.choice(M99.ENGINES), max_steps=max_steps)
+            case "profile":
+                self._run = partial(self.machine.run, profiler=M99_profile.Profiler())
+            case "memoize":
+                self._run = partial(self.machine.run, memoizer=M99_memo.Memoizer())
+            case "loops":
+                self._run = partial(self.machine.run, loop_detector=M99.LoopDetector())
+            case "checkpoints":
+                self._run = partial(self.machine.run, engine="decoded", checkpoints=M99.Checkpoints(interval=7, size=2))
+            case _:
+                raise ValueError(f"Unknown target {target}.")
+
+    def run(self, max_steps: int) -> int:
+        """
+        Execute at most max_steps instructions, a few more with the compiled
+        engine.
+
+        Returns:
+            int: number of executed instructions.
+        """
+        if self.batch is None:
+            return self._run(max_steps=max_steps)
+
+        batch = self.batch
+        steps = int(batch.steps[0])
+        batch.run(max_steps=max_steps)
+        if batch.errors[0] is not None:
+            raise batch.errors[0]
+        return int(batch.steps[0]) - steps
+
+    def state(self) -> tuple:
+        if self.batch is None:
+            return state(self.machine)
+        machine = self.batch.machine(0)
+        return (list(machine.mem), machine.reg, machine._shutdown, list(self.batch.outputs[0]))
+
+
+def check(case: Case, target: str, max_steps: int = MAX_STEPS, seed: int = 0) -> str:
+    """
+    Run a case with the reference interpreter and a target, comparing the
+    memory, the registers, the shutdown state and the outputs after each
+    slice of instructions and the errors raised.
+
+    Args:
+        case (Case): case to be run.
+        target (str): one of TARGETS.
+        max_steps (int): number of instructions after which the case passes.
+        seed (int): seed drawing the slices, so that a case is checked the
+            same way again.
+
+    Returns:
+        str: description of the first difference, None if there is none.
+    """
+    if target == "batch":
+        return check_batch(case, max_steps)
+    if target == "static" and M99_analysis.Analysis(case.image).self_modifying:
+        return None
+
+    rng = random.Random(seed)
+    reference = Reference(case)
+    runner = Runner(case, target, rng)
+    while reference.steps < max_steps and not reference.machine._shutdown:
+        limit = min(rng.choice(SLICES), max_steps - reference.steps)
+        start = reference.steps
+        try:
+            count = runner.run(limit)
+        except M99.InfiniteLoop as e:
+            # The loop detector is right if the program never stops
+            if reference.advance(max_steps - reference.steps) is not None or reference.machine._shutdown:
+                return f"after {start} instructions, {describe(e)} raised but the program stops"
+            return None
+        except Exception as e:
+            # Some instructions may have been executed before the error
+            expected = reference.advance(limit + 99)
+            if expected is None:
+                return f"after {start} instructions, {describe(e)} raised instead of nothing"
+            if describe(expected) != describe(e):
+                return f"after {start} instructions, {describe(e)} raised instead of {describe(expected)}"
+            return error_difference(reference, runner, start)
+
+        expected = reference.advance(count)
+        if expected is not None:
+            return f"after {start} instructions, nothing raised instead of {describe(expected)}"
+        if reference.steps != start + count:
+            return f"after {start} instructions, {count} instructions executed after the shutdown"
+        found = difference(state(reference.machine), runner.state())
+        if found is not None:
+            return f"after {reference.steps} instructions, {found}"
+        if count == 0 and not reference.machine._shutdown:
+            return f"after {start} instructions, the run stopped without executing anything"
+    return None
+
+
+def error_difference(reference: Reference, runner: Runner, start: int) -> str:
+    found = difference(state(reference.machine), runner.state())
+    if found is not None:
+        return f"after the error raised at instruction {reference.steps}, {found}"
+    return None
+
+
+def check_batch(case: Case, max_steps: int) -> str:
+    """
+    Run a case with the reference interpreter and M99_batch.run_job, comparing
+    the result of the job.
+    """
+    reference = Reference(case)
+    error = reference.advance(max_steps)
+    machine = reference.machine
+    status = 0
+    if error is not None:
+        (status, error) = (2, str(error))
+    elif not machine._shutdown:
+        (status, error) = (3, "Instruction budget exhausted.")
+
+    result = M99_batch.run_job(("fuzz", 0, case.image, case.inputs, False), max_steps=max_steps)
+    expected = {"outputs": machine.write_value.values, "steps": reference.steps, "status": status, "error": error}
+    for key, value in expected.items():
+        if result[key] != value:
+            return f"the {key} of the job are {result[key]} instead of {value}"
+    return None
+
+
+def shrink(case: Case, target: str, max_steps: int = MAX_STEPS, seed: int = 0) -> Case:
+    """
+    Make a failing case smaller while it keeps failing: the program is cut
+    and its cells cleared, the input values are dropped and cleared.
+
+    Args:
+        case (Case): case on which check fails.
+        target (str): target failing on the case.
+        max_steps (int): max_steps given to check.
+        seed (int): seed given to check.
+
+    Returns:
+        Case: the smallest failing case found.
+    """
+
+    def candidates(case: Case):
+        (image, inputs) = case
+        for length in (len(image) // 2, len(image) - 1):
+            if 0 < length < len(image):
+                yield Case(image[:length], inputs)
+        for address in range(len(image)):
+            yield Case(image[:address] + image[address + 1 :], inputs)
+        for address in range(len(image)):
+            if image[address] != 0:
+                yield Case(image[:address] + [0] + image[address + 1 :], inputs)
+        for index in range(len(inputs)):
+            yield Case(image, inputs[:index] + inputs[index + 1 :])
+        for index in range(len(inputs)):
+            if inputs[index] != 0:
+                yield Case(image, inputs[:index] + [0] + inputs[index + 1 :])
+
+    shrunk = True
+    while shrunk:
+        shrunk = False
+        for candidate in candidates(case):
+            if candidate.image and check(candidate, target, max_steps, seed) is not None:
+                case = candidate
+                shrunk = True
+                break
+    return case
+
+
+def fuzz(cases: int, seed: int = 0, targets: tuple = TARGETS, max_steps: int = MAX_STEPS):
+    """
+    Check random cases with each target, yielding the shrunk failing cases.
+
+    Args:
+        cases (int): number of cases.
+        seed (int): seed of the random cases.
+        targets (tuple): targets to be checked.
+        max_steps (int): maximum number of instructions executed by a case.
+    """
+    rng = random.Random(seed)
+    for index in range(cases):
+        case = Case(random_image(rng), random_inputs(rng))
+        for target in targets:
+            if check(case, target, max_steps, index) is not None:
+                case = shrink(case, target, max_steps, index)
+                yield Mismatch(target, case, check(case, target, max_steps, index))
+
+
+def write_case(directory: str, name: str, case: Case) -> str:
+    """
+    Write a case as a source and an input file, which M99_batch.py can run.
+
+    Returns:
+        str: path of the source file.
+    """
+    path = os.path.join(directory, f"{name}.m99")
+    with open(path, "w") as f:
+        f.write("\n".join(M99.disassemble(opcode) for opcode in case.image) + "\n")
+    with open(os.path.join(directory, f"{name}.in"), "w") as f:
+        f.write(" ".join(str(value) for value in case.inputs) + "\n")
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the M99 execution engines to the reference interpreter on random programs",
+        epilog="The exit code is 1 when a target does not behave like the reference interpreter",
+    )
+    parser.add_argument("-n", "--cases", type=int, default=1000, help="number of random cases (default: 1000)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random cases (default: 0)")
+    parser.add_argument(
+        "--targets", nargs="+", choices=TARGETS, default=TARGETS, metavar="TARGET", help="targets to be checked"
+    )
+    parser.add_argument(
+        "--max-steps", type=int, default=MAX_STEPS, metavar="N", help=f"instructions run per case (default: {MAX_STEPS})"
+    )
+    parser.add_argument("-o", "--output", help="directory receiving the failing cases as .m99 and .in files")
+
+    args = parser.parse_args()
+    failed = False
+    for number, mismatch in enumerate(fuzz(args.cases, args.seed, tuple(args.targets), args.max_steps)):
+        failed = True
+        print(f"{mismatch.target}: {mismatch.reason}")
+        print(f"  program: {mismatch.case.image}")
+        print(f"  inputs: {mismatch.case.inputs}")
+        if args.output:
+            print(f"  written to {write_case(args.output, f'{mismatch.target}-{number}', mismatch.case)}")
+    sys.exit(1 if failed else 0)
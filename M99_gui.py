@@ -1,7 +1,11 @@
+import time
+import argparse
+import queue
 import M99
+import M99_worker
 from tkinter import Frame, Label, Tk, Button, Widget, LabelFrame
 from tkinter.messagebox import showinfo, showerror
-from tkinter.simpledialog import askinteger
+from tkinter.simpledialog import askinteger, askstring
 from tkinter.filedialog import askopenfilename
 
 # 1 means the instruction takes one argument and it's not a register
@@ -83,8 +87,12 @@ class MemoryCell(Frame):
                     case 1:
                         return f"{opcode_repr[0]} {opcode}"
                     case 2:
+                        if opcode // 10 > 5 or opcode % 10 > 5:
+                            return ""
                         return f"{opcode_repr[0]} {M99.M99.id_to_reg(opcode // 10)} {M99.M99.id_to_reg(opcode % 10)}"
                     case -1:
+                        if opcode % 10 > 5:
+                            return ""
                         return f"{opcode_repr[0]} {M99.M99.id_to_reg(opcode % 10)}"
                     case _:
                         raise ValueError("Invalid representation")
@@ -140,15 +148,26 @@ class MemoryCell(Frame):
 
 
 class M99Interface(Frame):
-    def __init__(self, master: Tk, machine: M99.M99) -> None:
+    def __init__(self, master: Tk, machine: M99.M99, fps: int = 30, history: int = 100000) -> None:
         super().__init__(master)
-        self.machine = machine
-        self.machine.after_exec(self.update_display)
-        self.machine.read_value = self.input_value
-        self.machine.write_value = self.display_value
+        # The machine is owned by the worker thread, the interface displays a
+        # copy of its state updated from the events of the worker
+        self.worker = M99_worker.MachineWorker(machine, fps, history)
+        self.view = M99.M99()
+        self.fps = fps
+        self.running = False
+        self.executed = 0
+        self.started = time.perf_counter()
         self.pack()
         self.assembly = []
+        self.labels = {}
+        self.breakpoints = set()
+        self.watchpoints = set()
+        self.stopped = None
+        self.cache = M99.AssemblyCache()
         self.create_widgets()
+        self.worker.start()
+        self.poll()
 
     def build_register_display(self) -> LabelFrame:
         """
@@ -162,7 +181,7 @@ class M99Interface(Frame):
             self.reg_labels.append(
                 Label(
                     cell,
-                    text=f"{self.machine.reg[i]}",
+                    text=f"{self.view.reg[i]}",
                     font=("Monospace", 20),
                 )
             )
@@ -189,24 +208,33 @@ class M99Interface(Frame):
         print(f"Input: {value}")
         return value
 
-    def update_register_display(self) -> None:
+    def update_register_display(self, registers: list[int]) -> None:
         """
         Update the register display.
+
+        Args:
+            registers (list[int]): ids of the registers that changed.
         """
-        if self.machine._shutdown:
-            self.register_contener.config(
-                text="Registers (Shutdown)",
-            )
-            change_color("red", self.register_contener)
+        for i in registers:
+            self.reg_labels[i]["text"] = f"{self.view.reg[i]}"
+
+    def update_shutdown_display(self) -> None:
+        """
+        Show whether the machine is shut down, only recoloring the widgets when
+        the state changed.
+        """
+        if self.view._shutdown == self.shown_shutdown:
             return
+
+        self.shown_shutdown = self.view._shutdown
+        if self.shown_shutdown:
+            self.register_contener.config(text="Registers (Shutdown)")
+            change_color("red", self.register_contener)
+            self.memory_display.config(text="Memory (Shutdown)", bg="red")
         else:
-            self.register_contener.config(
-                text="Registers",
-            )
+            self.register_contener.config(text="Registers")
             change_color("lightgrey", self.register_contener)
-        
-        for i in range(len(self.registers_labels)):
-            self.reg_labels[i]["text"] = f"{self.machine.reg[i]}"
+            self.memory_display.config(text="Memory", bg="lightgrey")
 
     def cell_color(self, i: int, j: int) -> str:
         """
@@ -220,10 +248,14 @@ class M99Interface(Frame):
             str: the background color of the cell
         """
         bg = "white"
-        if self.machine.reg[4] == i * 10 + j:
+        if self.view.reg[4] == i * 10 + j:
             bg = "lightgreen"
-        elif self.machine.reg[3] == i * 10 + j:
+        elif self.view.reg[3] == i * 10 + j:
             bg = "lightblue"
+        elif i * 10 + j in self.breakpoints:
+            bg = "salmon"
+        elif i * 10 + j in self.watchpoints:
+            bg = "khaki"
         return bg
 
     def build_memory_display(self) -> LabelFrame:
@@ -241,34 +273,34 @@ class M99Interface(Frame):
                     row.append(Label(memory, text="I/O"))
                 else:
                     bg = self.cell_color(i, j)
-                    row.append(MemoryCell(memory, self.machine.mem[i * 10 + j], bg=bg))
+                    row.append(MemoryCell(memory, self.view.mem[i * 10 + j], bg=bg))
                 row[j].grid(row=j + 1, column=i + 1)
             self.mem_labels.append(row)
 
         return memory
 
-    def update_memory_display(self) -> None:
+    def update_memory_display(self, cells: list[int]) -> None:
         """
         Update the memory display.
+
+        Args:
+            cells (list[int]): addresses of the cells that changed.
         """
-        if self.machine._shutdown:
-            self.memory_display.config(
-                text="Memory (Shutdown)",
-                bg="red"
-            )
+        for address in cells:
+            self.mem_labels[address // 10][address % 10].set_opcode(self.view.mem[address])
+
+        # Only the cells pointed by PC and SB before and after the change can
+        # have a different color
+        highlighted = (self.view.reg[3], self.view.reg[4])
+        if highlighted == self.highlighted:
             return
-        else:
-            self.memory_display.config(
-                text="Memory",
-                bg="lightgrey"
-            )
-        for i in range(10):
-            for j in range(10):
-                if i == 9 and j == 9:
-                    continue
-                bg = self.cell_color(i, j)
-                self.mem_labels[i][j].set_opcode(self.machine.mem[i * 10 + j])
-                self.mem_labels[i][j].config(bg=bg)
+
+        for address in {*self.highlighted, *highlighted}:
+            if 0 <= address < 99:
+                self.mem_labels[address // 10][address % 10].config(
+                    bg=self.cell_color(address // 10, address % 10)
+                )
+        self.highlighted = highlighted
 
     def build_buttons(self) -> Frame:
         """
@@ -280,38 +312,174 @@ class M99Interface(Frame):
         Button(buttons, text="Step", command=self.next_instruction).grid(
             row=0, column=2
         )
-        Button(buttons, text="Reset", command=self.machine.restart).grid(
+        Button(buttons, text="Reset", command=self.reset).grid(
             row=1, column=0
         )
         Button(buttons, text="Load", command=self.load).grid(row=1, column=1)
         Button(buttons, text="Quit", command=self.quit).grid(row=1, column=2)
-        Button(buttons, text="Clear", command=self.machine.clear).grid(row=2, column=1)
+        Button(buttons, text="Pause", command=self.pause).grid(row=2, column=0)
+        Button(buttons, text="Clear", command=self.clear).grid(row=2, column=1)
+        Button(buttons, text="Stop", command=self.stop).grid(row=2, column=2)
+        Button(buttons, text="Step Back", command=self.previous_instruction).grid(
+            row=3, column=0
+        )
+        Button(buttons, text="Run Back to PC", command=self.run_back).grid(
+            row=3, column=1, columnspan=2
+        )
+        Button(buttons, text="Breakpoint", command=self.toggle_breakpoint).grid(
+            row=4, column=0
+        )
+        Button(buttons, text="Watch", command=self.toggle_watchpoint).grid(
+            row=4, column=1
+        )
+        self.status = Label(buttons, text="")
+        self.status.grid(row=5, column=0, columnspan=3)
         self.master.bind("<Return>",  lambda _: self.next_instruction())
-        self.master.bind("<BackSpace>", lambda _: self.machine.clear())
+        self.master.bind("<BackSpace>", lambda _: self.clear())
         self.master.bind("<q>", lambda _: self.quit())
-        self.master.bind("<c>", lambda _: self.machine.clear())
+        self.master.bind("<c>", lambda _: self.clear())
         self.master.bind("<l>", lambda _: self.load())
         self.master.bind("<j>", lambda _: self.jump())
-        self.master.bind("<r>", lambda _: self.machine.restart())
+        self.master.bind("<r>", lambda _: self.reset())
+        self.master.bind("<e>", lambda _: self.run_machine())
+        self.master.bind("<p>", lambda _: self.pause())
+        self.master.bind("<s>", lambda _: self.stop())
+        self.master.bind("<b>", lambda _: self.previous_instruction())
+        self.master.bind("<k>", lambda _: self.toggle_breakpoint())
+        self.master.bind("<w>", lambda _: self.toggle_watchpoint())
         return buttons
 
     def next_instruction(self) -> None:
         """
         Execute the next instruction.
         """
+        self.stopped = None
+        self.worker.send("step")
+
+    def previous_instruction(self) -> None:
+        """
+        Go back to the state before the last executed instruction.
+        """
+        self.stopped = None
+        self.worker.send("back")
+
+    def run_back(self) -> None:
+        """
+        Go back to the last time the PC was at a specific address.
+        """
+        address = askinteger(
+            "Run Back to PC", "Enter an address:", parent=self, minvalue=0, maxvalue=98
+        )
+        if address is not None:
+            self.worker.send("back_to", address)
+
+    def ask_target(self, title: str, prompt: str) -> tuple[str, callable]:
+        """
+        Ask for the target of a breakpoint or a watchpoint, optionally followed
+        by "if CONDITION".
+
+        Returns:
+            tuple[str, callable]: the target and the condition, None if the
+                dialog was cancelled.
+        """
+        text = askstring(title, prompt, parent=self)
+        if not text:
+            return None
+        (target, _, expression) = text.partition(" if ")
         try:
-            self.machine.step()
+            return (target.strip(), M99.parse_condition(expression) if expression else None)
         except ValueError as e:
-            showerror("Error", f"An error occurred: {e}", parent=self)
+            showerror("Error", f"An error occurred:\n {e}", parent=self)
+            return None
+
+    def toggle_breakpoint(self) -> None:
+        """
+        Add a breakpoint on an address or a label, or remove it if it is set
+        and no condition is given.
+        """
+        answer = self.ask_target("Breakpoint", "Enter an address or a label, optionally followed by 'if CONDITION':")
+        if answer is None:
+            return
+
+        (location, condition) = answer
+        if location.isdigit() and int(location) <= 98:
+            address = int(location)
+        elif location in self.labels:
+            address = self.labels[location]
+        else:
+            showerror("Error", f"Unknown location {location}.", parent=self)
+            return
+
+        if address in self.breakpoints and condition is None:
+            self.breakpoints.discard(address)
+            self.worker.send("unbreak", address)
+        else:
+            self.breakpoints.add(address)
+            self.worker.send("break", address, condition)
+        self.mem_labels[address // 10][address % 10].config(bg=self.cell_color(address // 10, address % 10))
+
+    def toggle_watchpoint(self) -> None:
+        """
+        Add a watchpoint on a memory cell or a register, or remove it if it is
+        set and no condition is given.
+        """
+        answer = self.ask_target("Watch", "Enter a cell or a register, optionally followed by 'if CONDITION':")
+        if answer is None:
+            return
+
+        (target, condition) = answer
+        if target.isdigit() and int(target) <= 98:
+            target = int(target)
+        elif target not in M99.WATCH_REGISTERS:
+            showerror("Error", f"Can not watch {target}.", parent=self)
+            return
+
+        if target in self.watchpoints and condition is None:
+            self.watchpoints.discard(target)
+            self.worker.send("unwatch", target)
+        else:
+            self.watchpoints.add(target)
+            self.worker.send("watch", target, condition)
+        if isinstance(target, int):
+            self.mem_labels[target // 10][target % 10].config(bg=self.cell_color(target // 10, target % 10))
 
     def run_machine(self) -> None:
         """
-        Run the machine.
+        Run the machine until it shuts down or is paused.
+        The machine runs in the worker thread, which publishes its state at
+        most fps times per second.
         """
-        try:
-            self.machine.run(-1)
-        except ValueError as e:
-            showerror("Error", f"An error occurred: {e}", parent=self)
+        if self.view._shutdown:
+            return
+
+        self.started = time.perf_counter()
+        self.stopped = None
+        self.worker.send("run")
+
+    def pause(self) -> None:
+        """
+        Pause the execution started with Execute, it can be resumed with
+        Execute.
+        """
+        self.worker.send("pause")
+
+    def stop(self) -> None:
+        """
+        Stop the execution and shut the machine down.
+        """
+        self.worker.send("stop")
+
+    def reset(self) -> None:
+        """
+        Stop the execution and reset the registers.
+        """
+        self.worker.send("restart")
+
+    def clear(self) -> None:
+        """
+        Stop the execution and clear the memory.
+        """
+        self.worker.send("clear")
 
     def jump(self) -> None:
         """
@@ -320,36 +488,98 @@ class M99Interface(Frame):
         address = askinteger(
             "Jump", "Enter an address:", parent=self, minvalue=0, maxvalue=99
         )
-        self.machine.reg[3] = address
-        self.update_display()
+        if address is not None:
+            self.worker.send("jump", address)
 
     def load(self) -> None:
         """
         Load a program.
         """
+        self.pause()
         program_path = askopenfilename(
-            title="Load a program", filetypes=[("M99 Program", "*.m99")]
+            title="Load a program",
+            filetypes=[("M99 Program", "*.m99"), ("M99 Image", "*.m99i")],
         )
         if not program_path:
             return
 
-        with open(program_path, "r") as program_file:
-            program = program_file.read()
-
         try:
-            self.assembly = M99.assemble(program)
-            self.machine.load(self.assembly, 0)
-            self.machine.restart()
-            self.update_display()
+            if program_path.endswith(".m99i"):
+                with M99.Image(program_path) as image:
+                    self.assembly = image.program.tolist()
+                    self.labels = image.labels or {}
+            else:
+                with open(program_path, "r") as program_file:
+                    (self.assembly, self.labels, _) = self.cache.assemble(program_file.read())
+            if len(self.assembly) > 98:
+                raise ValueError("Program too long.")
+            self.worker.send("load", self.assembly, 0)
         except ValueError as e:
             showerror("Error", f"An error occurred:\n {e}", parent=self)
 
+    def poll(self) -> None:
+        """
+        Handle the events sent by the worker thread, then update the display
+        once with all the received states.
+        """
+        changed = False
+        try:
+            while True:
+                event = self.worker.events.get_nowait()
+                match event:
+                    case ("state", cells, registers, shutdown, executed, running):
+                        for address, value in cells:
+                            self.view.mem[address] = value
+                        self.view.reg = registers
+                        self.view._shutdown = shutdown
+                        self.executed = executed
+                        self.running = running
+                        changed = True
+                    case ("output", value):
+                        self.display_value(value)
+                    case ("input",):
+                        self.worker.send_input(self.input_value())
+                    case ("error", message):
+                        showerror("Error", f"An error occurred: {message}", parent=self)
+                    case ("stopped", stopped):
+                        self.stopped = stopped
+                        changed = True
+        except queue.Empty:
+            pass
+
+        if changed:
+            self.update_display()
+            self.update_status()
+        self.after(1000 // self.fps, self.poll)
+
+    def update_status(self) -> None:
+        """
+        Show the number of instructions executed by Execute.
+        """
+        if not self.executed:
+            self.status["text"] = ""
+            return
+
+        elapsed = time.perf_counter() - self.started
+        state = "Running" if self.running else "Stopped" if self.view._shutdown else "Paused"
+        if not self.running and self.stopped is not None:
+            if self.stopped[0] == "breakpoint":
+                state = f"Breakpoint at {self.stopped[1]}"
+            else:
+                state = f"Watchpoint {self.stopped[1]}: {self.stopped[2]} -> {self.stopped[3]}"
+        self.status["text"] = f"{state}: {self.executed} instructions"
+        if self.running:
+            self.status["text"] += f" ({self.executed / max(elapsed, 1e-6):.0f}/s)"
+
     def create_widgets(self) -> None:
         """
         Build the interface to debug the M99 machine.
         It displays registers, memory, and the stack.
         A button is provided to execute the next instruction.
         """
+        self.shown_shutdown = False
+        self.highlighted = (self.view.reg[3], self.view.reg[4])
+        self.view.changes()
         self.register_contener = self.build_register_display()
         self.register_contener.grid(row=1, column=0)
         self.memory_display = self.build_memory_display()
@@ -358,15 +588,30 @@ class M99Interface(Frame):
 
     def update_display(self) -> None:
         """
-        Update the display.
+        Update the widgets of the cells and registers changed since the last
+        update.
         """
-        self.update_register_display()
-        self.update_memory_display()
-        self.update()
+        (cells, registers) = self.view.changes()
+        self.update_shutdown_display()
+        self.update_register_display(registers)
+        self.update_memory_display(cells)
+        self.update_idletasks()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="M99 Machine debugger")
+    parser.add_argument(
+        "--fps", type=int, default=30, help="maximum number of display updates per second while executing (default: 30)"
+    )
+    parser.add_argument(
+        "--history",
+        type=int,
+        default=100000,
+        help="number of instructions executed with Step that can be undone at once (default: 100000)",
+    )
+    args = parser.parse_args()
+
     root = Tk()
     pc = M99.M99()
-    interface = M99Interface(root, pc)
+    interface = M99Interface(root, pc, args.fps, args.history)
     interface.mainloop()
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Memoization of the subroutines of M99 programs
+"""
+from collections import OrderedDict
+import M99
+
+# Locations read and written by the instructions: the memory cells are
+# numbered from 0 to 98 and the registers from REGISTER (R) to REGISTER + 5 (RA)
+REGISTER = 100
+R = REGISTER
+A = REGISTER + 1
+B = REGISTER + 2
+SB = REGISTER + 4
+RA = REGISTER + 5
+
+# Instructions whose accesses depend on SB or are checked against the stack
+# frame of the call
+PUSH = 1
+POP = 2
+RETURN = 3
+STORE = 4
+
+# Maximum number of nested calls recorded at once, the outermost ones are
+# forgotten first
+MAX_DEPTH = 64
+
+
+def accesses(handler: callable, data) -> tuple:
+    """
+    Give the locations an instruction of the decoded engine reads and writes,
+    besides the cell it is fetched from.
+
+    Args:
+        handler (callable): handler of the instruction.
+        data: operand of the handler.
+
+    Returns:
+        tuple: the locations read and written, None as the locations read if
+            the instruction can not be memoized (I/O, invalid instructions),
+            and PUSH, POP, RETURN, STORE or 0 for the instructions the stack
+            frame must be checked for.
+    """
+    if handler is M99.M99._op_lda:
+        return ((data,), (A,), 0)
+    if handler is M99.M99._op_ldb:
+        return ((data,), (B,), 0)
+    if handler is M99.M99._op_str:
+        return ((R,), (data,), STORE)
+    if handler is M99.M99._op_mov:
+        return (() if data[0] == 3 else (REGISTER + data[0],), () if data[1] == 3 else (REGISTER + data[1],), 0)
+    if handler in (M99.M99._op_add, M99.M99._op_sub, M99.M99._op_mul):
+        return ((A, B), (R,), 0)
+    if handler in (M99.M99._op_jpp, M99.M99._op_jeq, M99.M99._op_jne):
+        return ((R,), (), 0)
+    if handler is M99.M99._op_jmp:
+        return ((), (), 0)
+    if handler is M99.M99._op_cal:
+        return ((), (RA,), 0)
+    if handler is M99.M99._op_ret:
+        return ((RA,), (), RETURN)
+    if handler is M99.M99._op_psh:
+        return ((SB,) if data == 3 else (SB, REGISTER + data), (SB,), PUSH)
+    if handler is M99.M99._op_pop:
+        return ((SB,), (SB,) if data == 3 else (SB, REGISTER + data), POP)
+    return (None, (), 0)
+
+
+class Call:
+    """
+    Execution of a subroutine being recorded, from the instruction following
+    its CAL to its RET.
+    """
+
+    def __init__(self, target: int, sb: int, address: int) -> None:
+        """
+        Args:
+            target (int): address of the subroutine.
+            sb (int): SB when the subroutine was called, the subroutine can
+                only write the cells of its stack frame, from the current SB
+                to this one.
+            address (int): address the subroutine must return to.
+        """
+        self.target = target
+        self.sb = sb
+        self.address = address
+        # Value of each location read before being written
+        self.reads = {}
+        self.writes = set()
+        self.steps = 0
+        # Lowest SB reached by the call, for the stats of the replayed runs
+        self.lowest = sb
+        self.pure = True
+
+
+class Memoizer:
+    """
+    Replay the effects of the subroutines called again with the same inputs
+    instead of executing them.
+    Each call is recorded from its CAL to its RET: the locations (registers,
+    memory cells, including the instructions fetched) read before being written
+    make the key of the call, and the final values of the locations written are
+    its effects. When a subroutine is called again and the current values of
+    the locations of one of its keys match, its effects are applied and the
+    execution goes on at the return address. The update event is then emitted
+    once for the whole call.
+    Subroutines doing I/O, writing a memory cell outside their stack frame or
+    not returning to their caller are never memoized, and neither are the
+    ones calling them.
+    Like M99_profile.Profiler, the memoizer is given to M99.run which delegates
+    the whole run to it. The entries are kept over the runs, so the memoizer
+    pays off when the same program is run many times, for example on many
+    inputs.
+    """
+
+    def __init__(self, size: int = 4096) -> None:
+        """
+        Args:
+            size (int): maximum number of calls kept, the least recently used
+                ones being forgotten first.
+        """
+        self.size = size
+        self.clear()
+
+    def clear(self) -> None:
+        """
+        Forget every recorded call.
+        """
+        # (target, locations, values) -> (effects, steps, stack depth)
+        self.entries = OrderedDict()
+        # target -> {locations: number of entries}
+        self.keys = {}
+        self.impure = set()
+        self.hits = 0
+        self.misses = 0
+        self.machine = None
+        self._calls = []
+        self._end = None
+        # (handler, operand) -> locations accessed by the instruction
+        self._accesses = {}
+
+    def run(self, machine: M99.M99, max_steps: int = None) -> int:
+        """
+        Run the program loaded into the machine, memoizing its subroutines.
+        The calls being recorded go on over the runs resumed from the state
+        where the previous one stopped.
+
+        Args:
+            machine (M99.M99): machine to be run.
+            max_steps (int): maximum number of instructions to execute.
+
+        Returns:
+            int: number of executed instructions, replayed calls included.
+        """
+        if machine is not self.machine or self._end != (machine.mem, machine.reg):
+            self.machine = machine
+            self._calls = []
+        machine._code = None
+        steps = 0
+        if machine._shutdown or steps == max_steps:
+            return steps
+
+        calls = self._calls
+        mem = machine.mem
+        try:
+            while True:
+                code = machine._code
+                if code is None:
+                    code = machine._code = [M99.M99.decode(opcode) for opcode in mem]
+
+                reg = machine.reg
+                pc = reg[3]
+                handler, data = code[pc]
+                if calls:
+                    self._track(calls[-1], machine, pc, handler, data)
+                handler(machine, data)
+
+                reg = machine.reg
+                reg[3] += 1
+                count = 1
+                if handler is M99.M99._op_cal:
+                    count = self._call(machine, None if max_steps is None else max_steps - steps)
+                elif handler is M99.M99._op_ret and calls:
+                    self._return(machine)
+
+                if reg[3] >= 99:
+                    machine._shutdown = True
+
+                if machine.update_event:
+                    machine.update_event()
+
+                steps += count
+                if machine._shutdown or steps == max_steps:
+                    self._end = (mem[:], list(machine.reg))
+                    return steps
+        except Exception:
+            # The instruction raising the error was recorded but not executed
+            self._end = None
+            raise
+        finally:
+            machine._steps += steps
+
+    def _track(self, call: Call, machine: M99.M99, pc: int, handler: callable, data) -> None:
+        """
+        Record the locations read and written by an instruction of a call,
+        before it is executed.
+        """
+        call.steps += 1
+        if not call.pure:
+            return
+
+        entry = (handler, data)
+        access = self._accesses.get(entry)
+        if access is None:
+            access = self._accesses[entry] = accesses(handler, data)
+        (reads, writes, stack) = access
+        reg = machine.reg
+        if stack:
+            # PSH, POP and RET also bring R back into range, which does not
+            # depend on its value as long as it is in range
+            pure = -999 <= reg[0] <= 999
+            if stack == PUSH:
+                cell = reg[4]
+                pure = pure and 0 < cell <= call.sb
+                writes = writes + (cell,)
+                if cell - 1 < call.lowest:
+                    call.lowest = cell - 1
+            elif stack == POP:
+                # The stack must not be empty, cell 99 is the input
+                pure = pure and -1 <= reg[4] < 98
+                reads = reads + (reg[4] + 1,)
+            elif stack == STORE:
+                # Only the cells pushed on the stack and not popped yet
+                pure = reg[4] < data <= call.sb
+            if not pure:
+                call.pure = False
+        if not call.pure or reads is None:
+            call.pure = False
+            self.impure.add(call.target)
+            return
+
+        mem = machine.mem
+        known = call.reads
+        written = call.writes
+        location = pc % 99
+        if location not in written and location not in known:
+            known[location] = mem[location]
+        for location in reads:
+            if location not in written and location not in known:
+                known[location] = mem[location] if location < REGISTER else reg[location - REGISTER]
+        written.update(writes)
+
+    def _call(self, machine: M99.M99, max_steps: int = None) -> int:
+        """
+        Replay a call that was just made if its effects are known, or start
+        recording it.
+
+        Returns:
+            int: number of instructions executed by the CAL, the ones of the
+                subroutine included when it was replayed.
+        """
+        reg = machine.reg
+        target = reg[3]
+        if target in self.impure:
+            call = Call(target, reg[4], reg[5])
+            call.pure = False
+            self._push(call)
+            return 1
+
+        mem = machine.mem
+        for locations in self.keys.get(target, ()):
+            values = tuple(mem[location] if location < REGISTER else reg[location - REGISTER] for location in locations)
+            key = (target, locations, values)
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+            (effects, steps, depth) = entry
+            if max_steps is not None and steps >= max_steps:
+                break
+            self.entries.move_to_end(key)
+            self.hits += 1
+            # The pushes of the subroutine are not executed
+            lowest = reg[4] - depth
+            if lowest < machine._lowest_sb:
+                machine._lowest_sb = lowest
+
+            code = machine._code
+            for location, value in effects:
+                if location < REGISTER:
+                    mem[location] = value
+                    code[location] = M99.M99.decode(value)
+                else:
+                    reg[location - REGISTER] = value
+            reg[3] = reg[5]
+            if self._calls:
+                call = Call(target, reg[4], reg[5])
+                call.reads = dict(zip(locations, values))
+                call.writes = {location for location, _ in effects}
+                call.steps = steps
+                call.lowest = lowest
+                self._merge(self._calls[-1], call)
+            return steps + 1
+
+        self.misses += 1
+        self._push(Call(target, reg[4], reg[5]))
+        return 1
+
+    def _push(self, call: Call) -> None:
+        calls = self._calls
+        if len(calls) == MAX_DEPTH:
+            del calls[0]
+        calls.append(call)
+
+    def _return(self, machine: M99.M99) -> None:
+        """
+        Store the call that just returned and add it to its caller.
+        """
+        call = self._calls.pop()
+        reg = machine.reg
+        if reg[3] != call.address:
+            call.pure = False
+            self.impure.add(call.target)
+
+        if call.pure:
+            mem = machine.mem
+            locations = tuple(sorted(call.reads))
+            values = tuple(call.reads[location] for location in locations)
+            effects = tuple(
+                (location, mem[location] if location < REGISTER else reg[location - REGISTER])
+                for location in sorted(call.writes)
+            )
+            self._store((call.target, locations, values), (effects, call.steps, call.sb - call.lowest))
+
+        if self._calls:
+            self._merge(self._calls[-1], call)
+
+    def _merge(self, caller: Call, call: Call) -> None:
+        """
+        Add the locations read and written by a call to its caller.
+        """
+        caller.steps += call.steps
+        if call.lowest < caller.lowest:
+            caller.lowest = call.lowest
+        if not caller.pure:
+            return
+        if not call.pure or any(location < REGISTER and location > caller.sb for location in call.writes):
+            caller.pure = False
+            self.impure.add(caller.target)
+            return
+        for location, value in call.reads.items():
+            if location not in caller.writes and location not in caller.reads:
+                caller.reads[location] = value
+        caller.writes.update(call.writes)
+
+    def _store(self, key: tuple, entry: tuple) -> None:
+        entries = self.entries
+        if key in entries:
+            entries.move_to_end(key)
+            return
+        entries[key] = entry
+        (target, locations, _) = key
+        keys = self.keys.setdefault(target, {})
+        keys[locations] = keys.get(locations, 0) + 1
+        while len(entries) > self.size:
+            ((target, locations, _), _) = entries.popitem(last=False)
+            keys = self.keys[target]
+            keys[locations] -= 1
+            if not keys[locations]:
+                del keys[locations]
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per-address execution profiler for the M99 machine
+"""
+import json
+import time
+import M99
+
+
+class Profiler:
+    """
+    Record, for each memory address, the number of times its instruction was
+    executed and the time spent executing it, the number of instructions of
+    each kind and the call graph edges produced by CAL and RET.
+    The profiler runs the machine with the handlers of the decoded engine, it
+    is given to M99.run which then delegates the whole run to it, so a run
+    without profiler does not pay anything for it.
+    """
+
+    def __init__(self) -> None:
+        self.clear()
+
+    def clear(self) -> None:
+        """
+        Forget every recorded value.
+        """
+        self.counts = [0] * 99
+        self.times = [0] * 99
+        self.opcodes = {}
+        self.edges = {}
+
+    def run(self, machine: M99.M99, max_steps: int = None) -> int:
+        """
+        Run the program loaded into the machine, recording its execution.
+
+        Args:
+            machine (M99.M99): machine to be run.
+            max_steps (int): maximum number of instructions to execute.
+
+        Returns:
+            int: number of executed instructions.
+        """
+        machine._code = None
+        steps = 0
+        if machine._shutdown or steps == max_steps:
+            return steps
+
+        clock = time.perf_counter_ns
+        counts = self.counts
+        times = self.times
+        opcodes = self.opcodes
+        edges = self.edges
+        try:
+            while True:
+                code = machine._code
+                if code is None:
+                    code = machine._code = [M99.M99.decode(opcode) for opcode in machine.mem]
+
+                pc = machine.reg[3]
+                address = pc % 99
+                handler, data = code[pc]
+                opcode = machine.mem[pc]
+                start = clock()
+                try:
+                    handler(machine, data)
+                finally:
+                    times[address] += clock() - start
+                    counts[address] += 1
+                    opcodes[opcode] = opcodes.get(opcode, 0) + 1
+
+                reg = machine.reg
+                reg[3] += 1
+                if opcode == 409 or 900 <= opcode <= 999:  # RET, CAL
+                    edge = (address, reg[3])
+                    edges[edge] = edges.get(edge, 0) + 1
+
+                if reg[3] >= 99:
+                    machine._shutdown = True
+
+                if machine.update_event:
+                    machine.update_event()
+
+                steps += 1
+                if machine._shutdown or steps == max_steps:
+                    return steps
+        finally:
+            machine._steps += steps
+
+    def classes(self) -> dict[str, int]:
+        """
+        Count the executed instructions by mnemonic, invalid ones being counted
+        as DAT.
+
+        Returns:
+            dict[str, int]: number of executed instructions of each kind.
+        """
+        classes = {}
+        for opcode, count in self.opcodes.items():
+            mnemonic = M99.disassemble(opcode).split()[0]
+            classes[mnemonic] = classes.get(mnemonic, 0) + count
+        return dict(sorted(classes.items(), key=lambda item: -item[1]))
+
+    def report(self, program: list[int], labels: dict[str, int] = None, lines: list[int] = None) -> dict:
+        """
+        Build the report of the profile, mapping the addresses back to the
+        source lines and the labels of the program.
+
+        Args:
+            program (list[int]): program that was profiled.
+            labels (dict[str, int]): labels of the program.
+            lines (list[int]): source line of each instruction of the program.
+
+        Returns:
+            dict: the report, addresses being sorted by decreasing time.
+        """
+        names = sorted(((address, name) for name, address in (labels or {}).items()), reverse=True)
+
+        def locate(address: int) -> str:
+            for label_address, name in names:
+                if label_address <= address:
+                    offset = address - label_address
+                    return f"{name}+{offset}" if offset else name
+            return None
+
+        total_count = sum(self.counts)
+        total_time = sum(self.times)
+        addresses = []
+        for address in sorted(range(99), key=lambda address: -self.times[address]):
+            if not self.counts[address]:
+                continue
+            addresses.append(
+                {
+                    "address": address,
+                    "line": lines[address] if lines and address < len(lines) else None,
+                    "label": locate(address),
+                    "instruction": M99.disassemble(program[address]) if address < len(program) else None,
+                    "count": self.counts[address],
+                    "time_ns": self.times[address],
+                }
+            )
+
+        calls = [
+            {
+                "from": source,
+                "to": target,
+                "from_label": locate(source),
+                "to_label": locate(target),
+                "count": count,
+            }
+            for (source, target), count in sorted(self.edges.items(), key=lambda item: -item[1])
+        ]
+        return {
+            "steps": total_count,
+            "time_ns": total_time,
+            "addresses": addresses,
+            "classes": self.classes(),
+            "calls": calls,
+        }
+
+    def dump(self, path: str, program: list[int], labels: dict[str, int] = None, lines: list[int] = None) -> None:
+        """
+        Write the report of the profile to a JSON file.
+        """
+        with open(path, "w") as f:
+            json.dump(self.report(program, labels, lines), f, indent=2)
+
+
+def format_report(report: dict, limit: int = 20) -> str:
+    """
+    Format a report built by Profiler.report as tables.
+
+    Args:
+        report (dict): report to be formatted.
+        limit (int): maximum number of addresses and calls to show.
+
+    Returns:
+        str: the tables.
+    """
+    total_time = report["time_ns"] or 1
+    rows = [
+        f"{report['steps']} instructions executed in {report['time_ns'] / 1e6:.3f} ms",
+        "",
+        f"{'Addr':>4} {'Line':>5} {'Label':<28} {'Instruction':<11} {'Count':>10} {'Time (ms)':>10} {'%':>6}",
+    ]
+    for entry in report["addresses"][:limit]:
+        rows.append(
+            f"{entry['address']:>4} {entry['line'] or '':>5} {entry['label'] or '':<28} "
+            f"{entry['instruction'] or '':<11} {entry['count']:>10} "
+            f"{entry['time_ns'] / 1e6:>10.3f} {100 * entry['time_ns'] / total_time:>6.2f}"
+        )
+
+    rows += ["", f"{'Instruction':<11} {'Count':>10} {'%':>6}"]
+    for mnemonic, count in report["classes"].items():
+        rows.append(f"{mnemonic:<11} {count:>10} {100 * count / (report['steps'] or 1):>6.2f}")
+
+    if report["calls"]:
+        rows += ["", f"{'From':<33} {'To':<33} {'Count':>10}"]
+        for call in report["calls"][:limit]:
+            source = f"{call['from']:>2} {call['from_label'] or ''}"
+            target = f"{call['to']:>2} {call['to_label'] or ''}"
+            rows.append(f"{source:<33} {target:<33} {call['count']:>10}")
+    return "\n".join(rows)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Binary execution traces of the M99 machine
+"""
+import sys
+import mmap
+import struct
+import argparse
+import numpy as np
+import M99
+
+# Trace format: header followed by one fixed-width little-endian record per
+# executed instruction
+TRACE_MAGIC = b"M99T"
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct("<4sHH")  # magic, version, record size
+# Address of the instruction, cell written by it (NO_CELL if none), opcode,
+# R, A, B, SB and RA after execution, kind of I/O and value read or written
+TRACE_RECORD = struct.Struct("<BBhiiiiiBi")
+TRACE_DTYPE = np.dtype(
+    [
+        ("pc", "u1"),
+        ("cell", "u1"),
+        ("opcode", "<i2"),
+        ("r", "<i4"),
+        ("a", "<i4"),
+        ("b", "<i4"),
+        ("sb", "<i4"),
+        ("ra", "<i4"),
+        ("io", "u1"),
+        ("value", "<i4"),
+    ]
+)
+NO_CELL = 255
+IO_NONE = 0
+IO_INPUT = 1
+IO_OUTPUT = 2
+
+
+class Tracer:
+    """
+    Write one record per executed instruction to a trace file.
+    Like M99_profile.Profiler, the tracer is given to M99.run which delegates
+    the whole run to it, so a run without tracer does not pay anything for it.
+    The records are packed into a fixed-size buffer written to the file when
+    it is full, the tracer must be closed (or used as a context manager) to
+    write the last ones.
+    """
+
+    def __init__(self, path: str, buffer_records: int = 1 << 14) -> None:
+        """
+        Args:
+            path (str): path of the trace file, replaced if it exists.
+            buffer_records (int): number of records buffered before writing.
+        """
+        self.file = open(path, "wb")
+        self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD.size))
+        self.buffer = bytearray(TRACE_RECORD.size * buffer_records)
+        self.offset = 0
+        self.records = 0
+
+    def flush(self) -> None:
+        """
+        Write the buffered records to the file.
+        """
+        self.file.write(memoryview(self.buffer)[: self.offset])
+        self.offset = 0
+        self.file.flush()
+
+    def close(self) -> None:
+        """
+        Write the buffered records and close the file.
+        """
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self) -> "Tracer":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def run(self, machine: M99.M99, max_steps: int = None) -> int:
+        """
+        Run the program loaded into the machine, tracing its execution.
+        The instruction raising an error is not recorded.
+
+        Args:
+            machine (M99.M99): machine to be run.
+            max_steps (int): maximum number of instructions to execute.
+
+        Returns:
+            int: number of executed instructions.
+        """
+        machine._code = None
+        steps = 0
+        if machine._shutdown or steps == max_steps:
+            return steps
+
+        # The I/O channels are wrapped to record the values they carry
+        io = [IO_NONE, 0]
+        read_value = machine.read_value
+        write_value = machine.write_value
+
+        def traced_read() -> int:
+            value = read_value()
+            io[0] = IO_INPUT
+            # The machine stores the value brought back into range
+            io[1] = M99.M99.manage_overflow(value) if value is not None else 0
+            return value
+
+        def traced_write(value: int) -> None:
+            io[0] = IO_OUTPUT
+            io[1] = value
+            write_value(value)
+
+        machine.read_value = traced_read
+        machine.write_value = traced_write
+        pack_into = TRACE_RECORD.pack_into
+        size = TRACE_RECORD.size
+        buffer = self.buffer
+        try:
+            while True:
+                code = machine._code
+                if code is None:
+                    code = machine._code = [M99.M99.decode(opcode) for opcode in machine.mem]
+
+                reg = machine.reg
+                pc = reg[3]
+                handler, data = code[pc]
+                opcode = machine.mem[pc]
+                # STR and PSH are the only instructions writing in the memory
+                cell = NO_CELL
+                if 0 <= opcode <= 98:
+                    cell = opcode
+                elif 480 <= opcode <= 485 and 0 < reg[4] < 99:
+                    cell = reg[4]
+                io[0] = IO_NONE
+                handler(machine, data)
+
+                reg = machine.reg
+                reg[3] += 1
+                if reg[3] >= 99:
+                    machine._shutdown = True
+
+                # A negative PC executes the cell counted from the end of the memory
+                pack_into(buffer, self.offset, pc % 99, cell, opcode, reg[0], reg[1], reg[2], reg[4], reg[5], io[0], io[1])
+                self.offset += size
+                self.records += 1
+                if self.offset == len(buffer):
+                    self.flush()
+
+                if machine.update_event:
+                    machine.update_event()
+
+                steps += 1
+                if machine._shutdown or steps == max_steps:
+                    return steps
+        finally:
+            machine.read_value = read_value
+            machine.write_value = write_value
+            machine._steps += steps
+
+
+class Trace:
+    """
+    Trace file written by Tracer, memory-mapped and viewed as a NumPy
+    structured array of TRACE_DTYPE records, so that it can be filtered
+    without reading it into Python objects. The index of a record is the
+    number of the instruction in the run.
+    close must be called (or the trace used as a context manager) before the
+    file is released, the arrays returned by the filters are copies and stay
+    valid afterwards.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Args:
+            path (str): path of the trace file.
+        """
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, size) = TRACE_HEADER.unpack_from(self._mmap)
+        except struct.error:
+            self._mmap.close()
+            raise ValueError("Invalid trace.")
+        if magic != TRACE_MAGIC or version != TRACE_VERSION or size != TRACE_DTYPE.itemsize:
+            self._mmap.close()
+            raise ValueError("Invalid trace.")
+
+        count = (len(self._mmap) - TRACE_HEADER.size) // size
+        self.records = np.frombuffer(self._mmap, TRACE_DTYPE, count, TRACE_HEADER.size)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def at(self, pc: int) -> np.ndarray:
+        """
+        Indices of the instructions executed at an address.
+        """
+        return np.flatnonzero(self.records["pc"] == pc)
+
+    def writes(self, cell: int) -> np.ndarray:
+        """
+        Indices of the instructions writing a memory cell.
+        """
+        return np.flatnonzero(self.records["cell"] == cell)
+
+    def io(self, kind: int) -> np.ndarray:
+        """
+        Indices of the instructions reading (IO_INPUT) or writing (IO_OUTPUT)
+        a value.
+        """
+        return np.flatnonzero(self.records["io"] == kind)
+
+    def close(self) -> None:
+        """
+        Release the file of the trace.
+        """
+        self.records = None
+        self._mmap.close()
+
+    def __enter__(self) -> "Trace":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+def format_records(records: np.ndarray, indices: np.ndarray) -> str:
+    """
+    Format records of a trace as a table.
+
+    Args:
+        records (np.ndarray): records of the trace.
+        indices (np.ndarray): indices of the records to show.
+
+    Returns:
+        str: the table.
+    """
+    rows = [
+        f"{'Step':>10} {'PC':>3} {'Instruction':<11} {'R':>5} {'A':>5} {'B':>5} {'SB':>5} {'RA':>5} {'Cell':>4} {'I/O':>8}"
+    ]
+    for index in indices:
+        record = records[index]
+        cell = "" if record["cell"] == NO_CELL else record["cell"]
+        io = {IO_NONE: "", IO_INPUT: f"in {record['value']}", IO_OUTPUT: f"out {record['value']}"}[record["io"]]
+        rows.append(
+            f"{index:>10} {record['pc']:>3} {M99.disassemble(int(record['opcode'])):<11} "
+            f"{record['r']:>5} {record['a']:>5} {record['b']:>5} {record['sb']:>5} {record['ra']:>5} "
+            f"{cell:>4} {io:>8}"
+        )
+    return "\n".join(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="M99 execution trace viewer")
+    parser.add_argument("trace", help="trace file written by M99.py --trace")
+    parser.add_argument("--pc", type=int, help="show the instructions executed at this address")
+    parser.add_argument("--cell", type=int, help="show the instructions writing this memory cell")
+    parser.add_argument("--io", action="store_true", help="show the instructions reading or writing a value")
+    parser.add_argument("-n", "--limit", type=int, default=50, help="maximum number of records shown (default: 50)")
+
+    args = parser.parse_args()
+    try:
+        trace = Trace(args.trace)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+
+    with trace:
+        mask = np.ones(len(trace), dtype=bool)
+        if args.pc is not None:
+            mask &= trace.records["pc"] == args.pc
+        if args.cell is not None:
+            mask &= trace.records["cell"] == args.cell
+        if args.io:
+            mask &= trace.records["io"] != IO_NONE
+        indices = np.flatnonzero(mask)
+        print(f"{len(indices)} of {len(trace)} instructions")
+        print(format_records(trace.records, indices[: args.limit]))
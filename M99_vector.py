@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Vectorized M99 machines, running many instances of the same program in lockstep
+"""
+from array import array
+import numpy as np
+import M99
+
+
+def manage_overflow(values: np.ndarray) -> np.ndarray:
+    """
+    Vectorized version of M99.manage_overflow.
+    Cycling the value by 1999 until it is in [-999, 999] is the same as taking
+    the only value of this range congruent to it modulo 1999.
+
+    Args:
+        values (np.ndarray): values to be managed.
+
+    Returns:
+        np.ndarray: managed values.
+    """
+    return (values + 999) % 1999 - 999
+
+
+class BatchM99:
+    """
+    Struct of arrays version of the M99 machine.
+    The registers are stored in a (N, 6) array and the memory in a (N, 99) array.
+    Each machine reads its values from its own input queue and writes them to
+    its own output list instead of calling read_value and write_value.
+    A machine stops when it shuts down, like M99._shutdown, or when its
+    instruction raises, the exception is then stored in errors.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.mem = np.zeros((size, 99), dtype=np.int64)
+        self.set_inputs([[]] * size)
+        self.restart()
+
+    def restart(self) -> None:
+        self.reg = np.zeros((self.size, 6), dtype=np.int64)
+        self.reg[:, 4] = 98
+        self.shutdown = np.zeros(self.size, dtype=bool)
+        self.failed = np.zeros(self.size, dtype=bool)
+        self.errors = [None] * self.size
+        self.outputs = [[] for _ in range(self.size)]
+        self.steps = np.zeros(self.size, dtype=np.int64)
+        self.input_pos = np.zeros(self.size, dtype=np.int64)
+
+    @property
+    def halted(self) -> np.ndarray:
+        """
+        Mask of the machines which will not execute any other instruction.
+        """
+        return self.shutdown | self.failed
+
+    def set_inputs(self, inputs: list[list[int]]) -> None:
+        """
+        Set the input queue of each machine.
+        Reading a value once the queue is empty behaves like read_value
+        returning None: the machine shuts down with an "Invalid input." error.
+
+        Args:
+            inputs (list[list[int]]): values to be read by each machine.
+        """
+        if len(inputs) != self.size:
+            raise ValueError("Expected one input queue per machine.")
+
+        width = max((len(values) for values in inputs), default=0)
+        self._inputs = np.zeros((self.size, width + 1), dtype=np.int64)
+        self._input_len = np.zeros(self.size, dtype=np.int64)
+        for i, values in enumerate(inputs):
+            self._inputs[i, : len(values)] = values
+            self._input_len[i] = len(values)
+        self.input_pos = np.zeros(self.size, dtype=np.int64)
+
+    def load(self, program: list[int], offset: int = 0) -> None:
+        """
+        Load a program into every machine.
+
+        Args:
+            program (list[int]): program to be loaded, or one program per machine
+                as a (N, len) array.
+            offset (int): base memory address to load the program into.
+        """
+        program = np.asarray(program, dtype=np.int64)
+        if program.shape[-1] + offset > 98:
+            raise ValueError("Program too long.")
+
+        self.mem[:, offset : program.shape[-1] + offset] = program
+
+    def clear(self) -> None:
+        """
+        Clear the memory of every machine.
+        """
+        self.mem[:] = 0
+
+    def machine(self, index: int) -> M99.M99:
+        """
+        Build a M99 machine with the state of one of the machines.
+
+        Args:
+            index (int): index of the machine.
+
+        Returns:
+            M99.M99: a copy of the machine.
+        """
+        machine = M99.M99()
+        machine.mem = array("h", self.mem[index].tolist())
+        machine.reg = self.reg[index].tolist()
+        machine._shutdown = bool(self.shutdown[index])
+        return machine
+
+    def _fail(self, machines: np.ndarray, error: Exception) -> None:
+        self.failed[machines] = True
+        for machine in machines:
+            self.errors[machine] = type(error)(*error.args)
+
+    def _read(self, machines: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Read a value from the input queue of the given machines.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: values read and mask of the machines
+                that had a value to read.
+        """
+        pos = self.input_pos[machines]
+        available = pos < self._input_len[machines]
+        values = manage_overflow(self._inputs[machines, pos])
+        self.input_pos[machines[available]] += 1
+
+        empty = machines[~available]
+        self.shutdown[empty] = True
+        self._fail(empty, ValueError("Invalid input."))
+        return (values, available)
+
+    def _write(self, machines: np.ndarray, values: np.ndarray) -> None:
+        for machine, value in zip(machines.tolist(), values.tolist()):
+            self.outputs[machine].append(value)
+
+    def step(self) -> None:
+        """
+        Execute the current instruction of every running machine.
+        """
+        machines = np.flatnonzero(~(self.shutdown | self.failed))
+        if machines.size == 0:
+            return
+
+        reg = self.reg[machines]
+        ok = np.ones(machines.size, dtype=bool)
+
+        def fail(mask: np.ndarray, error: Exception) -> None:
+            ok[mask] = False
+            self._fail(machines[mask], error)
+
+        pc = reg[:, 3]
+        fail((pc >= 99) | (pc < -99), IndexError("list index out of range"))
+        opcode = np.zeros(machines.size, dtype=np.int64)
+        opcode[ok] = self.mem[machines[ok], pc[ok]]
+        invalid = ok & ((opcode > 999) | (opcode < 0))
+        fail(invalid, ValueError("Opcode must be a 3-digit integer."))
+
+        data = opcode % 100
+        identifier = opcode // 100
+
+        # STR
+        rows = np.flatnonzero(ok & (identifier == 0))
+        if rows.size:
+            value = manage_overflow(reg[rows, 0])
+            io = data[rows] == 99
+            self._write(machines[rows[io]], value[io])
+            self.mem[machines[rows[~io]], data[rows[~io]]] = value[~io]
+
+        # LDA, LDB
+        for target in (1, 2):
+            rows = np.flatnonzero(ok & (identifier == target))
+            if rows.size:
+                io = data[rows] == 99
+                memory = rows[~io]
+                reg[memory, target] = self.mem[machines[memory], data[memory]]
+                rows = rows[io]
+                values, available = self._read(machines[rows])
+                reg[rows[available], target] = values[available]
+                ok[rows[~available]] = False
+
+        # MOV
+        rows = np.flatnonzero(ok & (identifier == 3))
+        if rows.size:
+            source = data[rows] // 10
+            target = data[rows] % 10
+            fail(rows[source > 5], IndexError("list index out of range"))
+            fail(
+                rows[(source <= 5) & (target > 5)],
+                IndexError("list assignment index out of range"),
+            )
+            valid = (source <= 5) & (target <= 5)
+            rows = rows[valid]
+            reg[rows, target[valid]] = reg[rows, source[valid]]
+
+        # ADD, SUB, MUL, PSH, POP, RET...
+        rows = np.flatnonzero(ok & (identifier == 4))
+        if rows.size:
+            operation = data[rows]
+            for code, operator in ((0, np.add), (1, np.subtract), (2, np.multiply)):
+                arithmetic = rows[operation == code]
+                reg[arithmetic, 0] = operator(reg[arithmetic, 1], reg[arithmetic, 2])
+            ret = rows[operation == 9]
+            reg[ret, 3] = reg[ret, 5] - 1
+            invalid = (operation > 2) & (operation < 80) & (operation != 9)
+            fail(rows[invalid], ValueError("Invalid register operation."))
+            for push in (True, False):
+                stack = rows[operation // 10 == (8 if push else 9)]
+                self._stack_op(machines, reg, stack, data[stack] % 10, fail, push)
+            rows = rows[ok[rows]]
+            reg[rows, 0] = manage_overflow(reg[rows, 0])
+
+        # JMP
+        rows = np.flatnonzero(ok & (identifier == 5))
+        reg[rows, 3] = data[rows] - 1
+
+        # JPP
+        rows = np.flatnonzero(ok & (identifier == 6) & (reg[:, 0] > 0))
+        reg[rows, 3] = data[rows] - 1
+
+        # JEQ, JNE
+        rows = np.flatnonzero(ok & (identifier == 7) & (reg[:, 0] == data))
+        reg[rows, 3] += 1
+        rows = np.flatnonzero(ok & (identifier == 8) & (reg[:, 0] != data))
+        reg[rows, 3] += 1
+
+        # CAL
+        rows = np.flatnonzero(ok & (identifier == 9))
+        reg[rows, 5] = reg[rows, 3] + 1
+        reg[rows, 3] = data[rows] - 1
+
+        reg[ok, 3] += 1
+        self.steps[machines[ok]] += 1
+        self.shutdown[machines[ok & (reg[:, 3] >= 99)]] = True
+        self.reg[machines] = reg
+
+    def _stack_op(
+        self,
+        machines: np.ndarray,
+        reg: np.ndarray,
+        rows: np.ndarray,
+        source: np.ndarray,
+        fail: callable,
+        push: bool,
+    ) -> None:
+        """
+        Execute PSH or POP for the given rows, checking the errors in the same
+        order as M99.stack_op.
+
+        Args:
+            machines (np.ndarray): indexes of the machines executing the step.
+            reg (np.ndarray): registers of these machines.
+            rows (np.ndarray): rows of reg executing the stack operation.
+            source (np.ndarray): register id of the operation of each row.
+            fail (callable): callback marking rows as failed.
+            push (bool): execute PSH if True, POP otherwise.
+        """
+        if rows.size == 0:
+            return
+
+        if push:
+            overflow = reg[rows, 4] <= 0
+            fail(rows[overflow], ValueError("Stack overflow"))
+            fail(rows[~overflow & (source > 5)], IndexError("list index out of range"))
+            valid = ~overflow & (source <= 5)
+            rows, source = rows[valid], source[valid]
+            address = reg[rows, 4]
+            fail(rows[address > 99], ValueError("Memory cell index out of range."))
+            valid = address <= 99
+            rows, source, address = rows[valid], source[valid], address[valid]
+            value = manage_overflow(reg[rows, source])
+            io = address == 99
+            self._write(machines[rows[io]], value[io])
+            self.mem[machines[rows[~io]], address[~io]] = value[~io]
+            reg[rows, 4] -= 1
+        else:
+            empty = reg[rows, 4] >= 98
+            fail(rows[empty], ValueError("Stack is empty."))
+            rows, source = rows[~empty], source[~empty]
+            reg[rows, 4] += 1
+            address = reg[rows, 4]
+            fail(rows[address < 0], ValueError("Memory cell index out of range."))
+            valid = address >= 0
+            rows, source, address = rows[valid], source[valid], address[valid]
+            fail(rows[source > 5], IndexError("list assignment index out of range"))
+            valid = source <= 5
+            rows, source, address = rows[valid], source[valid], address[valid]
+            reg[rows, source] = self.mem[machines[rows], address]
+
+    def run(self, max_steps: int = None) -> int:
+        """
+        Run every machine until all of them are halted.
+
+        Args:
+            max_steps (int): maximum number of lockstep steps to execute.
+
+        Returns:
+            int: number of lockstep steps executed.
+        """
+        steps = 0
+        while not self.halted.all():
+            if max_steps is not None and steps >= max_steps:
+                break
+            self.step()
+            steps += 1
+        return steps
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Run a M99 machine in a background thread, controlled through queues
+"""
+import time
+import queue
+import threading
+import M99
+
+
+class MachineWorker(threading.Thread):
+    """
+    Thread owning a M99 machine.
+    Commands are sent with send and executed in order by the thread. The
+    thread reports what happens on the events queue, as tuples whose first
+    item is the kind of event:
+
+    - ("state", cells, registers, shutdown, executed, running): the machine
+      changed, cells being the (address, value) pairs of the memory cells
+      modified since the previous state event.
+    - ("output", value): the program wrote a value.
+    - ("input",): the program waits for a value, given with send_input.
+    - ("error", message): an instruction raised an error, the run is stopped.
+    - ("stopped", reason): a breakpoint or a watchpoint stopped the run,
+      reason being the value of M99.stopped.
+
+    While running, the machine executes instructions for one frame then
+    publishes its state, so at most fps state events are sent per second.
+    The execution is recorded in a M99.History so that it can be stepped
+    backward.
+    """
+
+    def __init__(self, machine: M99.M99, fps: int = 30, history: int = 100000) -> None:
+        super().__init__(daemon=True)
+        self.machine = machine
+        self.period = 1 / fps
+        self.commands = queue.Queue()
+        self.events = queue.Queue()
+        self.inputs = queue.Queue()
+        self.running = False
+        self.executed = 0
+        self.chunk = 1000
+        machine.update_event = None
+        machine.read_value = self.read_value
+        machine.write_value = self.write_value
+        self.history = M99.History(machine, size=history)
+
+    def send(self, command: str, *args) -> None:
+        """
+        Send a command to the thread.
+
+        Args:
+            command (str): one of run, pause, stop, step, back, back_to,
+                restart, clear, load, jump, break, unbreak, watch, unwatch and
+                quit.
+            *args: arguments of the command, the program for load, the
+                address for jump and back_to, the address and the condition
+                for break, the target and the condition for watch.
+        """
+        self.commands.put((command, args))
+
+    def send_input(self, value: int) -> None:
+        """
+        Answer an input event.
+
+        Args:
+            value (int): the value read by the program, None for no value.
+        """
+        self.inputs.put(value)
+
+    def read_value(self) -> int:
+        self.events.put(("input",))
+        return self.inputs.get()
+
+    def write_value(self, value: int) -> None:
+        self.events.put(("output", value))
+
+    def publish(self, full: bool = False) -> None:
+        """
+        Send the changes of the machine since the previous state event.
+
+        Args:
+            full (bool): send every memory cell.
+        """
+        (cells, _) = self.machine.changes()
+        if full:
+            cells = range(99)
+        mem = self.machine.mem
+        self.events.put(
+            (
+                "state",
+                [(address, mem[address]) for address in cells],
+                list(self.machine.reg),
+                self.machine._shutdown,
+                self.executed,
+                self.running,
+            )
+        )
+
+    def execute(self, command: str, args: tuple) -> bool:
+        """
+        Execute a command.
+
+        Returns:
+            bool: False if the thread must exit.
+        """
+        machine = self.machine
+        match command:
+            case "run":
+                if not self.running:
+                    self.running = True
+                    self.executed = 0
+            case "pause":
+                self.running = False
+            case "stop":
+                self.running = False
+                machine.shutdown()
+            case "step":
+                self.running = False
+                self.history.step()
+            case "back":
+                self.running = False
+                if not self.history.step_back():
+                    raise ValueError("No more history.")
+            case "back_to":
+                self.running = False
+                if not self.history.back_to(*args):
+                    raise ValueError(f"Address {args[0]} not found in the history.")
+            case "restart":
+                self.running = False
+                machine.restart()
+                self.history.clear()
+            case "clear":
+                self.running = False
+                machine.clear()
+                self.history.clear()
+            case "load":
+                self.running = False
+                machine.load(*args)
+                machine.restart()
+                self.history.clear()
+            case "jump":
+                machine.reg[3] = args[0]
+                self.history.clear()
+            case "break":
+                machine.add_breakpoint(*args)
+            case "unbreak":
+                machine.remove_breakpoint(*args)
+            case "watch":
+                machine.add_watchpoint(*args)
+            case "unwatch":
+                machine.remove_watchpoint(*args)
+            case "quit":
+                return False
+            case _:
+                raise ValueError(f"Unknown command {command}.")
+        return True
+
+    def run_frame(self) -> None:
+        """
+        Execute instructions for one frame, stopping early if a command is
+        received.
+        """
+        deadline = time.perf_counter() + self.period
+        while not self.machine._shutdown and self.commands.empty():
+            start = time.perf_counter()
+            self.executed += self.history.run(engine="decoded", max_steps=self.chunk)
+            now = time.perf_counter()
+            # Keep the chunks around 5 ms so that commands are handled quickly
+            self.chunk = max(100, min(1 << 16, int(self.chunk * 0.005 / max(now - start, 1e-6))))
+            if now >= deadline or self.machine.stopped is not None:
+                break
+
+        if self.machine.stopped is not None:
+            self.running = False
+            self.events.put(("stopped", self.machine.stopped))
+        if self.machine._shutdown:
+            self.running = False
+
+    def run(self) -> None:
+        """
+        Body of the thread: execute the commands, and run the machine while
+        it is running.
+        """
+        self.publish(full=True)
+        while True:
+            try:
+                # Wait for a command unless the machine is running
+                (command, args) = self.commands.get(block=not self.running)
+                if not self.execute(command, args):
+                    return
+            except queue.Empty:
+                pass
+            # Invalid register ids raise IndexError, like with M99.step
+            except (ValueError, IndexError) as e:
+                self.running = False
+                self.events.put(("error", str(e)))
+
+            if self.running:
+                try:
+                    self.run_frame()
+                except (ValueError, IndexError) as e:
+                    self.running = False
+                    self.events.put(("error", str(e)))
+
+            if self.running or self.commands.empty():
+                self.publish()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the M99 interpreter, assembler and command line startup
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import itertools
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import M99
+
+# Workload format: name -> (program path relative to the repository, inputs)
+WORKLOADS = {
+    "nth-prime": ("exemples/nth-prime.m99", [300]),
+    "stack": ("benchmarks/programs/stack.m99", [999]),
+    "loop": ("benchmarks/programs/loop.m99", [200]),
+    "selfmod": ("benchmarks/programs/selfmod.m99", [999]),
+}
+
+
+def count_steps(program: list[int], inputs: list[int]) -> int:
+    """
+    Count the instructions executed by a program with the reference interpreter.
+
+    Args:
+        program (list[int]): assembled program.
+        inputs (list[int]): values read by the program.
+
+    Returns:
+        int: number of executed instructions.
+    """
+    machine = M99.M99()
+    machine.read_value = M99.IterableInput(inputs)
+    machine.write_value = M99.ListOutput()
+    counter = itertools.count()
+    machine.load(program)
+    machine.after_exec(counter.__next__)
+    machine.run(engine="step")
+    return next(counter)
+
+
+def best_time(function: callable, repeat: int, min_time: float) -> float:
+    """
+    Time a function, calling it enough times for each sample to last at least
+    min_time seconds.
+
+    Args:
+        function (callable): function to be timed.
+        repeat (int): number of samples.
+        min_time (float): minimum duration of a sample in seconds.
+
+    Returns:
+        float: best time of a single call in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            function()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        if best is None or elapsed / calls < best:
+            best = elapsed / calls
+    return best
+
+
+def bench_run(name: str, engine: str, repeat: int, min_time: float) -> dict:
+    """
+    Measure the steady state instructions per second of M99.run on a workload.
+    The machine is built before the timed region, only load and run are timed.
+    """
+    (path, inputs) = WORKLOADS[name]
+    with open(os.path.join(ROOT, path), "r") as f:
+        program = M99.assemble(f.read())
+    steps = count_steps(program, inputs)
+
+    def run() -> None:
+        machine.read_value = M99.IterableInput(inputs)
+        machine.load(program)
+        machine.restart()
+        machine.run(engine=engine)
+
+    machine = M99.M99()
+    machine.write_value = M99.ListOutput()
+    seconds = best_time(run, repeat, min_time)
+    return {"value": steps / seconds, "unit": "instructions/s", "higher_is_better": True}
+
+
+def generate_source(lines: int, seed: int = 0) -> str:
+    """
+    Generate a valid M99 source with the given number of instruction lines,
+    with labels, comments and label references.
+
+    Args:
+        lines (int): number of instructions.
+        seed (int): seed of the generator.
+
+    Returns:
+        str: the source.
+    """
+    def label(index: int) -> str:
+        # Labels can not contain most digits, number them with letters instead
+        name = ""
+        while True:
+            index, digit = divmod(index, 26)
+            name += chr(ord("a") + digit)
+            if not index:
+                return f"label-{name}"
+
+    generator = random.Random(seed)
+    registers = ("R", "A", "B", "PC", "SB", "RA")
+    source = []
+    for i in range(lines):
+        if i % 8 == 0:
+            source.append(f":{label(i // 8)}")
+        mnemonic = generator.choice(list(M99.INSTRUCTIONS))
+        match M99.INSTRUCTIONS[mnemonic][1]:
+            case None:
+                line = mnemonic
+            case "address":
+                if generator.random() < 0.5:
+                    line = f"{mnemonic} @{label(generator.randrange(lines // 8))}"
+                else:
+                    line = f"{mnemonic} {generator.randrange(100)}"
+            case "value":
+                line = f"{mnemonic} {generator.randrange(1000)}"
+            case "register":
+                line = f"{mnemonic} {generator.choice(registers)}"
+            case "registers":
+                line = f"{mnemonic} {generator.choice(registers)} {generator.choice(registers)}"
+        if generator.random() < 0.25:
+            line += " # comment"
+        source.append("\t" + line)
+    return "\n".join(source)
+
+
+def bench_assembler(lines: int, repeat: int, min_time: float) -> dict:
+    """
+    Measure the number of source lines assembled per second.
+    """
+    source = generate_source(lines)
+    seconds = best_time(lambda: M99.assemble_program(source), repeat, min_time)
+    return {"value": lines / seconds, "unit": "lines/s", "higher_is_better": True}
+
+
+def bench_startup(repeat: int) -> dict:
+    """
+    Measure the time taken by M99.py to assemble and run a tiny program.
+    """
+    command = [
+        sys.executable,
+        os.path.join(ROOT, "M99.py"),
+        os.path.join(ROOT, "exemples", "add.m99"),
+        "--no-cache",
+        "-i",
+        "1",
+        "-i",
+        "2",
+    ]
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return {"value": min(times) * 1000, "unit": "ms", "higher_is_better": False}
+
+
+def run_benchmarks(
+    engines: list[str], workloads: list[str], repeat: int, min_time: float, lines: int
+) -> dict:
+    """
+    Run every benchmark and gather the results.
+
+    Returns:
+        dict: the results, keyed by benchmark name.
+    """
+    results = {}
+    for name in workloads:
+        for engine in engines:
+            key = f"run/{name}/{engine}"
+            results[key] = bench_run(name, engine, repeat, min_time)
+            print(f"{key}: {results[key]['value']:.0f} {results[key]['unit']}", file=sys.stderr)
+
+    results["assembler"] = bench_assembler(lines, repeat, min_time)
+    print(f"assembler: {results['assembler']['value']:.0f} lines/s", file=sys.stderr)
+    results["startup"] = bench_startup(repeat)
+    print(f"startup: {results['startup']['value']:.1f} ms", file=sys.stderr)
+    return results
+
+
+def compare(base: dict, new: dict, threshold: float) -> list[str]:
+    """
+    Compare two result files and print the change of each benchmark.
+
+    Args:
+        base (dict): reference results.
+        new (dict): results to be checked.
+        threshold (float): relative slowdown, in percent, counted as a regression.
+
+    Returns:
+        list[str]: the benchmarks that regressed.
+    """
+    regressions = []
+    print(f"{'Benchmark':<28} {'Base':>14} {'New':>14} {'Change':>8}")
+    for key, result in new["results"].items():
+        if key not in base["results"]:
+            continue
+        before = base["results"][key]["value"]
+        after = result["value"]
+        # Positive changes are always improvements
+        change = (after - before) / before * 100
+        if not result["higher_is_better"]:
+            change = -change
+        flag = ""
+        if change < -threshold:
+            flag = " REGRESSION"
+            regressions.append(key)
+        print(f"{key:<28} {before:>14.1f} {after:>14.1f} {change:>+7.1f}%{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the M99 interpreter, assembler and startup",
+        epilog="Error codes: 1: a benchmark regressed beyond the threshold",
+    )
+    parser.add_argument("-o", "--output", help="file receiving the results as JSON")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("BASE", "NEW"), help="compare two result files instead of running"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=5.0, help="slowdown in percent counted as a regression (default: 5)"
+    )
+    parser.add_argument(
+        "--engine", choices=M99.ENGINES, nargs="+", default=list(M99.ENGINES), help="engines to benchmark"
+    )
+    parser.add_argument(
+        "--workload", choices=list(WORKLOADS), nargs="+", default=list(WORKLOADS), help="workloads to run"
+    )
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="number of samples of each benchmark")
+    parser.add_argument(
+        "--min-time", type=float, default=0.2, help="minimum duration of a sample in seconds"
+    )
+    parser.add_argument(
+        "--lines", type=int, default=20000, help="number of lines of the generated assembler source"
+    )
+
+    args = parser.parse_args()
+    if args.compare:
+        with open(args.compare[0], "r") as f:
+            base = json.load(f)
+        with open(args.compare[1], "r") as f:
+            new = json.load(f)
+        if compare(base, new, args.threshold):
+            sys.exit(1)
+        sys.exit(0)
+
+    results = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": run_benchmarks(args.engine, args.workload, args.repeat, args.min_time, args.lines),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True)
+def cache_directory(tmp_path, monkeypatch):
+    # The assembly cache must not write into the home directory of the user
+    monkeypatch.setenv("M99_CACHE_DIR", str(tmp_path / "cache"))
@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+import M99_analysis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def analyze(path):
+    with open(os.path.join(ROOT, path)) as f:
+        return M99_analysis.analyze_source(f.read())
+
+
+@pytest.mark.parametrize(
+    "path",
+    [
+        "exemples/add.m99",
+        "exemples/labels.m99",
+        "exemples/nth-prime.m99",
+        "benchmarks/programs/stack.m99",
+        "benchmarks/programs/loop.m99",
+    ],
+)
+def test_examples_have_no_findings(path):
+    analysis = analyze(path)
+    assert analysis.complete
+    assert analysis.findings == []
+    assert not analysis.self_modifying
+
+
+def test_self_modifying_program():
+    analysis = analyze("benchmarks/programs/selfmod.m99")
+    assert analysis.self_modifying
+    assert analysis.errors == []
+    # The instruction at 5 writes the cell executed at 8, the SUB it copies
+    # from 13 is never executed
+    assert [(finding.address, finding.kind) for finding in analysis.findings] == [
+        (8, "self-modifying"),
+        (13, "unreachable"),
+    ]
+
+
+def test_call_graph():
+    analysis = analyze("exemples/labels.m99")
+    assert analysis.calls == {6: {11}, 7: {11}}
+    # The subroutine returns to both of its callers
+    assert analysis.successors[16] == {7, 8}
+    assert analysis.successors[14] == {15, 17}
+    assert analysis.successors[10] == {M99_analysis.HALT}
+    assert "16 RET          -> 7, 8" in analysis.format_graph().split("\n")
+
+
+@pytest.mark.parametrize(
+    "code, finding",
+    [
+        ("\tPOP A\n\tJMP 99\n", (0, "error", "underflow")),
+        ("\tLDA 99\n\tJMP @data\n:data\n\tDAT 5\n", (2, "error", "data")),
+        ("\tLDA 99\n\tMOV A R\n\tSTR 99\n", (3, "error", "data")),
+        ("\tLDA 99\n\tMOV A R\n\tJMP 99\n\tLDA 1\n", (3, "warning", "unreachable")),
+    ],
+)
+def test_findings(code, finding):
+    analysis = M99_analysis.analyze_source(code)
+    assert finding in [(found.address, found.severity, found.kind) for found in analysis.findings]
+
+
+def test_jump_to_an_unknown_address():
+    analysis = M99_analysis.analyze_source("\tLDA 99\n\tMOV A PC\n")
+    assert not analysis.complete
+    assert analysis.self_modifying
+    assert [(finding.address, finding.kind) for finding in analysis.findings] == [(1, "indirect")]
@@ -0,0 +1,30 @@
+import pytest
+
+import M99
+
+
+def test_labels_and_lines():
+    code = "# countdown\n:loop\n\tLDA 99 # read\n\n\tJMP @loop\n:end\n\tMOV A R\n"
+    (program, labels, lines) = M99.assemble_program(code)
+    assert program == [199, 500, 310]
+    assert labels == {"loop": 0, "end": 2}
+    assert lines == [3, 5, 7]
+
+
+def test_label_used_before_its_definition():
+    assert M99.assemble("JMP @end\nLDA 99\n:end\nSTR 99\n") == [502, 199, 99]
+
+
+def test_redefined_label_keeps_the_last_one():
+    assert M99.assemble(":here\nLDA 99\n:here\nJMP @here\n") == [199, 501]
+
+
+def test_every_error_is_reported():
+    code = "LDA 99\nFOO 1\nJMP @nowhere\nMOV A\n"
+    with pytest.raises(ValueError) as error:
+        M99.assemble(code)
+    assert str(error.value).split("\n") == [
+        "Invalid instruction at line 2 : FOO 1",
+        "Invalid instruction at line 4 : MOV A",
+        "Undefined label nowhere at line 3",
+    ]
@@ -0,0 +1,68 @@
+import asyncio
+import os
+
+import pytest
+
+import M99
+import M99_async
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PRIME = M99_async.load_program(os.path.join(ROOT, "exemples", "nth-prime.m99"))
+
+
+def reference(program, inputs):
+    machine = M99.M99()
+    machine.read_value = M99.IterableInput(inputs)
+    machine.write_value = M99.ListOutput()
+    machine.load(program)
+    try:
+        machine.run(engine="step")
+    except ValueError:
+        pass
+    return (machine.write_value.values, machine.stats.steps)
+
+
+@pytest.mark.parametrize("engine", M99_async.ASYNC_ENGINES)
+def test_run_waits_for_the_input(engine):
+    async def main():
+        host = M99_async.AsyncM99(engine=engine, slice_size=7)
+        host.machine.load(PRIME)
+        task = asyncio.create_task(host.run())
+        for _ in range(10):
+            await asyncio.sleep(0)
+        # The machine waits for its value without blocking the event loop
+        assert not task.done()
+        await host.inputs.put(30)
+        steps = await task
+        return ([host.outputs.get_nowait() for _ in range(host.outputs.qsize())], steps)
+
+    assert asyncio.run(main()) == reference(PRIME, [30])
+
+
+def test_end_of_input_counts_the_executed_instructions():
+    program = M99.assemble("\tLDA 99\n\tLDB 99\n\tADD\n\tSTR 99\n\tJMP 99\n")
+
+    async def main():
+        host = M99_async.AsyncM99()
+        host.machine.load(program)
+        await host.inputs.put(3)
+        await host.inputs.put(None)
+        with pytest.raises(ValueError, match="Invalid input."):
+            await host.run()
+        return host.steps
+
+    assert asyncio.run(main()) == reference(program, [3])[1] == 1
+
+
+def test_update_event_of_the_caller_is_kept():
+    events = []
+
+    async def main():
+        host = M99_async.AsyncM99(slice_size=5)
+        host.machine.after_exec(lambda: events.append(None))
+        host.machine.load(PRIME)
+        await host.inputs.put(5)
+        return await host.run()
+
+    steps = asyncio.run(main())
+    assert len(events) == steps == reference(PRIME, [5])[1]
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+import M99
+import M99_batch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_invalid_register_is_a_runtime_error():
+    # MOV R into the register 6, which does not exist
+    result = M99_batch.run_job(("invalid", 0, [306], [], False))
+    assert result["status"] == 2
+    assert result["steps"] == 0
+
+
+def test_steps_of_a_failing_memoized_run():
+    # The second call of the subroutine is replayed, then the input runs out
+    program = M99.assemble(":loop\n\tCAL @sub\n\tLDA 99\n\tJMP @loop\n:sub\n\tMOV B A\n\tADD\n\tRET\n")
+    M99_batch.memoizer = (None, None)
+    result = M99_batch.run_job(("memoized", 0, program, [1], False), memoize=True)
+    assert M99_batch.memoizer[1].hits == 1
+    assert result["status"] == 2
+    assert result["steps"] == 10
+
+
+@pytest.mark.parametrize("engine", M99.ENGINES)
+def test_engines_give_the_same_results(engine):
+    with open(os.path.join(ROOT, "exemples", "nth-prime.m99")) as f:
+        program = M99.assemble(f.read())
+    expected = M99_batch.run_job(("prime", 0, program, [20], False), engine="step")
+    assert expected["outputs"] == [71]
+    assert M99_batch.run_job(("prime", 0, program, [20], False), engine=engine) == expected
+
+
+@pytest.mark.parametrize("engine", M99.ENGINES)
+def test_instruction_budget(engine):
+    program = M99.assemble(":loop\n\tLDA 1\n\tLDB 1\n\tJMP @loop\n")
+    result = M99_batch.run_job(("loop", 0, program, [], False), engine=engine, max_steps=100)
+    assert result["status"] == 3
+    assert result["error"] == "Instruction budget exhausted."
+    assert result["steps"] >= 100
@@ -0,0 +1,96 @@
+import pytest
+
+import M99
+import M99_worker
+from test_worker import wait_for
+
+# Counts down from the value read, writing each value
+COUNTDOWN = M99.assemble(
+    """
+\tLDA 99
+:loop
+\tMOV A R
+\tSTR 99
+\tLDB @one
+\tSUB
+\tMOV R A
+\tJPP @loop
+\tJMP 99
+:one
+\tDAT 1
+"""
+)
+
+
+def machine(value=3):
+    machine = M99.M99()
+    machine.read_value = M99.IterableInput([value])
+    machine.write_value = M99.ListOutput()
+    machine.load(COUNTDOWN)
+    return machine
+
+
+def test_breakpoint_stops_before_its_instruction():
+    m = machine()
+    m.add_breakpoint(2)
+    m.run(engine="compiled")
+    assert m.stopped == ("breakpoint", 2)
+    assert m.reg[3] == 2
+    assert m.write_value.values == []
+    # Resuming executes the instruction of the breakpoint
+    m.run()
+    assert m.stopped == ("breakpoint", 2)
+    assert m.write_value.values == [3]
+
+
+def test_breakpoint_with_a_false_condition_does_not_stop():
+    m = machine()
+    m.add_breakpoint(2, M99.parse_condition("A == 10"))
+    m.run()
+    assert m.stopped is None
+    assert m._shutdown
+    assert m.write_value.values == [3, 2, 1]
+
+
+def test_breakpoint_condition():
+    m = machine()
+    m.add_breakpoint(2, M99.parse_condition("A == 1"))
+    m.run()
+    assert m.stopped == ("breakpoint", 2)
+    assert m.write_value.values == [3, 2]
+
+
+def test_watchpoint_stops_after_the_change():
+    m = machine()
+    m.add_watchpoint("R", M99.parse_condition("R < 3"))
+    m.run()
+    assert m.stopped == ("watchpoint", "R", 3, 2)
+    assert m.write_value.values == [3]
+
+
+@pytest.mark.parametrize("expression", ["X > 1", "abs(A) > 1", "mem.index(0)"])
+def test_condition_with_unknown_names(expression):
+    with pytest.raises(ValueError):
+        M99.parse_condition(expression)
+
+
+@pytest.mark.parametrize("expression", ["R / 0", 'A < "x"', "mem[200]"])
+def test_condition_failing_when_evaluated(expression):
+    m = machine()
+    m.add_breakpoint(2, M99.parse_condition(expression))
+    with pytest.raises(ValueError, match="Invalid condition"):
+        m.run()
+
+
+def test_failing_condition_is_reported_by_the_worker():
+    worker = M99_worker.MachineWorker(M99.M99())
+    worker.start()
+    try:
+        worker.send("load", COUNTDOWN)
+        worker.send("break", 0, M99.parse_condition("R / 0"))
+        worker.send("run")
+        assert wait_for(worker, "error")[0] == "error"
+    finally:
+        worker.send("quit")
+        worker.join(timeout=5)
+    assert not worker.is_alive()
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+import M99
+
+SOURCE = "\tLDA 99\n\tLDB 99\n\tADD\n\tSTR 99\n\tJMP 99\n"
+
+
+def entries(directory):
+    return sorted(os.listdir(directory))
+
+
+def test_miss_then_hit(tmp_path):
+    cache = M99.AssemblyCache(str(tmp_path))
+    result = cache.assemble(SOURCE)
+    assert result == M99.assemble_program(SOURCE)
+    assert entries(tmp_path) == [os.path.basename(cache.path(SOURCE))]
+    # A hit reads the entry instead of assembling the source again
+    with open(cache.path(SOURCE), "wb") as f:
+        f.write(M99.pack_image([599], {}, [1]))
+    assert cache.assemble(SOURCE)[0] == [599]
+
+
+def test_invalid_entry_is_a_miss(tmp_path):
+    cache = M99.AssemblyCache(str(tmp_path))
+    with open(cache.path(SOURCE), "wb") as f:
+        f.write(b"garbage")
+    assert cache.assemble(SOURCE) == M99.assemble_program(SOURCE)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = M99.AssemblyCache(str(tmp_path))
+    sources = [SOURCE + "\tDAT " + str(i) + "\n" for i in range(3)]
+    cache.assemble(sources[0])
+    size = os.path.getsize(cache.path(sources[0]))
+    cache.max_size = 2 * size
+    for age, source in enumerate(sources[1:], 1):
+        os.utime(cache.path(sources[0]), (age, age))
+        cache.assemble(source)
+    assert entries(tmp_path) == sorted(os.path.basename(cache.path(source)) for source in sources[1:])
+
+
+def test_failed_store_leaves_no_temporary_file(tmp_path, monkeypatch):
+    cache = M99.AssemblyCache(str(tmp_path))
+
+    def fail(source, destination):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", fail)
+    with pytest.raises(OSError):
+        cache.store(cache.path(SOURCE), b"data")
+    assert entries(tmp_path) == []
+    # The cache only misses
+    assert cache.assemble(SOURCE) == M99.assemble_program(SOURCE)
@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_cli(*args, tmp_path):
+    env = dict(os.environ, M99_CACHE_DIR=str(tmp_path / "cache"))
+    return subprocess.run(
+        [sys.executable, os.path.join(ROOT, "M99.py"), *args],
+        capture_output=True,
+        text=True,
+        cwd=ROOT,
+        env=env,
+    )
+
+
+def test_inputs_before_the_file(tmp_path):
+    result = run_cli("-i", "3", "-i", "4", "exemples/add.m99", tmp_path=tmp_path)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert result.stdout.split() == ["7"]
+
+
+def test_truncated_image(tmp_path):
+    path = str(tmp_path / "add.m99i")
+    assert run_cli("exemples/labels.m99", "-o", path, tmp_path=tmp_path).returncode == 0
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:-3])
+    result = run_cli("--image", path, tmp_path=tmp_path)
+    assert result.returncode == 1
+    assert result.stdout.strip() == "Invalid image."
+    assert "Traceback" not in result.stderr
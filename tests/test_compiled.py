@@ -0,0 +1,18 @@
+import M99
+
+
+def run(program, inputs, engine):
+    machine = M99.M99()
+    machine.read_value = M99.IterableInput(inputs)
+    machine.write_value = M99.ListOutput()
+    machine.load(program)
+    steps = machine.run(engine=engine, max_steps=2000)
+    return (steps, machine.mem, machine.reg, machine._shutdown, machine.write_value.values)
+
+
+def test_store_into_uncompilable_cell():
+    # Cell 3 holds LDA 99 when it is first reached, so it is executed with
+    # step, then STR 3 turns it into STR 0 which must rewrite cell 0 before
+    # the first block runs again
+    program = [615, 333, 331, 199, 402, 202, 3, 409]
+    assert run(program, [0], "compiled") == run(program, [0], "step")
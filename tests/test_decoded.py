@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+import M99
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Programs of the repository with the values they read
+PROGRAMS = [
+    ("exemples/add.m99", [12, -30]),
+    ("exemples/labels.m99", [4, 9, 2]),
+    ("exemples/nth-prime.m99", [20]),
+    ("benchmarks/programs/stack.m99", [50]),
+    ("benchmarks/programs/loop.m99", [10]),
+    ("benchmarks/programs/selfmod.m99", [50]),
+]
+
+
+def run(program, inputs, engine, max_steps=None):
+    machine = M99.M99()
+    machine.read_value = M99.IterableInput(inputs)
+    machine.write_value = M99.ListOutput()
+    machine.load(program)
+    steps = machine.run(engine=engine, max_steps=max_steps)
+    return (steps, list(machine.mem), machine.reg, machine._shutdown, machine.write_value.values)
+
+
+@pytest.mark.parametrize("path, inputs", PROGRAMS)
+def test_same_results_as_step(path, inputs):
+    with open(os.path.join(ROOT, path)) as f:
+        program = M99.assemble(f.read())
+    assert run(program, inputs, "decoded") == run(program, inputs, "step")
+
+
+def test_stops_after_max_steps():
+    program = M99.assemble(":loop\n\tLDA 1\n\tJMP @loop\n")
+    result = run(program, [], "decoded", max_steps=7)
+    assert result[0] == 7
+    assert result == run(program, [], "step", max_steps=7)
+
+
+def test_store_over_the_next_instruction():
+    # STR 3 replaces the JMP 99 at address 3 by the value read, LDA 5, so the
+    # decoded instruction must be updated before it is executed
+    program = M99.assemble("LDA 99\nMOV A R\nSTR 3\nJMP 99\nMOV A R\nSTR 99\nJMP 99\n")
+    result = run(program, [105], "decoded")
+    assert result[4] == [99]
+    assert result == run(program, [105], "step")
+
+
+@pytest.mark.parametrize("opcode", [306, 1000, 470])
+def test_invalid_instruction_fails_like_step(opcode):
+    errors = []
+    for engine in ("step", "decoded"):
+        machine = M99.M99()
+        machine.load([opcode])
+        with pytest.raises(Exception) as error:
+            machine.run(engine=engine)
+        errors.append((type(error.value), str(error.value), machine.reg))
+    assert errors[0] == errors[1]
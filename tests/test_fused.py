@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+import M99
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(program, inputs, engine, max_steps=None):
+    machine = M99.M99()
+    machine.read_value = M99.IterableInput(inputs)
+    machine.write_value = M99.ListOutput()
+    machine.load(program)
+    steps = machine.run(engine=engine, max_steps=max_steps)
+    return (steps, list(machine.mem), machine.reg, machine._shutdown, machine.write_value.values)
+
+
+@pytest.mark.parametrize(
+    "path, inputs",
+    [
+        ("exemples/labels.m99", [4, 9, 2]),
+        ("exemples/nth-prime.m99", [20]),
+        ("benchmarks/programs/stack.m99", [50]),
+        ("benchmarks/programs/loop.m99", [10]),
+        ("benchmarks/programs/selfmod.m99", [50]),
+    ],
+)
+def test_same_results_as_step(path, inputs):
+    with open(os.path.join(ROOT, path)) as f:
+        program = M99.assemble(f.read())
+    assert run(program, inputs, "fused") == run(program, inputs, "step")
+
+
+# The first iteration replaces the SUB of the fused LDA; LDB; SUB; JPP
+# sequence at loop by a jump to done
+PATCHED_SEQUENCE = """
+	LDA 99
+	MOV A R
+	STR @count
+:loop
+	LDA @count
+	LDB @one
+:op
+	SUB
+	JPP @store
+	JMP @done
+:store
+	STR @count
+	LDA @patch
+	MOV A R
+	STR @op
+	JMP @loop
+:done
+	LDA @count
+	MOV A R
+	STR 99
+	JMP 99
+:patch
+	JMP @done
+:one
+	DAT 1
+:count
+	DAT 0
+"""
+
+# Positive values jump into the middle of the fused LDA; LDB; SUB; JPP
+# sequence, skipping its LDA
+JUMP_INTO_SEQUENCE = """
+	LDA 99
+	MOV A R
+	JPP @middle
+	LDA @ten
+:middle
+	LDB @one
+	SUB
+	JPP @positive
+	JMP 99
+:positive
+	STR 99
+	JMP 99
+:one
+	DAT 1
+:ten
+	DAT 10
+"""
+
+
+def test_store_into_a_fused_sequence():
+    program = M99.assemble(PATCHED_SEQUENCE)
+    result = run(program, [5], "fused")
+    assert result[4] == [4]
+    assert result == run(program, [5], "step")
+
+
+@pytest.mark.parametrize("value, output", [(8, 7), (-4, 9)])
+def test_jump_into_a_fused_sequence(value, output):
+    program = M99.assemble(JUMP_INTO_SEQUENCE)
+    result = run(program, [value], "fused")
+    assert result[4] == [output]
+    assert result == run(program, [value], "step")
+
+
+@pytest.mark.parametrize("max_steps", range(1, 9))
+def test_max_steps_inside_a_fused_sequence(max_steps):
+    program = M99.assemble(JUMP_INTO_SEQUENCE)
+    assert run(program, [-4], "fused", max_steps) == run(program, [-4], "step", max_steps)
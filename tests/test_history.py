@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+import M99
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_failing_run_records_the_executed_instructions():
+    machine = M99.M99()
+    # The POP fails, the stack being empty
+    machine.load(M99.assemble("\tLDA 1\n\tLDB 1\n\tPOP A\n\tJMP 99"))
+    history = M99.History(machine)
+    with pytest.raises(ValueError, match="Stack is empty."):
+        history.run()
+    assert history.steps == 2
+    assert machine.reg[3] == 2
+    assert not machine._shutdown
+    assert history.step_back()
+    assert machine.reg[3] == 1
+
+
+def prime_machine(inputs):
+    with open(os.path.join(ROOT, "exemples", "nth-prime.m99")) as f:
+        program = M99.assemble(f.read())
+    machine = M99.M99()
+    machine.read_value = M99.IterableInput(inputs)
+    machine.write_value = M99.ListOutput()
+    machine.load(program)
+    return machine
+
+
+def state_after(steps):
+    machine = prime_machine([20])
+    machine.run(engine="step", max_steps=steps)
+    return (list(machine.mem), machine.reg, machine._shutdown)
+
+
+def state(machine):
+    return (list(machine.mem), machine.reg, machine._shutdown)
+
+
+def test_step_back_over_recorded_steps():
+    machine = prime_machine([20])
+    history = M99.History(machine)
+    for _ in range(60):
+        history.step()
+    for steps in range(59, 54, -1):
+        assert history.step_back()
+        assert history.steps == steps
+        assert state(machine) == state_after(steps)
+
+
+def test_step_back_to_the_start():
+    reads = []
+    machine = prime_machine([])
+    machine.read_value = lambda: reads.append(20) or 20
+    history = M99.History(machine)
+    for _ in range(3):
+        history.step()
+    while history.step_back():
+        pass
+    assert history.steps == 0
+    assert state(machine) == state_after(0)
+    # The value is read again from the history
+    for _ in range(3):
+        history.step()
+    assert reads == [20]
+    assert state(machine) == state_after(3)
+
+
+def test_step_back_into_a_run():
+    machine = prime_machine([20])
+    history = M99.History(machine, interval=100)
+    steps = history.run()
+    assert machine.write_value.values == [71]
+    assert history.step_back()
+    assert history.steps == steps - 1
+    assert state(machine) == state_after(steps - 1)
+    # The output is not written again by the replay
+    assert machine.write_value.values == [71]
+    history.step()
+    assert state(machine) == state_after(steps)
+
+
+def test_back_to():
+    machine = prime_machine([20])
+    history = M99.History(machine, interval=100)
+    history.run(max_steps=500)
+    assert history.back_to(0)
+    assert machine.reg[3] == 0
+    assert history.steps == 0
+    assert state(machine) == state_after(0)
+
+
+def test_back_to_an_address_never_reached():
+    machine = prime_machine([20])
+    history = M99.History(machine, interval=100)
+    history.run(max_steps=500)
+    assert not history.back_to(98)
+    assert history.steps == 500
+    assert state(machine) == state_after(500)
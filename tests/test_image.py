@@ -0,0 +1,15 @@
+import pytest
+import M99
+
+
+def test_truncated_labels(tmp_path):
+    path = str(tmp_path / "add.m99i")
+    (program, labels, lines) = M99.assemble_program(":main\n\tLDA 99\n\tLDB 99\n\tADD\n\tSTR 99\n")
+    M99.write_image(path, program, labels, lines)
+    with M99.Image(path) as image:
+        assert image.labels == labels
+    with open(path, "rb") as f:
+        data = f.read()
+    for size in (len(data) - 1, len(data) - len("main")):
+        with pytest.raises(ValueError, match="Invalid image."):
+            M99.Image(data[:size])
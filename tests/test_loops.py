@@ -0,0 +1,23 @@
+import pytest
+import M99
+
+
+def test_read_before_max_steps_resets_detection():
+    # The run stops right after the second read, once the state at the jump
+    # was saved: the resumed run must not find it again after the read
+    machine = M99.M99()
+    machine.read_value = M99.IterableInput([0] * 5)
+    machine.load(M99.assemble(":loop\n\tLDA 99\n\tJMP @loop\n"))
+    detector = M99.LoopDetector()
+    assert machine.run(loop_detector=detector, max_steps=3) == 3
+    with pytest.raises(ValueError) as error:
+        machine.run(loop_detector=detector)
+    assert not isinstance(error.value, M99.InfiniteLoop)
+    assert str(error.value) == "Invalid input."
+
+
+def test_infinite_loop_is_detected():
+    machine = M99.M99()
+    machine.load(M99.assemble(":loop\n\tJMP @loop\n"))
+    with pytest.raises(M99.InfiniteLoop):
+        machine.run(loop_detector=M99.LoopDetector())
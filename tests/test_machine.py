@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+import M99
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize("engine", M99.ENGINES)
+def test_memory_stays_an_int16_array(engine):
+    machine = M99.M99()
+    machine.read_value = M99.IterableInput([12])
+    machine.write_value = M99.ListOutput()
+    with open(os.path.join(ROOT, "exemples", "nth-prime.m99")) as f:
+        machine.load(M99.assemble(f.read()))
+    snapshot = machine.snapshot()
+    machine.run(engine=engine)
+    assert machine.write_value.values == [37]
+    assert machine.mem.typecode == "h"
+    machine.restore(snapshot)
+    assert machine.mem.typecode == "h"
+    assert machine.snapshot() == snapshot
+
+
+def test_load_brings_values_back_into_range():
+    machine = M99.M99()
+    machine.load([100000, 1001, -5])
+    assert machine.mem[:3].tolist() == [M99.M99.manage_overflow(100000), -998, -5]
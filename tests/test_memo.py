@@ -0,0 +1,28 @@
+import M99
+import M99_memo
+
+
+def run_twice(source):
+    program = M99.assemble(source)
+    memoizer = M99_memo.Memoizer()
+    machines = []
+    for _ in range(2):
+        machine = M99.M99()
+        machine.load(program)
+        machine.run(memoizer=memoizer)
+        machines.append(machine)
+    return (memoizer, machines)
+
+
+def test_replayed_call_reports_its_stack_depth():
+    (memoizer, machines) = run_twice(":main\n\tCAL @sub\n\tJMP 99\n:sub\n\tPSH R\n\tPSH R\n\tPOP R\n\tPOP R\n\tRET\n")
+    assert memoizer.hits == 1
+    assert [machine.stats.max_depth for machine in machines] == [2, 2]
+    assert [machine.stats.steps for machine in machines] == [7, 7]
+
+
+def test_call_writing_outside_its_frame_is_not_memoized():
+    (memoizer, machines) = run_twice(":main\n\tCAL @sub\n\tJMP 99\n:sub\n\tSTR @var\n\tRET\n:var\n\tDAT 0\n")
+    assert memoizer.hits == 0
+    assert 2 in memoizer.impure
+    assert machines[1].stats.steps == 4
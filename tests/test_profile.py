@@ -0,0 +1,64 @@
+import os
+import json
+
+import M99
+import M99_profile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def profile(inputs):
+    with open(os.path.join(ROOT, "exemples", "labels.m99")) as f:
+        (program, labels, lines) = M99.assemble_program(f.read())
+    machine = M99.M99()
+    machine.read_value = M99.IterableInput(inputs)
+    machine.write_value = M99.ListOutput()
+    machine.load(program)
+    profiler = M99_profile.Profiler()
+    steps = machine.run(profiler=profiler)
+    return (machine, profiler, steps, program, labels, lines)
+
+
+def test_counts_and_classes():
+    (machine, profiler, steps, *_) = profile([4, 9, 2])
+    assert machine.write_value.values == [2]
+    assert steps == sum(profiler.counts) == 23
+    # The subroutine at 11 is called twice and always returns from 16
+    assert profiler.counts[:17] == [1] * 11 + [2] * 6
+    assert profiler.counts[17:] == [0] * 82
+    assert profiler.classes() == {
+        "PSH": 5, "POP": 5, "LDA": 3, "CAL": 2, "SUB": 2, "JPP": 2, "RET": 2, "STR": 1, "JMP": 1
+    }
+
+
+def test_call_edges():
+    (_, profiler, *_) = profile([4, 9, 2])
+    assert profiler.edges == {(6, 11): 1, (16, 7): 1, (7, 11): 1, (16, 8): 1}
+
+
+def test_report(tmp_path):
+    (_, profiler, _, program, labels, lines) = profile([4, 9, 2])
+    report = profiler.report(program, labels, lines)
+    assert report["steps"] == 23
+    assert {"from": 6, "to": 11, "from_label": "main+6", "to_label": "comp", "count": 1} in report["calls"]
+    entry = next(entry for entry in report["addresses"] if entry["address"] == 14)
+    assert (entry["line"], entry["label"], entry["instruction"], entry["count"]) == (18, "comp+3", "JPP 17", 2)
+    assert "JPP 17" in M99_profile.format_report(report)
+
+    profiler.dump(str(tmp_path / "profile.json"), program, labels, lines)
+    with open(tmp_path / "profile.json") as f:
+        assert json.load(f)["classes"] == report["classes"]
+
+
+def test_same_results_as_step():
+    (machine, _, _, program, *_) = profile([-5, 0, 7])
+    reference = M99.M99()
+    reference.read_value = M99.IterableInput([-5, 0, 7])
+    reference.write_value = M99.ListOutput()
+    reference.load(program)
+    reference.run(engine="step")
+    assert (machine.mem, machine.reg, machine.write_value.values) == (
+        reference.mem,
+        reference.reg,
+        reference.write_value.values,
+    )
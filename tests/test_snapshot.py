@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+import M99
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def prime_machine(inputs):
+    with open(os.path.join(ROOT, "exemples", "nth-prime.m99")) as f:
+        program = M99.assemble(f.read())
+    machine = M99.M99()
+    machine.read_value = M99.IterableInput(inputs)
+    machine.write_value = M99.ListOutput()
+    machine.load(program)
+    return machine
+
+
+def test_restore_resumes_the_run():
+    machine = prime_machine([20])
+    machine.run(engine="decoded", max_steps=100)
+    snapshot = machine.snapshot()
+    machine.run(engine="decoded")
+    end = (list(machine.mem), machine.reg, machine.write_value.values)
+
+    machine.restore(snapshot)
+    assert machine.snapshot() == snapshot
+    machine.write_value = M99.ListOutput()
+    machine.run(engine="decoded")
+    assert (list(machine.mem), machine.reg, machine.write_value.values) == end
+    assert end[2] == [71]
+
+
+def test_pack_and_unpack():
+    machine = prime_machine([20])
+    machine.run(max_steps=50)
+    snapshot = machine.snapshot()
+    assert M99.Snapshot.unpack(snapshot.pack()) == snapshot
+    assert len(snapshot.memory) == 2 * 99
+
+
+def test_registers_out_of_int16():
+    machine = M99.M99()
+    machine.reg[0] = 998001
+    snapshot = machine.snapshot()
+    assert len(snapshot.registers) == 8 * 6
+    restored = M99.M99()
+    restored.restore(M99.Snapshot.unpack(snapshot.pack()))
+    assert restored.reg == machine.reg
+
+
+@pytest.mark.parametrize("data", [b"", b"\x00" * 3, M99.M99().snapshot().pack()[:-1]])
+def test_invalid_snapshot(data):
+    with pytest.raises(ValueError):
+        M99.Snapshot.unpack(data)
+
+
+def test_checkpoint_ring(tmp_path):
+    path = str(tmp_path / "run.ckpt")
+    machine = M99.M99()
+    machine.load(M99.assemble(":loop\n\tLDA 1\n\tJMP @loop\n"))
+    checkpoints = M99.Checkpoints(interval=10, size=3, path=path)
+    assert checkpoints.latest() is None
+    assert machine.run(checkpoints=checkpoints, max_steps=95) == 95
+    assert [steps for steps, _ in checkpoints.ring] == [70, 80, 90]
+    assert checkpoints.steps == 95
+    assert M99.Checkpoints.load(path) == checkpoints.latest()
+    assert os.listdir(tmp_path) == ["run.ckpt"]
+
+
+def test_resume_from_checkpoint_file(tmp_path):
+    path = str(tmp_path / "run.ckpt")
+    machine = prime_machine([20])
+    machine.run(engine="step", checkpoints=M99.Checkpoints(interval=100, path=path), max_steps=250)
+    (steps, snapshot) = M99.Checkpoints.load(path)
+    assert steps == 200
+
+    # The value was read before the checkpoint
+    resumed = prime_machine([])
+    resumed.restore(snapshot)
+    resumed.run(engine="decoded")
+    assert resumed.write_value.values == [71]
@@ -0,0 +1,50 @@
+import pytest
+
+import M99
+import M99_memo
+import M99_profile
+import M99_trace
+
+# Reads values and pushes them until the input runs out
+SOURCE = ":loop\n\tLDA 99\n\tPSH A\n\tJMP @loop\n"
+
+
+def failing_run(**kwargs):
+    machine = M99.M99()
+    machine.read_value = M99.IterableInput([5] * 10)
+    machine.load(M99.assemble(SOURCE))
+    with pytest.raises(ValueError, match="Invalid input."):
+        machine.run(**kwargs)
+    return machine
+
+
+@pytest.mark.parametrize("engine", M99.ENGINES)
+def test_stats_of_a_failing_run(engine):
+    stats = failing_run(engine=engine).stats
+    assert (stats.steps, stats.max_depth, stats.inputs, stats.outputs) == (30, 10, 10, 0)
+
+
+@pytest.mark.parametrize(
+    "delegate",
+    ["profiler", "tracer", "loop_detector", "memoizer", "checkpoints", "timeout"],
+)
+def test_stats_of_a_failing_delegated_run(delegate, tmp_path):
+    kwargs = {
+        "profiler": {"profiler": M99_profile.Profiler()},
+        "tracer": {"tracer": M99_trace.Tracer(str(tmp_path / "trace"))},
+        "loop_detector": {"loop_detector": M99.LoopDetector()},
+        "memoizer": {"memoizer": M99_memo.Memoizer()},
+        "checkpoints": {"checkpoints": M99.Checkpoints(interval=10)},
+        "timeout": {"timeout": 60},
+    }[delegate]
+    assert failing_run(**kwargs).stats.steps == 30
+
+
+def test_cli_reports_the_stats_of_a_failing_run(tmp_path):
+    from test_cli import run_cli
+
+    path = tmp_path / "overflow.m99"
+    path.write_text(SOURCE)
+    result = run_cli("--stats", "-i", "5", str(path), tmp_path=tmp_path)
+    assert result.returncode == 2
+    assert "Steps: 3, stack depth: 1, inputs: 1, outputs: 0" in result.stderr
@@ -0,0 +1,31 @@
+import M99
+import M99_trace
+
+# LDA 2, MOV A PC, then the PC -95 + 1 runs the cell 5: STR 99, JMP 99
+NEGATIVE_PC = [102, 313, -95, 0, 0, 99, 599]
+
+
+def test_negative_pc(tmp_path):
+    path = str(tmp_path / "run.m99t")
+    machine = M99.M99()
+    machine.write_value = M99.ListOutput()
+    machine.load(NEGATIVE_PC)
+    tracer = M99_trace.Tracer(path)
+    assert machine.run(tracer=tracer) == 4
+    tracer.close()
+    assert machine._shutdown
+    trace = M99_trace.Trace(path)
+    assert trace.records["pc"].tolist() == [0, 1, 5, 6]
+
+
+def test_inputs_are_recorded_in_range(tmp_path):
+    path = str(tmp_path / "run.m99t")
+    machine = M99.M99()
+    machine.read_value = M99.IterableInput([1001, 10**12])
+    machine.load(M99.assemble("\tLDA 99\n\tLDB 99\n\tJMP 99"))
+    tracer = M99_trace.Tracer(path)
+    assert machine.run(tracer=tracer) == 3
+    tracer.close()
+    assert machine.reg[1:3] == [-998, 125]
+    trace = M99_trace.Trace(path)
+    assert trace.records["value"][:2].tolist() == [-998, 125]
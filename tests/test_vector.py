@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+import M99
+import M99_vector
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_step(program, inputs):
+    machine = M99.M99()
+    machine.read_value = M99.IterableInput(inputs)
+    machine.write_value = M99.ListOutput()
+    machine.load(program)
+    try:
+        steps = machine.run(engine="step")
+    except ValueError:
+        steps = machine.stats.steps
+    return (steps, list(machine.mem), machine.reg, machine.write_value.values)
+
+
+@pytest.mark.parametrize(
+    "path, inputs",
+    [
+        ("exemples/nth-prime.m99", [[1], [5], [20], [0], [-3]]),
+        ("exemples/labels.m99", [[4, 9, 2], [-5, 0, 7], [1, 1, 1]]),
+        ("benchmarks/programs/selfmod.m99", [[10], [50]]),
+    ],
+)
+def test_same_results_as_step(path, inputs):
+    with open(os.path.join(ROOT, path)) as f:
+        program = M99.assemble(f.read())
+    batch = M99_vector.BatchM99(len(inputs))
+    batch.set_inputs(inputs)
+    batch.load(program)
+    batch.run()
+    assert batch.halted.all()
+    for i, values in enumerate(inputs):
+        machine = batch.machine(i)
+        result = (int(batch.steps[i]), list(machine.mem), machine.reg, batch.outputs[i])
+        assert result == run_step(program, values)
+
+
+def test_input_runs_out():
+    program = M99.assemble(":loop\n\tLDA 99\n\tMOV A R\n\tSTR 99\n\tJMP @loop\n")
+    batch = M99_vector.BatchM99(2)
+    batch.set_inputs([[1, 2], [3000]])
+    batch.load(program)
+    batch.run()
+    assert batch.outputs == [[1, 2], [-998]]
+    assert batch.failed.tolist() == [True, True]
+    assert [str(error) for error in batch.errors] == ["Invalid input.", "Invalid input."]
+
+
+def test_one_program_per_machine():
+    batch = M99_vector.BatchM99(2)
+    batch.load(M99.assemble("LDA 99\nMOV A R\nSTR 99\nJMP 99\n") + [0])
+    batch.load([[198], [199]])
+    batch.set_inputs([[7], [7]])
+    batch.run()
+    assert batch.outputs == [[0], [7]]
+
+
+def test_max_steps():
+    batch = M99_vector.BatchM99(3)
+    batch.load(M99.assemble(":loop\n\tJMP @loop\n"))
+    assert batch.run(max_steps=10) == 10
+    assert not batch.halted.any()
+
+
+def test_one_input_queue_per_machine():
+    batch = M99_vector.BatchM99(2)
+    with pytest.raises(ValueError):
+        batch.set_inputs([[1]])
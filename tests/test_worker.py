@@ -0,0 +1,26 @@
+import M99
+import M99_worker
+
+
+def wait_for(worker, kind):
+    while True:
+        event = worker.events.get(timeout=5)
+        if event[0] == kind:
+            return event
+
+
+def test_invalid_register_is_reported():
+    worker = M99_worker.MachineWorker(M99.M99())
+    worker.start()
+    try:
+        # MOV R into the register 6, which does not exist
+        worker.send("load", [306])
+        worker.send("run")
+        assert wait_for(worker, "error")[0] == "error"
+        # The thread is still alive and handles the next commands
+        worker.send("step")
+        assert wait_for(worker, "error")[0] == "error"
+    finally:
+        worker.send("quit")
+        worker.join(timeout=5)
+    assert not worker.is_alive()